@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+# Benchmark of the still frame extraction strategies of the 'create_still_frame_images' Lambda function.
+#
+# Requires ffmpeg and ffprobe on the PATH, and the Lambda function's dependencies:
+#   pip install aws-lambda-powertools
+#
+# Usage (from the root of the repository):
+#   python benchmarks/frame_extraction_benchmark.py --duration 1800 --workers 2 4 8
+#   python benchmarks/frame_extraction_benchmark.py --video my-recording.mp4
+#   python benchmarks/frame_extraction_benchmark.py --keyframe-interval 1
+#
+# Without '--video', a synthetic 1080p screen-like recording of '--duration' seconds is generated first, with a
+#  keyframe every '--keyframe-interval' seconds. Besides the extraction modes, the decode modes are compared
+#  (every frame, keyframes only, seeking to every sample point) along with the one picked by the 'auto' mode.
+import argparse
+import os, sys, time, resource
+import shutil, subprocess, tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "create_still_frame_images"))
+from lib import frame_extraction # type: ignore
+
+
+def generate_video(video_path: str, duration: int, keyframe_interval: float = 10) -> None:
+    subprocess.check_call([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=1920x1080:rate=30:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", str(max(round(30 * keyframe_interval), 1)), "-pix_fmt", "yuv420p",
+        video_path,
+    ])
+
+
+def children_cpu_seconds() -> float:
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# Run one extraction strategy, consuming (and discarding) the frames as the handler would
+def run(name: str, frames_factory, work_dir: str) -> dict:
+    image_dir = os.path.join(work_dir, "images")
+    os.makedirs(image_dir, exist_ok=True)
+    cpu_start = children_cpu_seconds()
+    wall_start = time.perf_counter()
+    count = 0
+    for frame in frames_factory(image_dir):
+        count += 1
+    wall = time.perf_counter() - wall_start
+    cpu = children_cpu_seconds() - cpu_start
+    shutil.rmtree(image_dir)
+    return {"strategy": name, "frames": count, "wall": wall, "cpu": cpu}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark of the still frame extraction strategies")
+    parser.add_argument("--video", help="video file to extract frames from (a synthetic one is generated otherwise)")
+    parser.add_argument("--duration", type=int, default=600, help="duration in seconds of the synthetic video")
+    parser.add_argument("--workers", type=int, nargs="+", default=[2, 4], help="number of parallel FFmpeg processes to try")
+    parser.add_argument("--keyframe-interval", type=float, default=10, help="seconds between keyframes of the synthetic video")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_path = args.video
+        if not video_path:
+            video_path = os.path.join(work_dir, "video.mp4")
+            print(f"Generating a {args.duration}s synthetic video...")
+            generate_video(video_path, args.duration, args.keyframe_interval)
+        duration = frame_extraction.probe_duration(video_path)
+        stream_info = frame_extraction.probe_video_stream(video_path)
+
+        results = [run("single process", lambda image_dir: frame_extraction.extract_frames(video_path, image_dir), work_dir)]
+        for workers in args.workers:
+            results.append(run(f"parallel x{workers}",
+                               lambda image_dir: frame_extraction.extract_frames_in_parallel(video_path, image_dir, workers=workers),
+                               work_dir))
+        results.append(run("keyframes only",
+                           lambda image_dir: frame_extraction.extract_frames(video_path, image_dir, keyframes_only=True), work_dir))
+        for workers in args.workers:
+            results.append(run(f"seek x{workers}",
+                               lambda image_dir: frame_extraction.seek_frames(video_path, workers=workers), work_dir))
+
+        baseline = results[0]["wall"]
+        print(f"\nVideo: {video_path} ({duration:.0f}s, {stream_info.codec} at {stream_info.frame_rate:.2f} fps, "
+              f"a keyframe every {stream_info.keyframe_interval:.2f}s), {os.cpu_count()} CPU cores")
+        print(f"Decode mode picked by 'auto': {frame_extraction.choose_decode_mode(stream_info)}\n")
+        print(f"{'strategy':<20}{'frames':>8}{'wall (s)':>10}{'speedup':>9}{'CPU-s/video-min':>17}")
+        for result in results:
+            print(f"{result['strategy']:<20}{result['frames']:>8}{result['wall']:>10.1f}{baseline / result['wall']:>8.2f}x"
+                  f"{result['cpu'] / (duration / 60):>17.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Check of the 'url' and 'pipe' video input modes of the 'create_still_frame_images' Lambda function.
+#
+# Requires ffmpeg on the PATH, and the Lambda function's dependencies:
+#   pip install aws-lambda-powertools
+#
+# Usage (from the root of the repository):
+#   python benchmarks/video_input_modes_check.py
+#   python benchmarks/video_input_modes_check.py --video my-recording.mp4
+#   python benchmarks/video_input_modes_check.py --no-faststart
+#
+# The video (a synthetic one of '--duration' seconds without '--video') is served by a local HTTP server supporting
+#  range requests, as S3 serves it through a presigned URL. The frames are streamed out of the local file first,
+#  then with FFmpeg reading the URL ('url' mode), and with the HTTP response piped into FFmpeg's standard input
+#  ('pipe' mode, as the S3 object body is). Both sampling modes and a chunk read with range requests must give the
+#  same frames, thumbnails and timestamps as the local file. '--no-faststart' generates the synthetic video with
+#  the 'moov' atom last, which the 'pipe' mode is expected to fail on.
+import argparse
+import os, sys, re, threading, time
+import subprocess, tempfile, urllib.request
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambdas", "create_still_frame_images"))
+from lib import frame_extraction # type: ignore
+
+
+def generate_video(video_path: str, duration: int, faststart: bool = True) -> None:
+    subprocess.check_call([
+        "ffmpeg", "-v", "error", "-y",
+        "-f", "lavfi", "-i", f"testsrc2=size=640x360:rate=30:duration={duration}",
+        "-c:v", "libx264", "-preset", "veryfast", "-g", "300", "-pix_fmt", "yuv420p",
+        *(["-movflags", "+faststart"] if faststart else []),
+        video_path,
+    ])
+
+
+# Static file handler answering range requests ('Range: bytes=start-end') with partial content, like S3 does
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    requests = []
+
+    def send_head(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return None
+        size = os.path.getsize(path)
+        start, end = 0, size - 1
+        match = re.fullmatch(r"bytes=(\d*)-(\d*)", self.headers.get("Range", ""))
+        if match and match.group(1):
+            start = int(match.group(1))
+            end = min(int(match.group(2)), end) if match.group(2) else end
+        elif match and match.group(2):
+            start = max(size - int(match.group(2)), 0)
+        if start >= size:
+            self.send_error(416)
+            return None
+        # bytes actually sent, FFmpeg closes the connection when it seeks elsewhere
+        self.sent = [self.headers.get("Range"), 0]
+        RangeRequestHandler.requests.append(self.sent)
+        self.send_response(206 if match else 200)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(end - start + 1))
+        if match:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        video_file = open(path, "rb")
+        video_file.seek(start)
+        self.remaining = end - start + 1
+        return video_file
+
+    def copyfile(self, source, outputfile):
+        while self.remaining > 0:
+            data = source.read(min(self.remaining, 64 * 1024))
+            if not data:
+                break
+            try:
+                outputfile.write(data)
+            except (BrokenPipeError, ConnectionResetError):
+                break
+            self.remaining -= len(data)
+            self.sent[1] += len(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+# Stream the frames the way the handler does, returning what identifies each of them
+#  with 'pipe_url', the HTTP response body is piped into FFmpeg's standard input ('video_path' being 'pipe:0')
+def run(name: str, video_path: str, pipe_url: str | None = None, **kwargs) -> dict:
+    RangeRequestHandler.requests.clear()
+    start = time.perf_counter()
+    video_stream = urllib.request.urlopen(pipe_url) if pipe_url else None
+    frames = [(frame.number, round(frame.timestamp, 3), frame.sha256, hash(frame.thumbnail))
+              for frame in frame_extraction.stream_frames(video_path, True, video_stream, **kwargs)]
+    return {"run": name, "frames": frames, "wall": time.perf_counter() - start,
+            "requests": len(RangeRequestHandler.requests),
+            "bytes": sum(sent for _, sent in RangeRequestHandler.requests)}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Check of the 'url' and 'pipe' video input modes")
+    parser.add_argument("--video", help="video file to extract frames from (a synthetic one is generated otherwise)")
+    parser.add_argument("--duration", type=int, default=60, help="duration in seconds of the synthetic video")
+    parser.add_argument("--no-faststart", action="store_true", help="put the 'moov' atom of the synthetic video last")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        video_path = args.video
+        if not video_path:
+            video_path = os.path.join(work_dir, "video.mp4")
+            print(f"Generating a {args.duration}s synthetic video...")
+            generate_video(video_path, args.duration, faststart=not args.no_faststart)
+        video_path = os.path.abspath(video_path)
+        handler = lambda *handler_args: RangeRequestHandler(*handler_args, directory=os.path.dirname(video_path))
+        server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        video_url = f"http://127.0.0.1:{server.server_port}/{os.path.basename(video_path)}"
+
+        scene_sampling = frame_extraction.SceneSampling()
+        chunk_start, chunk_duration = 20, 10
+        cases = [
+            ("fixed rate", {}),
+            ("scene change", {"scene_sampling": scene_sampling}),
+            (f"chunk {chunk_start}-{chunk_start + chunk_duration}s",
+             {"start": chunk_start, "duration": chunk_duration, "first_number": chunk_start * frame_extraction.FPS}),
+        ]
+        results, failures = [], []
+        for case, kwargs in cases:
+            reference = run(f"{case}, file", video_path, **kwargs)
+            results.append(reference)
+            runs = [("url", lambda: run(f"{case}, url", video_url, **kwargs))]
+            # chunks seek into the video, which can't be done through a pipe (the handler reads them from a URL)
+            if "start" not in kwargs:
+                runs.append(("pipe", lambda: run(f"{case}, pipe", "pipe:0", video_url, **kwargs)))
+            for mode, mode_run in runs:
+                try:
+                    result = mode_run()
+                except subprocess.CalledProcessError as error:
+                    if mode == "pipe" and args.no_faststart:
+                        print(f"{case}, pipe: FFmpeg failed ({error.returncode}) as expected without the 'moov' atom first")
+                    else:
+                        failures.append(f"{case}, {mode}: FFmpeg failed ({error.returncode})")
+                    continue
+                results.append(result)
+                if result["frames"] != reference["frames"]:
+                    failures.append(f"{result['run']}: the frames differ from the local file's")
+        server.shutdown()
+
+        video_size = os.path.getsize(video_path)
+        print(f"\nVideo: {video_url} ({video_size / 2**20:.1f} MiB)\n")
+        print(f"{'run':<30}{'frames':>8}{'wall (s)':>10}{'requests':>10}{'MiB read':>10}")
+        for result in results:
+            print(f"{result['run']:<30}{len(result['frames']):>8}{result['wall']:>10.1f}{result['requests']:>10}"
+                  f"{result['bytes'] / 2**20:>10.1f}")
+        print()
+        for failure in failures:
+            print(f"FAILED {failure}")
+        if failures:
+            sys.exit(1)
+        print("The 'url' and 'pipe' input modes give the same frames as the local file")
+
+
+if __name__ == "__main__":
+    main()
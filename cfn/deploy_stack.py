@@ -54,6 +54,8 @@ class PAMVideoAnalysis(Stack):
                                 encryption=s3.BucketEncryption.S3_MANAGED, 
                                 enforce_ssl=True,
                                 auto_delete_objects=True,
+                                # cached analyses of the image batches (see the Transcribe-Images-Function's ANALYSIS_CACHE_PREFIX)
+                                lifecycle_rules=[s3.LifecycleRule(prefix="analysis-cache/", expiration=Duration.days(30))],
                                 removal_policy=RemovalPolicy.DESTROY)        
         
         ######################################################
@@ -71,6 +73,15 @@ class PAMVideoAnalysis(Stack):
             removal_policy=RemovalPolicy.DESTROY
         )
         
+        # token buckets pacing the requests of the concurrent image transcriptions to Bedrock, one item per model
+        rate_limit_table = ddb.TableV2(self, "BedrockRateLimitTable",
+            partition_key=ddb.Attribute(name="BucketID", type=ddb.AttributeType.STRING),
+            billing= ddb.Billing.on_demand(),
+            table_class= ddb.TableClass.STANDARD,
+            encryption=ddb.TableEncryptionV2.dynamo_owned_key(),
+            removal_policy=RemovalPolicy.DESTROY
+        )
+        
         ######################################################
         # Define the Dynamo DB table where LLM prompts 
         # will be stored and pre-fill with default prompts
@@ -112,6 +123,8 @@ class PAMVideoAnalysis(Stack):
         boto3_lambda_layer = self.__create_layer_from_pip("boto3", "Layer with recent enough Boto3 Library", "1-35-or-higher")
         # layer with the ffmpeg executable
         ffmpeg_layer = self.__create_layer_from_shell("ffmpeg", "Layer with FFmpeg", "7-0-2-or-higher")
+        # layer with the Bedrock helpers shared by the functions calling the Converse API (retries, rate limiting, streaming)
+        bedrock_converse_layer = self.__create_layer_from_dir("bedrock-converse", "Layer with the shared Bedrock Converse helpers", "1")
         # layer with Lambda powertools
         powertools_layer = lambda_.LayerVersion.from_layer_version_arn(
             self, "PowertoolsLayer",
@@ -123,16 +136,62 @@ class PAMVideoAnalysis(Stack):
         # images from videos, transcribe images and aggregate 
         # transcriptions.
         ######################################################
+        # Model analysing the still frame images, the frames are batched to fit its request limits
+        analysis_model_id = "anthropic.claude-3-haiku-20240307-v1:0"
+        # Lambda allocates CPU in proportion to memory, raise the memory size to
+        #  give more cores to the 'parallel' frame extraction mode
+        extraction_memory_size = self.node.try_get_context("extractionmemorysize")
+        if not extraction_memory_size:
+            extraction_memory_size = 512
+        # Features changing what the model is given are opt-in, as they trade some accuracy for cost (see the README):
+        #  -c framededupthreshold=0.001 drops near-duplicate frames, -c frameformat=jpeg sends lossy JPEG images instead of PNG,
+        #  -c batchoverlap=2 repeats the last frames of a batch in the next one and -c idlethreshold=0.002 skips the idle batches
+        frame_dedup_threshold = self.node.try_get_context("framededupthreshold")
+        if not frame_dedup_threshold:
+            frame_dedup_threshold = 0
+        frame_format = self.node.try_get_context("frameformat")
+        if not frame_format:
+            frame_format = "png"
+        batch_overlap = self.node.try_get_context("batchoverlap")
+        if not batch_overlap:
+            batch_overlap = 0
+        idle_threshold = self.node.try_get_context("idlethreshold")
+        if not idle_threshold:
+            idle_threshold = 0
         create_still_frame_images_function = lambda_.Function(
             self, "Create-Still-Frame-Images-Function",
             code=lambda_.Code.from_asset("lambdas/create_still_frame_images"),
             handler="create_still_frame_images.lambda_handler",
             runtime=PYTHON_VERSION,
             timeout=LAMBDA_TIMEOUT,
-            memory_size=512,
+            memory_size=int(extraction_memory_size),
             environment={
                 "VIDEO_BUCKET": video_bucket.bucket_name,
                 "IMAGE_BUCKET": image_bucket.bucket_name,
+                "FRAME_EXTRACTION_MODE": "stream",
+                "VIDEO_INPUT_MODE": "url",
+                "FRAME_SAMPLING_MODE": "fixed",
+                "FRAME_DECODE_MODE": "auto",
+                "FRAME_SCENE_THRESHOLD": "0.01",
+                "FRAME_MIN_INTERVAL": "0.5",
+                "FRAME_MAX_INTERVAL": "10",
+                "FRAME_DEDUP_THRESHOLD": str(frame_dedup_threshold),
+                "FRAME_DEDUP_PIXEL_DELTA": "16",
+                "FRAME_DEDUP_MAX_GAP": "30",
+                "FRAME_FORMAT": frame_format,
+                "FRAME_QUALITY": "85",
+                "FRAME_MAX_EDGE": "1568",
+                "FRAME_TILE_GRID": "1x1",
+                "FRAME_CROP_CHANGES": "false",
+                "FRAME_CROP_MAX_AREA": "0.5",
+                "IDLE_THRESHOLD": str(idle_threshold),
+                "CHECKPOINT_INTERVAL": "300",
+                "CHECKPOINT_SAFETY_MARGIN": "30",
+                "ANALYSIS_MODEL_ID": analysis_model_id,
+                "BATCH_OVERLAP": str(batch_overlap),
+                "UPLOAD_MAX_WORKERS": "16",
+                "UPLOAD_MAX_POOL_CONNECTIONS": "16",
+                "UPLOAD_MAX_ATTEMPTS": "5",
                 "POWERTOOLS_SERVICE_NAME": "pam-video-analysis",
                 "POWERTOOLS_METRICS_NAMESPACE": "PAMVideoAnalysis",
                 "POWERTOOLS_LOGGER_LOG_EVENT": "true",
@@ -141,33 +200,78 @@ class PAMVideoAnalysis(Stack):
             layers=[boto3_lambda_layer, ffmpeg_layer, powertools_layer]
         )
         video_bucket.grant_read(create_still_frame_images_function)
-        image_bucket.grant_write(create_still_frame_images_function)
+        image_bucket.grant_read_write(create_still_frame_images_function) # checkpoints and manifests are read back
+
+        # Define the Lambda function splitting the videos into chunks extracted in parallel
+        plan_extraction_function = lambda_.Function(
+            self, "Plan-Extraction-Function",
+            code=lambda_.Code.from_asset("lambdas/create_still_frame_images"),
+            handler="plan_extraction.lambda_handler",
+            runtime=PYTHON_VERSION,
+            timeout=Duration.seconds(60),
+            environment={
+                "VIDEO_BUCKET": video_bucket.bucket_name,
+                "CHUNK_DURATION": "600",
+                "POWERTOOLS_SERVICE_NAME": "pam-video-analysis",
+                "POWERTOOLS_METRICS_NAMESPACE": "PAMVideoAnalysis",
+                "POWERTOOLS_LOGGER_LOG_EVENT": "true",
+                "POWERTOOLS_LOG_LEVEL": "DEBUG"
+            },
+            layers=[boto3_lambda_layer, ffmpeg_layer, powertools_layer]
+        )
+        video_bucket.grant_read(plan_extraction_function)
         
         # Define the Lambda function to process each item
+        # an invocation holds the images of up to WORKER_CONCURRENCY batches at once, each taking up to WORKER_MEMORY_MB,
+        #  the function analysing fewer batches at a time when its memory size is smaller
+        transcribe_memory_size = self.node.try_get_context("transcribememorysize")
+        if not transcribe_memory_size:
+            transcribe_memory_size = 1024
         transcribe_images_function = lambda_.Function(
             self, "Transcribe-Images-Function",
             code=lambda_.Code.from_asset("lambdas/transcribe_images"),
             handler="transcribe_images.lambda_handler",
             runtime=PYTHON_VERSION,
             timeout=LAMBDA_TIMEOUT,
+            memory_size=int(transcribe_memory_size),
             environment={
                 "IMAGE_BUCKET": image_bucket.bucket_name,
                 "ANALYSIS_TABLE": video_transcripts_table.table_name,
                 "PROMPT_TABLE": prompt_table.table_name,
-                "ANALYSIS_MODEL_ID": "anthropic.claude-3-haiku-20240307-v1:0",
+                "ANALYSIS_MODEL_ID": analysis_model_id,
+                "ESCALATION_MODEL_ID": "anthropic.claude-3-sonnet-20240229-v1:0",
+                "ESCALATION_MAX_ASSUMPTIONS": "2",
+                "ESCALATION_CHANGE": "0.5",
+                "ESCALATION_COMMAND_LINE": "false",
+                "IMAGE_FETCH_WORKERS": "10",
+                # 'auto' only passes images by S3 location to Amazon Nova models, the Claude models above take the bytes
+                "IMAGE_SOURCE_MODE": "bytes",
+                "WORKER_CONCURRENCY": "5",
+                "WORKER_MEMORY_MB": "200",
+                "PROMPT_CACHE_TTL": "300",
+                "ANALYSIS_CACHE_PREFIX": "analysis-cache",
+                "BEDROCK_MAX_ATTEMPTS": "6",
+                "RATE_LIMIT_TABLE": rate_limit_table.table_name,
+                "RATE_LIMIT_MAX_RATE": "2",
+                "RATE_LIMIT_BURST": "5",
+                "BEDROCK_STREAMING": "false",
+                "PARTIAL_WRITE_INTERVAL": "5",
                 "POWERTOOLS_SERVICE_NAME": "pam-video-analysis",
                 "POWERTOOLS_METRICS_NAMESPACE": "PAMVideoAnalysis",
                 "POWERTOOLS_LOGGER_LOG_EVENT": "true",
                 "POWERTOOLS_LOG_LEVEL": "DEBUG"
             },
-            layers=[boto3_lambda_layer, powertools_layer]
+            layers=[boto3_lambda_layer, powertools_layer, bedrock_converse_layer]
         )
         image_bucket.grant_read(transcribe_images_function)
-        video_transcripts_table.grant_write_data(transcribe_images_function)
+        image_bucket.grant_put(transcribe_images_function, "analysis-cache/*")
+        rate_limit_table.grant_read_write_data(transcribe_images_function)
+        # the analyses stored by a previous attempt are read back when a task is retried
+        video_transcripts_table.grant_read_write_data(transcribe_images_function)
         prompt_table.grant_read_data(transcribe_images_function)
         image_analysis_bedrock_policy = iam.PolicyStatement(
             effect = iam.Effect.ALLOW,
-            actions = ['bedrock:InvokeModel',],
+            actions = ['bedrock:InvokeModel', 'bedrock:InvokeModelWithResponseStream',],
             resources = [
                 bedrock.FoundationModel.from_foundation_model_id(self, "Claude3-Haiku", bedrock.FoundationModelIdentifier.ANTHROPIC_CLAUDE_3_HAIKU_20240307_V1_0).model_arn,
                 bedrock.FoundationModel.from_foundation_model_id(self, "Claude3-Sonnet", bedrock.FoundationModelIdentifier.ANTHROPIC_CLAUDE_3_SONNET_20240229_V1_0).model_arn,
@@ -186,18 +290,21 @@ class PAMVideoAnalysis(Stack):
                 "ANALYSIS_TABLE": video_transcripts_table.table_name,
                 "PROMPT_TABLE": prompt_table.table_name,
                 "AGGREGATE_MODEL_ID": "anthropic.claude-3-sonnet-20240229-v1:0",
+                "PROMPT_CACHE_TTL": "300",
+                "BEDROCK_STREAMING": "false",
+                "PARTIAL_WRITE_INTERVAL": "5",
                 "POWERTOOLS_SERVICE_NAME": "pam-video-analysis",
                 "POWERTOOLS_METRICS_NAMESPACE": "PAMVideoAnalysis",
                 "POWERTOOLS_LOGGER_LOG_EVENT": "true",
                 "POWERTOOLS_LOG_LEVEL": "DEBUG"
             },
-            layers=[boto3_lambda_layer, powertools_layer]
+            layers=[boto3_lambda_layer, powertools_layer, bedrock_converse_layer]
         )
         video_transcripts_table.grant_read_write_data(aggregate_segment_transcripts_function)
         prompt_table.grant_read_data(aggregate_segment_transcripts_function)
         aggregation_bedrock_policy = iam.PolicyStatement(
             effect = iam.Effect.ALLOW,
-            actions = ['bedrock:InvokeModel',],
+            actions = ['bedrock:InvokeModel', 'bedrock:InvokeModelWithResponseStream',],
             resources = [
                 bedrock.FoundationModel.from_foundation_model_id(self, "Claude3-Haiku", bedrock.FoundationModelIdentifier.ANTHROPIC_CLAUDE_3_HAIKU_20240307_V1_0).model_arn,
                 bedrock.FoundationModel.from_foundation_model_id(self, "Claude3-Sonnet", bedrock.FoundationModelIdentifier.ANTHROPIC_CLAUDE_3_SONNET_20240229_V1_0).model_arn,
@@ -207,43 +314,264 @@ class PAMVideoAnalysis(Stack):
         )
         aggregate_segment_transcripts_function.add_to_role_policy(aggregation_bedrock_policy)
 
+        # Batch inference mode ('analysismode' context set to 'batch'): the image batches are written as the records of a
+        #  single batch inference job instead of being sent to the model one by one, e.g. to reprocess an archive of videos
+        analysis_mode = self.node.try_get_context("analysismode")
+        if not analysis_mode:
+            analysis_mode = "ondemand"
+        if analysis_mode == "batch":
+            batch_environment = {
+                "IMAGE_BUCKET": image_bucket.bucket_name,
+                "ANALYSIS_TABLE": video_transcripts_table.table_name,
+                "PROMPT_TABLE": prompt_table.table_name,
+                "ANALYSIS_MODEL_ID": analysis_model_id,
+                "POWERTOOLS_SERVICE_NAME": "pam-video-analysis",
+                "POWERTOOLS_METRICS_NAMESPACE": "PAMVideoAnalysis",
+                "POWERTOOLS_LOGGER_LOG_EVENT": "true",
+                "POWERTOOLS_LOG_LEVEL": "DEBUG"
+            }
+            # service role of the batch inference jobs, reading the records and writing the results in the image bucket
+            batch_job_role = iam.Role(self, "Batch-Inference-Job-Role", assumed_by=iam.ServicePrincipal("bedrock.amazonaws.com"))
+            image_bucket.grant_read_write(batch_job_role, "batch-inference/*")
+            batch_job_role.add_to_policy(image_analysis_bedrock_policy)
+
+            # Define the Lambda function writing the records of the image batches
+            prepare_batch_record_function = lambda_.Function(
+                self, "Prepare-Batch-Record-Function",
+                code=lambda_.Code.from_asset("lambdas/transcribe_images"),
+                handler="prepare_batch_record.lambda_handler",
+                runtime=PYTHON_VERSION,
+                timeout=LAMBDA_TIMEOUT,
+                environment={**batch_environment, "IMAGE_FETCH_WORKERS": "10", "PROMPT_CACHE_TTL": "300"},
+                layers=[boto3_lambda_layer, powertools_layer, bedrock_converse_layer]
+            )
+            image_bucket.grant_read(prepare_batch_record_function)
+            image_bucket.grant_put(prepare_batch_record_function, "batch-inference/*")
+            prompt_table.grant_read_data(prepare_batch_record_function)
+
+            # Define the Lambda function submitting the batch inference job and checking on it
+            batch_inference_job_function = lambda_.Function(
+                self, "Batch-Inference-Job-Function",
+                code=lambda_.Code.from_asset("lambdas/transcribe_images"),
+                handler="batch_inference_job.lambda_handler",
+                runtime=PYTHON_VERSION,
+                timeout=LAMBDA_TIMEOUT,
+                # the records being packed into the input files and the slices of a local job are held in memory
+                memory_size=1024,
+                environment={**batch_environment, "BATCH_JOB_API": "bedrock", "BATCH_JOB_MIN_RECORDS": "100",
+                             "BATCH_JOB_ROLE_ARN": batch_job_role.role_arn, "BATCH_FILE_MAX_RECORDS": "10000",
+                             "BATCH_FILE_MAX_BYTES": "1000000000", "BATCH_JOB_LOCAL_WORKERS": "4"},
+                layers=[boto3_lambda_layer, powertools_layer]
+            )
+            image_bucket.grant_read_write(batch_inference_job_function, "batch-inference/*")
+            batch_inference_job_function.add_to_role_policy(iam.PolicyStatement(
+                effect = iam.Effect.ALLOW,
+                actions = ['bedrock:CreateModelInvocationJob', 'bedrock:GetModelInvocationJob',],
+                resources = ["*"]
+            ))
+            # jobs too small for batch inference are run by the function itself
+            batch_inference_job_function.add_to_role_policy(image_analysis_bedrock_policy)
+            batch_job_role.grant_pass_role(batch_inference_job_function)
+
+            # Define the Lambda function storing the results of the batch inference job
+            collect_batch_results_function = lambda_.Function(
+                self, "Collect-Batch-Results-Function",
+                code=lambda_.Code.from_asset("lambdas/transcribe_images"),
+                handler="collect_batch_results.lambda_handler",
+                runtime=PYTHON_VERSION,
+                timeout=LAMBDA_TIMEOUT,
+                environment=batch_environment,
+                layers=[boto3_lambda_layer, powertools_layer, bedrock_converse_layer]
+            )
+            image_bucket.grant_read(collect_batch_results_function, "batch-inference/*")
+            video_transcripts_table.grant_write_data(collect_batch_results_function)
+
         ######################################################
         # Define the StepFunctions steps and workflow
         ######################################################
-        # initial video image extraction task
+        # initial planning task splitting the video into chunks
+        plan_extraction_task = tasks.LambdaInvoke(
+            self, "PlanExtractionTask",
+            lambda_function=plan_extraction_function,
+            payload=sfn.TaskInput.from_object({"Input.$": "$$"}),
+            result_path="$.plantaskresult",
+        )
+
+        # video image extraction task, run for every chunk of the video
         create_still_frame_images_task = tasks.LambdaInvoke(
             self, "CreateStillFrameImagesTask",
             lambda_function=create_still_frame_images_function,
-            payload=sfn.TaskInput.from_object({"Input.$": "$$"}),
+            payload=sfn.TaskInput.from_object({"Input.$": "$$", "chunk.$": "$.chunk"}),
             result_path="$.videotaskresult",
             # output_path="$.image_batches",
         )
-
-        # then the distributed Map to loop through all extracted images
-        transcribe_images_task = sfn.Map(
-            self, "ImageBatchMap",
-            max_concurrency=20,
-            items_path="$.videotaskresult.Payload.image_batches",
-            result_path="$.distributedmapresult",
-            # output_path="$.analyses_path",
+        # the extraction resumes from its last checkpoint when the function times out or is throttled
+        create_still_frame_images_task.add_retry(
+            errors=["Sandbox.Timedout", "Lambda.TooManyRequestsException"],
+            interval=Duration.seconds(5),
+            max_attempts=3,
+            backoff_rate=2,
         )
-        transcribe_images_task.item_processor(
-            processor=tasks.LambdaInvoke(
+
+        if analysis_mode == "batch":
+            # in batch inference mode, the Map writes the records of the batch inference job instead,
+            #  the chunk's output being the IDs of the records written for its image batches
+            transcribe_images_task = sfn.Map(
+                self, "BatchRecordMap",
+                max_concurrency=20,
+                items_path="$.videotaskresult.Payload.image_batches",
+                item_selector={"batch.$": "$$.Map.Item.Value", "execution_name.$": "$$.Execution.Name"},
+                result_selector={"records.$": "$[*].Payload.record_id"},
+                result_path="$.chunkresult",
+                output_path="$.chunkresult.records",
+            )
+            transcribe_images_task.item_processor(processor=tasks.LambdaInvoke(
+                self, "PrepareBatchRecordTask",
+                lambda_function=prepare_batch_record_function,
+            ))
+        else:
+            # then the distributed Map to loop through all images extracted from the chunk,
+            #  the chunk's output being the list of the analyses of its image batches
+            # each iteration analyses 'batchesperworker' image batches at once (the function's WORKER_CONCURRENCY at a
+            #  time), cutting the number of invocations and state transitions; the chunk's output is then one list of
+            #  analyses per iteration, and fewer iterations run at a time to keep the same number of batches in flight
+            batches_per_worker = self.node.try_get_context("batchesperworker")
+            if not batches_per_worker:
+                batches_per_worker = 5
+            batches_per_worker = int(batches_per_worker)
+            if batches_per_worker > 1:
+                transcribe_images_task = sfn.Map(
+                    self, "ImageBatchMap",
+                    max_concurrency=max(20 // batches_per_worker, 1),
+                    items_path="$.workerbatches.groups",
+                    item_selector={"batches.$": "$$.Map.Item.Value"},
+                    result_selector={"analyses.$": "$[*].Payload.analyses"},
+                    result_path="$.chunkresult",
+                    output_path="$.chunkresult.analyses",
+                )
+            else:
+                transcribe_images_task = sfn.Map(
+                    self, "ImageBatchMap",
+                    max_concurrency=20,
+                    items_path="$.videotaskresult.Payload.image_batches",
+                    result_selector={"analyses.$": "$[*].Payload.analysis"},
+                    result_path="$.chunkresult",
+                    output_path="$.chunkresult.analyses",
+                )
+            transcribe_images_invoke = tasks.LambdaInvoke(
                 self, "TranscribeImagesTask",
                 lambda_function=transcribe_images_function,
+                # on a retry, the batches of the group analysed by the previous attempts are kept rather than analysed again
+                payload=sfn.TaskInput.from_object({"batches.$": "$.batches", "retry_count.$": "$$.State.RetryCount"}) if batches_per_worker > 1 else None,
             )
-        )
+            # Bedrock kept throttling the requests (or failing) after the function's own retries, try again later
+            transcribe_images_invoke.add_retry(
+                errors=["BedrockUnavailableError"],
+                interval=Duration.seconds(30),
+                max_attempts=3,
+                backoff_rate=2,
+            )
+            transcribe_images_task.item_processor(processor=transcribe_images_invoke)
         
         # eventually the aggregation task at the end
         aggregate_segment_transcript_task = tasks.LambdaInvoke(
             self, "AggregateSegmentTranscriptTask",
             lambda_function=aggregate_segment_transcripts_function,
-            input_path="$.distributedmapresult[*].Payload.analysis",
+            input_path="$.distributedmapresult",
             result_path="$.final_analysis",
         )
+        aggregate_segment_transcript_task.add_retry(
+            errors=["BedrockUnavailableError"],
+            interval=Duration.seconds(30),
+            max_attempts=3,
+            backoff_rate=2,
+        )
 
        # Build up the process chain
-        chain = create_still_frame_images_task.next(transcribe_images_task).next(aggregate_segment_transcript_task)
+        #  the extraction task is invoked again, resuming from its checkpoint, until the whole chunk is processed
+        extraction_done_choice = sfn.Choice(self, "ExtractionDoneChoice")
+        extraction_done_choice.when(
+            sfn.Condition.string_equals("$.videotaskresult.Payload.status", "IN_PROGRESS"),
+            create_still_frame_images_task,
+        )
+        if analysis_mode != "batch" and batches_per_worker > 1:
+            # split the chunk's image batches into the groups given to the transcription workers
+            extraction_done_choice.otherwise(sfn.Pass(
+                self, "GroupImageBatchesPass",
+                parameters={"groups.$": f"States.ArrayPartition($.videotaskresult.Payload.image_batches, {batches_per_worker})"},
+                result_path="$.workerbatches",
+            ).next(transcribe_images_task))
+        else:
+            extraction_done_choice.otherwise(transcribe_images_task)
+
+        # the chunks are extracted and analysed in parallel, each chunk's images being analysed as soon as it is extracted
+        extraction_concurrency = self.node.try_get_context("extractionconcurrency")
+        if not extraction_concurrency:
+            extraction_concurrency = 5
+        extraction_chunk_map = sfn.Map(
+            self, "ExtractionChunkMap",
+            max_concurrency=int(extraction_concurrency),
+            items_path="$.plantaskresult.Payload.chunks",
+            item_selector={"chunk.$": "$$.Map.Item.Value"},
+            result_path="$.distributedmapresult",
+        )
+        extraction_chunk_map.item_processor(
+            processor=create_still_frame_images_task.next(extraction_done_choice)
+        )
+        if analysis_mode == "batch":
+            # once every chunk is extracted, the records are submitted as one batch inference job, checked on until it
+            #  is done, and its results are collected in place of the analyses of the chunks
+            submit_batch_job_task = tasks.LambdaInvoke(
+                self, "SubmitBatchJobTask",
+                lambda_function=batch_inference_job_function,
+                payload=sfn.TaskInput.from_object({"execution_name.$": "$$.Execution.Name"}),
+                result_selector={"job.$": "$.Payload"},
+                result_path="$.batchjob",
+            )
+            check_batch_job_task = tasks.LambdaInvoke(
+                self, "CheckBatchJobTask",
+                lambda_function=batch_inference_job_function,
+                payload=sfn.TaskInput.from_object({"job.$": "$.batchjob.job"}),
+                result_selector={"job.$": "$.Payload"},
+                result_path="$.batchjob",
+            )
+            collect_batch_results_task = tasks.LambdaInvoke(
+                self, "CollectBatchResultsTask",
+                lambda_function=collect_batch_results_function,
+                payload=sfn.TaskInput.from_object({"execution_name.$": "$$.Execution.Name"}),
+                # the state becomes the analyses, where the aggregation expects them
+                result_selector={"distributedmapresult.$": "$.Payload.analyses"},
+                result_path="$",
+            )
+            batch_job_poll_interval = self.node.try_get_context("batchjobpollinterval")
+            if not batch_job_poll_interval:
+                batch_job_poll_interval = 300
+            batch_job_wait = sfn.Wait(self, "BatchJobWait", time=sfn.WaitTime.duration(Duration.seconds(int(batch_job_poll_interval))))
+            batch_job_done_choice = sfn.Choice(self, "BatchJobDoneChoice")
+            # a local job is run by the invocations checking on it, the next one carries on right away
+            batch_job_done_choice.when(
+                sfn.Condition.and_(
+                    sfn.Condition.boolean_equals("$.batchjob.job.done", False),
+                    sfn.Condition.boolean_equals("$.batchjob.job.local", True),
+                ),
+                check_batch_job_task,
+            )
+            batch_job_done_choice.when(
+                sfn.Condition.boolean_equals("$.batchjob.job.done", False),
+                batch_job_wait.next(check_batch_job_task),
+            )
+            batch_job_done_choice.when(
+                sfn.Condition.or_(
+                    sfn.Condition.string_equals("$.batchjob.job.status", "Completed"),
+                    sfn.Condition.string_equals("$.batchjob.job.status", "PartiallyCompleted"),
+                ),
+                collect_batch_results_task.next(aggregate_segment_transcript_task),
+            )
+            batch_job_done_choice.otherwise(sfn.Fail(self, "BatchJobFailed", cause="The batch inference job failed"))
+            check_batch_job_task.next(batch_job_done_choice)
+            chain = plan_extraction_task.next(extraction_chunk_map).next(submit_batch_job_task).next(batch_job_done_choice)
+        else:
+            chain = plan_extraction_task.next(extraction_chunk_map).next(aggregate_segment_transcript_task)
         
         # Define the Step Functions state machine
         state_machine = sfn.StateMachine(
@@ -310,6 +638,23 @@ class PAMVideoAnalysis(Stack):
         )
         return my_layer
 
+    def __create_layer_from_dir(self, layer_name, description: str, version: str) -> lambda_.LayerVersion:
+        # the modules are committed in the layer directory, under 'python/' as Lambda expects them
+        layer_dir = f"lambdas/layers/{layer_name}-layer"
+
+        layer_id = f"{layer_name}-lambda-layer"  # 👈🏽 a unique id for the layer
+        layer_code = lambda_.Code.from_asset(layer_dir, exclude=["**/__pycache__"])  # 👈🏽 import the modules
+
+        my_layer = lambda_.LayerVersion(
+            self,
+            layer_id,
+            code=layer_code,
+            compatible_runtimes=[PYTHON_VERSION],
+            description=description,
+            layer_version_name=f"{layer_name}-layer-{version}"
+        )
+        return my_layer
+
     def __create_layer_from_shell(self, layer_name, description: str, version: str) -> lambda_.LayerVersion:
         # requirements_file = f"lambdas/layers/{layer_name}-layer/requirements.txt"  
         # default to shell script for Mac/Linux users
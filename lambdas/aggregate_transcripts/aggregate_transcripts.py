@@ -39,6 +39,9 @@ def lambda_handler(event, context):
         }
     ]
     '''
+    # when the video is extracted in chunks, the analyses come as one list per chunk, in order, and as one list per
+    #  transcription worker within a chunk when the workers are given several batches each
+    event = list(_flatten_analyses(event))
     video_id = event[0]["video_id"]
     video_s3_uri = event[0]["video_s3_uri"]
     video_url = event[0]["video_url"]
@@ -55,9 +58,14 @@ def lambda_handler(event, context):
     '''    
     model_id = os.environ["AGGREGATE_MODEL_ID"]
     # pass the history to Bedrock and get a summary out of it 
-    full_analysis, prompt_version = ai_lib.summarize_analysis(model_id, history, max_tokens = 4096, temperature = 0, top_p = 0, top_k = 250)
+    # with BEDROCK_STREAMING, the partial summary is written to DynamoDB as it comes
+    #  'call_stats' receiving the tokens, latency, bytes and estimated cost of the call
+    call_stats = {}
+    full_analysis, prompt_version = ai_lib.summarize_analysis(model_id, history, max_tokens = 4096, temperature = 0, top_p = 0, top_k = 250,
+        call_stats=call_stats, on_partial=lambda partial_analysis, partial_prompt_version: ai_lib.store_full_analysis(video_id, video_s3_uri, video_url, partial_analysis,
+                                                                                             partial_prompt_version, partial=True))
     # store the full analysis in DynamoDB
-    ai_lib.store_full_analysis(video_id, video_s3_uri, video_url, full_analysis, prompt_version)
+    ai_lib.store_full_analysis(video_id, video_s3_uri, video_url, full_analysis, prompt_version, call_stats=call_stats)
 
     if full_analysis.startswith("Empty summary"):
         logger.info(f"Analysis for video with ID '{video_id}' could not be completed, check logs for errors")
@@ -72,4 +80,13 @@ def lambda_handler(event, context):
         "status": "OK",
         "message": "Analyses aggregated!",
         "aggregate analysis": full_analysis
-    }
\ No newline at end of file
+    }
+
+
+# The analyses of the (possibly nested) lists of analyses, in order
+def _flatten_analyses(analyses: list):
+    for analysis in analyses:
+        if isinstance(analysis, list):
+            yield from _flatten_analyses(analysis)
+        else:
+            yield analysis
@@ -6,8 +6,9 @@ from botocore.config import Config
 import traceback
 import re
 import datetime
-from typing import List
+from typing import Callable, List
 from aws_lambda_powertools import Logger
+import bedrock_converse # type: ignore
 from aws_lambda_powertools.logging import correlation_paths
 
 from boto3.dynamodb.types import TypeDeserializer
@@ -18,7 +19,8 @@ logger.debug(json.dumps(dict(os.environ), indent=4))
 region = os.environ['AWS_REGION']
 
 config = Config(read_timeout=1000, region_name=region)
-bedrock_runtime = boto3.client("bedrock-runtime", config=config)
+# Bedrock requests are retried by bedrock_converse.converse_with_retries rather than by the client
+bedrock_runtime = boto3.client("bedrock-runtime", config=config.merge(Config(retries={"mode": "standard", "max_attempts": 1})))
 ddb = boto3.client("dynamodb", config=config)
 analysis_table = os.environ["ANALYSIS_TABLE"]
 prompt_table = os.environ["PROMPT_TABLE"]
@@ -29,22 +31,7 @@ date_timestamp = (datetime.datetime.now()).strftime("%Y-%m-%d_%H:%M:%S")
 def build_prompt() -> tuple[str, str] | None:
     logger.debug(f"###### Retrieving aggregate prompt from DynamoDB table '{prompt_table}' ######")
     try:
-        version_zero = ddb.get_item(
-            TableName=prompt_table,
-            Key={
-                "PromptID": {"S": "aggregate-prompt"},
-                "VersionID": {"S": "v0"}
-            }
-        )
-        latest_version = "v" + version_zero["Item"]["Latest"]["N"]
-        results = ddb.get_item(
-            TableName=prompt_table,
-            Key={
-                "PromptID": {"S": "aggregate-prompt"},
-                "VersionID": {"S": latest_version}
-            }
-        )
-        prompt_item = results["Item"]
+        latest_version, prompt_item = bedrock_converse.load_prompt_item(ddb, prompt_table, "aggregate-prompt")
 
         ##### Prompt element 1: Task context
         # Give Claude context about the role it should take on or what goals and overarching tasks you want it to undertake with the prompt.
@@ -122,7 +109,7 @@ def build_prompt() -> tuple[str, str] | None:
         if PREFILL:
             prompt += f"""\n\n{PREFILL}"""
 
-        prompt_version = f"aggregate-v{version_zero["Item"]["Latest"]["N"]}"
+        prompt_version = f"aggregate-v{latest_version}"
         return prompt, prompt_version
     
     except Exception as e:
@@ -139,6 +126,8 @@ def summarize_analysis(
     temperature: float = 0,
     top_p: float = 0.999,
     top_k: int = 250,
+    on_partial: Callable[[str, str], None] | None = None,
+    call_stats: dict | None = None,
 ) -> tuple[str, str] | None:
     logger.debug("###### Sending to Bedrock ######")
     prompt_version = ""
@@ -165,18 +154,26 @@ def summarize_analysis(
         logger.debug(f"system prompts={json.dumps(system_prompts[0])}")
         logger.debug(f"prompt version='{prompt_version}'")
         
-        # Send the message.
-        resp = bedrock_runtime.converse(
+        # Send the message, 'on_partial' (if any) receiving the partial summary along with the prompt version
+        resp = bedrock_converse.converse_with_retries(
+            bedrock_runtime,
+            ddb,
+            on_partial=(lambda partial_summary: on_partial(partial_summary, prompt_version)) if on_partial else None,
             modelId=model_id,
             messages=messages,
             system=system_prompts,
             inferenceConfig=inference_config,
             additionalModelRequestFields=additional_model_fields,
         )
+        # report the usage of the call, 'call_stats' (if any) receiving it for the transcript item
+        payload_bytes = len(prompt.encode("utf-8")) + sum(len(hist.encode("utf-8")) for hist in analysis_history)
+        bedrock_converse.record_call_usage(resp, model_id, prompt_version, 0, payload_bytes, call_stats)
         result = resp["output"]["message"]
         logger.debug(f"Bedrock's response={result}")
         return result["content"][0]["text"], prompt_version
     
+    except bedrock_converse.BedrockUnavailableError:
+        raise
     except Exception as e:
         logger.error(f"Error calling Bedrock's Converse API: {e}")
         logger.error(traceback.format_exc())
@@ -259,7 +256,10 @@ def load_analysis_history(video_id: str) -> List[str] | None:
         return None
 
 
-def store_full_analysis(video_id: str, video_s3_uri: str, video_url: str, analysis: str, prompt_version: str) -> None:
+# Store the full analysis of the video, 'partial' marking an analysis still being streamed (replaced by the final one)
+#  'call_stats' (if any) is the usage of the call made for it
+def store_full_analysis(video_id: str, video_s3_uri: str, video_url: str, analysis: str, prompt_version: str, partial: bool = False,
+                        call_stats: dict | None = None) -> None:
     logger.debug("###### Storing full analysis in DynamoDB ######")
     try:
         ddb.put_item(
@@ -270,7 +270,9 @@ def store_full_analysis(video_id: str, video_s3_uri: str, video_url: str, analys
                 "Analysis": {"S": analysis},
                 "VideoS3URI": {"S": video_s3_uri},
                 "VideoURL": {"S": video_url},
-                "Created": {"S": date_timestamp}
+                "Created": {"S": date_timestamp},
+                **bedrock_converse.usage_attributes(call_stats),
+                **({"Partial": {"BOOL": True}} if partial else {})
             })
     
     except Exception as e:
@@ -279,3 +281,4 @@ def store_full_analysis(video_id: str, video_s3_uri: str, video_url: str, analys
         
     finally:
         return None
+
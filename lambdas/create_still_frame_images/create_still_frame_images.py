@@ -1,18 +1,29 @@
-import os, subprocess
-import shutil, shlex
+import os
+import shutil
+import time
 import boto3, botocore
 from aws_lambda_powertools import Logger, Metrics
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.metrics import MetricUnit
 from aws_lambda_powertools.utilities.typing import LambdaContext
 from aws_lambda_powertools.utilities.data_classes import S3Event
+from lib import batch_planner, extraction_checkpoint, frame_cropping, frame_dedup, frame_extraction, frame_manifest, frame_tiling, frame_upload # type: ignore
 
 logger = Logger()
 metrics = Metrics()
 
-# Create an S3 client
+# Create an S3 client, sized for concurrent uploads of the still frame images
+#  UPLOAD_MAX_WORKERS: number of threads uploading still frame images in parallel
+#  UPLOAD_MAX_POOL_CONNECTIONS: size of the S3 client's connection pool (defaults to the number of threads)
+#  UPLOAD_MAX_ATTEMPTS: attempts per upload before giving up, transient errors being retried with backoff
 aws_region = os.environ['AWS_REGION']
-s3_client = boto3.client('s3', region_name=aws_region)
+upload_max_workers = int(os.environ.get("UPLOAD_MAX_WORKERS", "16"))
+upload_max_pool_connections = int(os.environ.get("UPLOAD_MAX_POOL_CONNECTIONS", str(upload_max_workers)))
+upload_max_attempts = int(os.environ.get("UPLOAD_MAX_ATTEMPTS", "5"))
+s3_client = boto3.client('s3', config=frame_upload.s3_client_config(aws_region, upload_max_pool_connections, upload_max_attempts))
+
+# Validity of the presigned URL FFmpeg reads the video from, in seconds (VIDEO_INPUT_MODE='url')
+presigned_url_expiration = int(os.environ.get("PRESIGNED_URL_EXPIRATION", "3600"))
 
 @logger.inject_lambda_context
 @metrics.log_metrics
@@ -73,17 +84,122 @@ def lambda_handler(event: S3Event, context: LambdaContext):
     logger.info(f"Starting processing of video file '{video_s3_uri}' => VideoID='{video_id}'")
     
     # Extract still frame images from the video
-    # Use FFmpeg to create a PNG file for every second of the video
+    # Use FFmpeg to create an image file for every second of the video
+    # FRAME_EXTRACTION_MODE:
+    #  'staged' (default): FFmpeg writes all the frames in /tmp first, they are uploaded afterwards
+    #  'stream': FFmpeg pipes the frames out, each frame is uploaded while decoding continues
+    #  'parallel': time ranges of the video are decoded by concurrent FFmpeg processes, see
+    #   FRAME_EXTRACTION_WORKERS (defaults to the number of CPU cores) and FRAME_SEGMENT_DURATION (in seconds)
+    extraction_mode = os.environ.get("FRAME_EXTRACTION_MODE", "staged")
+    extraction_workers = int(os.environ.get("FRAME_EXTRACTION_WORKERS", "0"))
+    segment_duration = int(os.environ.get("FRAME_SEGMENT_DURATION", "0"))
+    # Checkpointed extraction, for videos taking longer than the Lambda timeout to process
+    #  CHECKPOINT_INTERVAL: the video is processed in time ranges of that many seconds, the progress being saved
+    #   to S3 after each of them, 0 (default) processes the video in a single pass without checkpoints
+    #  CHECKPOINT_SAFETY_MARGIN: seconds of Lambda execution time kept in reserve, the function returning with an
+    #   'IN_PROGRESS' status, for the state machine to invoke it again, when the next range may not fit in the time left
+    checkpoint_interval = int(os.environ.get("CHECKPOINT_INTERVAL", "0"))
+    checkpoint_safety_margin = int(os.environ.get("CHECKPOINT_SAFETY_MARGIN", "30"))
+    # FRAME_DECODE_MODE: how FFmpeg decodes the video to sample one frame per second
+    #  'full' (default): every frame of the video is decoded
+    #  'keyframes': only keyframes are decoded, for videos whose keyframes are about one second apart
+    #  'seek': FFmpeg seeks to every sample point, decoding from the keyframe before it (FRAME_EXTRACTION_WORKERS
+    #   seeks at a time), for videos with frequent keyframes and a high frame rate
+    #  'auto': the cheapest of these given the frame rate and keyframe interval probed by ffprobe
+    decode_mode = os.environ.get("FRAME_DECODE_MODE", "full")
+    if decode_mode not in frame_extraction.DECODE_MODES + ("auto",):
+        raise ValueError(f"Unsupported frame decode mode '{decode_mode}'")
+    # Chunk of the video to extract, as planned by plan_extraction ({"index": 1, "start": 600, "duration": 600}),
+    #  the whole video when there is none
+    chunk = event.get("chunk")
+    # VIDEO_INPUT_MODE:
+    #  'download' (default): the video is downloaded to /tmp before FFmpeg starts, its size is capped by the ephemeral storage
+    #  'url': FFmpeg reads the video from a presigned URL, seeking with HTTP range requests
+    #  'pipe': the video is streamed from S3 into FFmpeg's standard input, which only works for videos that
+    #   can be decoded without seeking (e.g. MP4 files with the 'moov' atom first, see FFmpeg's '-movflags +faststart')
+    video_input_mode = os.environ.get("VIDEO_INPUT_MODE", "download")
+    if video_input_mode == "pipe" and (extraction_mode == "parallel" or checkpoint_interval or chunk or decode_mode in ("seek", "auto")):
+        logger.warning("The 'parallel' extraction mode, checkpoints, chunks and the 'seek' and 'auto' decode modes read the video more than once, "
+                       "reading it from a presigned URL rather than a pipe")
+        video_input_mode = "url"
     local_video_path = '/tmp/video.mp4'
-    # Download the video file from the source S3 bucket
-    s3_client.download_file(video_bucket, video_object_key, local_video_path)        
+    video_stream = None
+    if video_input_mode == "url":
+        video_path = s3_client.generate_presigned_url("get_object", Params={"Bucket": video_bucket, "Key": video_object_key}, ExpiresIn=presigned_url_expiration)
+    elif video_input_mode == "pipe":
+        video_path = "pipe:0"
+        video_stream = s3_client.get_object(Bucket=video_bucket, Key=video_object_key)["Body"]
+    else:
+        # Download the video file from the source S3 bucket
+        s3_client.download_file(video_bucket, video_object_key, local_video_path)
+        video_path = local_video_path
+    # FRAME_SAMPLING_MODE:
+    #  'fixed' (default): one frame per second
+    #  'scene': frames are sampled on scene changes (FFmpeg's scene score above FRAME_SCENE_THRESHOLD, between 0 and 1),
+    #   at most one every FRAME_MIN_INTERVAL seconds and at least one every FRAME_MAX_INTERVAL seconds, so that
+    #   periods of activity get dense frames and idle periods sparse ones
+    scene_sampling = None
+    if os.environ.get("FRAME_SAMPLING_MODE", "fixed") == "scene":
+        scene_sampling = frame_extraction.SceneSampling(
+            threshold=float(os.environ.get("FRAME_SCENE_THRESHOLD", "0.01")),
+            min_interval=float(os.environ.get("FRAME_MIN_INTERVAL", "0.5")),
+            max_interval=float(os.environ.get("FRAME_MAX_INTERVAL", "10")),
+        )
+    if decode_mode == "auto":
+        stream_info = frame_extraction.probe_video_stream(video_path)
+        decode_mode = frame_extraction.choose_decode_mode(stream_info, scene_sampling)
+        logger.info(f"Decoding the video in '{decode_mode}' mode: {stream_info.codec} at {stream_info.frame_rate:.2f} fps, "
+                    f"a keyframe every {stream_info.keyframe_interval:.2f}s")
+    elif decode_mode == "seek" and scene_sampling:
+        logger.warning("The scene change sampling needs every frame of the video, decoding them all rather than seeking")
+        decode_mode = "full"
+    metrics.add_metadata(key="decode_mode", value=decode_mode)
+    # Near-duplicate frames elimination, disabled when the threshold is 0
+    #  FRAME_DEDUP_THRESHOLD: share of (thumbnail) pixels that must change for a frame to be kept
+    #  FRAME_DEDUP_PIXEL_DELTA: gray level difference above which a pixel is considered changed
+    #  FRAME_DEDUP_MAX_GAP: maximum number of consecutive frames that can be dropped
+    dedup_threshold = float(os.environ.get("FRAME_DEDUP_THRESHOLD", "0"))
+    dedup_pixel_delta = int(os.environ.get("FRAME_DEDUP_PIXEL_DELTA", "16"))
+    dedup_max_gap = int(os.environ.get("FRAME_DEDUP_MAX_GAP", "0"))
+    # Encoding of the still frame images
+    #  FRAME_FORMAT: 'png' (default, lossless), 'jpeg' or 'webp'
+    #  FRAME_QUALITY: from 1 to 100, for JPEG and WebP images
+    #  FRAME_MAX_EDGE: maximum width/height of the images in pixels, 0 (default) keeps the video's resolution
+    frame_encoding = frame_extraction.FrameEncoding(
+        format=os.environ.get("FRAME_FORMAT", "png").lower(),
+        quality=int(os.environ.get("FRAME_QUALITY", "85")),
+        max_edge=int(os.environ.get("FRAME_MAX_EDGE", "0")),
+    )
+    if frame_encoding.format not in frame_extraction.IMAGE_EXTENSIONS:
+        raise ValueError(f"Unsupported still frame image format '{frame_encoding.format}'")
+    # Tiling of consecutive frames into a single image, so that each request to the model covers more of the video
+    #  FRAME_TILE_GRID: '<columns>x<rows>' frames per image, '1x1' (default) disables tiling
+    #  FRAME_TILE_FONT: font file to label each frame with its timestamp, frames are not labelled without it
+    tile_grid = frame_tiling.TileGrid.parse(os.environ.get("FRAME_TILE_GRID", "1x1"))
+    tile_font_path = os.environ.get("FRAME_TILE_FONT") or None
+    extraction_encoding = tile_grid.cell_encoding(frame_encoding) if tile_grid.cells > 1 else frame_encoding
+    # Cropping of the region that changed since the previous frame, which is sent to the model instead of the
+    #  whole frame (except for the first frame of a batch)
+    #  FRAME_CROP_CHANGES: 'true' to enable, not compatible with tiling
+    #  FRAME_CROP_MAX_AREA: largest share of the frame a region can cover to be cropped
+    #  FRAME_CROP_MARGIN: pixels of context kept around the changed region
+    #  FRAME_CROP_WORKERS: number of FFmpeg processes cropping images in parallel
+    crop_changes = os.environ.get("FRAME_CROP_CHANGES", "false").lower() == "true"
+    if crop_changes and tile_grid.cells > 1:
+        logger.warning("Changed regions are not cropped out of tiled frames")
+        crop_changes = False
+    crop_max_area = float(os.environ.get("FRAME_CROP_MAX_AREA", "0.5"))
+    crop_margin = int(os.environ.get("FRAME_CROP_MARGIN", "16"))
+    crop_workers = int(os.environ.get("FRAME_CROP_WORKERS", "4"))
+    # Idle batches, where the screen doesn't change, are described without calling the model
+    #  IDLE_THRESHOLD: largest share of (thumbnail) pixels that can change between two frames of an idle batch, 0 (default) disables it
+    idle_threshold = float(os.environ.get("IDLE_THRESHOLD", "0"))
+    # Thumbnails are what frames are compared on
+    with_thumbnails = dedup_threshold > 0 or crop_changes or idle_threshold > 0
+
     tmp_image_dir = '/tmp/images'
-    if not os.path.exists(tmp_image_dir):
-        os.makedirs(tmp_image_dir)
-    ffmpeg_cmd = f'ffmpeg -i {shlex.quote(local_video_path)} -vf fps=1 {shlex.quote(f"{tmp_image_dir}/%05d.png")}'
-    logger.debug(f"Executing the following ffmpeg command: {ffmpeg_cmd}")
-    # subprocess.run(shlex.split(ffmpeg_cmd), check=True)
-    subprocess.check_call(shlex.split(ffmpeg_cmd))
+    tmp_thumbnail_path = '/tmp/thumbnails.gray'
+    tmp_tile_dir = '/tmp/tiles'
 
     # Upload the still frame images to the destination S3 bucket
     # 'image_path' and 'image_list' are expected to look like this
@@ -97,31 +213,149 @@ def lambda_handler(event: S3Event, context: LambdaContext):
         "0041.png"
     ]
     '''
-    image_list = []
-    image_path = video_object_key
-    for filename in sorted(os.listdir(tmp_image_dir)): # force alphabetical order to have images in the right sequential order
-        image_list.append(filename)
-        local_image_path = os.path.join(tmp_image_dir, filename)
-        image_key = f'{image_path}/{filename}'
-        s3_client.upload_file(local_image_path, image_bucket, image_key)
+    # With the fixed rate sampling, frames keep the file name FFmpeg gave them (their rank at 1 frame per second)
+    #  even when near-duplicates are dropped, so the timestamp of frame 'NNNNN.png' is NNNNN-1 seconds.
+    #  In any case, the timestamp of every frame is recorded in the frame manifest
+    #  With tiling, each image is named after its first frame and the manifest lists the timestamps of all its frames
+    # Uploads run in parallel and in the background so that decoding goes on in the meantime
+    # the images of each chunk go under their own prefix, along with the chunk's manifest and checkpoint
+    image_path = f"{video_object_key}/chunk-{chunk['index']:05d}" if chunk else video_object_key
+    range_start = chunk["start"] if chunk else 0
+    range_end = chunk["start"] + chunk["duration"] if chunk else None
+    manifest_key = f"{image_path}/{frame_manifest.MANIFEST_FILENAME}"
+    checkpoint_key = f"{image_path}/{extraction_checkpoint.CHECKPOINT_FILENAME}"
+    execution_id = event["Input"]["Execution"].get("Id", video_object_key)
+    uploaded_frames = []
+    if checkpoint_interval:
+        checkpoint = extraction_checkpoint.load_checkpoint(s3_client, image_bucket, checkpoint_key, execution_id, range_start)
+        if checkpoint.next_start > range_start:
+            # frames uploaded by the previous invocations, up to the checkpoint (the manifest is saved first)
+            uploaded_frames = [frame for frame in frame_manifest.read_manifest(s3_client, image_bucket, manifest_key)
+                               if frame.timestamp < checkpoint.next_start]
+        video_duration = range_end if range_end is not None else frame_extraction.probe_duration(video_path)
+    else:
+        checkpoint = extraction_checkpoint.Checkpoint(execution_id, range_start)
+    range_seconds = 0
+    while not checkpoint.done:
+        # stop while there is still time to save the progress, the state machine invoking the function again
+        if checkpoint_interval and range_seconds and \
+            context.get_remaining_time_in_millis() / 1000 < 1.5 * range_seconds + checkpoint_safety_margin:
+            logger.info(f"Pausing the extraction at {checkpoint.next_start}s of {video_duration:.0f}s, not enough time left for another {checkpoint_interval}s")
+            _clean_up_temporary_files(local_video_path, tmp_image_dir, tmp_thumbnail_path, tmp_tile_dir)
+            return {
+                "status": "IN_PROGRESS",
+                "message": f"Extracted frames up to {checkpoint.next_start}s of the video",
+            }
+        range_started = time.monotonic()
+        start = checkpoint.next_start
+        duration = checkpoint_interval or None
+        if range_end is not None:
+            duration = min(duration, range_end - start) if duration else range_end - start
+        # scene change sampled frames are numbered in sequence within the chunk, as the chunks are extracted in parallel
+        first_number = checkpoint.last_number if scene_sampling else round(start * frame_extraction.FPS)
+        if not os.path.exists(tmp_image_dir):
+            os.makedirs(tmp_image_dir)
+        keyframes_only = decode_mode == "keyframes"
+        if decode_mode == "seek":
+            frames = frame_extraction.seek_frames(video_path, with_thumbnails, extraction_encoding, start, duration, first_number, extraction_workers)
+        elif extraction_mode == "stream":
+            frames = frame_extraction.stream_frames(video_path, with_thumbnails, video_stream, scene_sampling, extraction_encoding,
+                                                    start, duration, first_number, keyframes_only)
+        elif extraction_mode == "parallel":
+            frames = frame_extraction.extract_frames_in_parallel(video_path, tmp_image_dir, with_thumbnails, extraction_workers, segment_duration,
+                                                                 scene_sampling, extraction_encoding, start, duration, first_number,
+                                                                 keyframes_only)
+        else:
+            frames = frame_extraction.extract_frames(video_path, tmp_image_dir, tmp_thumbnail_path if with_thumbnails else None, video_stream,
+                                                     scene_sampling, extraction_encoding, start, duration, first_number, keyframes_only)
+        frames = checkpoint.track_extracted(frames)
+        dedup_stats = {}
+        if dedup_threshold > 0:
+            frames = frame_dedup.drop_near_duplicates(frames, dedup_threshold, dedup_pixel_delta, dedup_max_gap, dedup_stats,
+                                                      checkpoint.last_kept_frame())
+        previous_frame = checkpoint.last_kept_frame()
+        frames = checkpoint.track_kept(frames)
+        if idle_threshold > 0:
+            frames = frame_dedup.measure_changes(frames, dedup_pixel_delta, previous_frame)
+        if tile_grid.cells > 1:
+            frames = frame_tiling.tile_frames(frames, tile_grid, frame_encoding, tmp_tile_dir, tile_font_path)
+        if crop_changes:
+            frames = frame_cropping.crop_changed_regions(frames, frame_encoding, dedup_pixel_delta, crop_max_area, crop_margin, crop_workers,
+                                                         previous_frame)
+        if with_thumbnails:
+            # the uploaded frames are kept until the end, without their thumbnails (the checkpoint keeps the last kept one)
+            frames = frame_dedup.release_thumbnails(frames)
+        uploaded_frames += frame_upload.upload_frames(s3_client, frames, image_bucket, image_path, upload_max_workers)
+        checkpoint.extracted += dedup_stats.get("extracted", 0)
+        checkpoint.dropped += dedup_stats.get("dropped", 0)
+        if checkpoint_interval:
+            checkpoint.next_start = start + checkpoint_interval
+            checkpoint.done = checkpoint.next_start >= video_duration
+            frame_manifest.write_manifest(s3_client, uploaded_frames, image_bucket, manifest_key)
+            extraction_checkpoint.save_checkpoint(s3_client, checkpoint, image_bucket, checkpoint_key)
+        else:
+            checkpoint.done = True
+        range_seconds = time.monotonic() - range_started
+    image_list = [frame.filename for frame in uploaded_frames]
+    if dedup_threshold > 0:
+        logger.info(f"Dropped {checkpoint.dropped} near-duplicate frames out of {checkpoint.extracted}")
+        metrics.add_metric(name="DroppedDuplicateFrames", unit=MetricUnit.Count, value=checkpoint.dropped)
+    # Report the size of the images, and what the encoding saves compared to full resolution PNG images, estimated
+    #  from a reference frame (the video can't be read twice when it's piped into FFmpeg)
+    frame_bytes = sum(frame.size for frame in uploaded_frames)
+    metrics.add_metadata(key="video_id", value=video_id)
+    metrics.add_metric(name="FrameBytes", unit=MetricUnit.Bytes, value=frame_bytes)
+    if crop_changes:
+        cropped_frames = [frame for frame in uploaded_frames if frame.crop_region]
+        logger.info(f"Cropped the changed region of {len(cropped_frames)} still frame images out of {len(uploaded_frames)}")
+        metrics.add_metric(name="CroppedFrames", unit=MetricUnit.Count, value=len(cropped_frames))
+        metrics.add_metric(name="CroppedFrameBytesSaved", unit=MetricUnit.Bytes, value=sum(frame.size - frame.crop_size for frame in cropped_frames))
+    if uploaded_frames and (frame_encoding != frame_extraction.FrameEncoding() or tile_grid.cells > 1) and video_input_mode != "pipe":
+        reference_frame = uploaded_frames[len(uploaded_frames) // 2]
+        try:
+            reference_size = len(frame_extraction.encode_reference_frame(video_path, reference_frame.timestamp))
+            png_bytes = reference_size * sum(len(frame.cell_timestamps or [frame.timestamp]) for frame in uploaded_frames)
+            metrics.add_metric(name="FrameBytesSaved", unit=MetricUnit.Bytes, value=max(png_bytes - frame_bytes, 0))
+            logger.info(f"Still frame images take {frame_bytes} bytes, about {100 * (1 - frame_bytes / png_bytes):.0f}% less than full resolution PNG images")
+        except Exception as e:
+            logger.warning(f"Could not estimate the size of full resolution PNG images: {e}")
 
     # Clean up temporary files
-    os.remove(local_video_path)
-    shutil.rmtree(tmp_image_dir)    
+    _clean_up_temporary_files(local_video_path, tmp_image_dir, tmp_thumbnail_path, tmp_tile_dir)
         
     # At the moment of writing this, Bedrock can process up to 20 images at a time
-    #  so, return the images list in batches of up to 20 images 
-    image_batch_size = 20
-    image_batches = []
-    for i in range(0, len(image_list), image_batch_size):
-        image_batch = image_list[i:i+image_batch_size]
-        image_batches.append(image_batch)
+    #  so, return the images list in batches that fit what the analysis model accepts in a single request
+    #  ANALYSIS_MODEL_ID: model the batches are sized for (see batch_planner.MODEL_BUDGETS)
+    #  BATCH_MAX_IMAGES, BATCH_MAX_BYTES, BATCH_MAX_IMAGE_TOKENS: override the model's limits when set (0 keeps the model's)
+    #  BATCH_OVERLAP: number of frames repeated from the end of a batch at the start of the next one
+    batch_budget = batch_planner.model_budget(
+        os.environ.get("ANALYSIS_MODEL_ID", ""),
+        max_images=int(os.environ.get("BATCH_MAX_IMAGES", "0")),
+        max_bytes=int(os.environ.get("BATCH_MAX_BYTES", "0")),
+        max_image_tokens=int(os.environ.get("BATCH_MAX_IMAGE_TOKENS", "0")),
+        overlap=int(os.environ.get("BATCH_OVERLAP", "0")),
+    )
+    image_batches = batch_planner.plan_batches(uploaded_frames, batch_budget)
+    logger.info(f"Packed {len(image_list)} still frame images into {len(image_batches)} batches")
+    idle_spans = [batch_planner.idle_span(image_batch, idle_threshold) if idle_threshold > 0 else None for image_batch, _ in image_batches]
+    if idle_threshold > 0:
+        idle_batches = sum(1 for span in idle_spans if span)
+        logger.info(f"Found {idle_batches} idle batches out of {len(image_batches)}, they won't be sent to the model")
+        metrics.add_metric(name="IdleBatches", unit=MetricUnit.Count, value=idle_batches)
     
     logger.info(f"Finished extracting still images from video file '{video_s3_uri}' => VideoID='{video_id}'. \nExtracted images can be found at s3://{image_bucket}/{image_path}/")
     metrics.add_metric(name="IngestedPAMVideos", unit=MetricUnit.Count, value=1)
     
+    # Write the frame manifest next to the images: batches only carry the range of frames they cover in the
+    #  manifest, as the Step Functions state can't hold the file names of long videos (256KB payload limit)
+    manifest_offsets = frame_manifest.write_manifest(s3_client, uploaded_frames, image_bucket, manifest_key)
+    frame_positions = {frame.number: k for k, frame in enumerate(uploaded_frames)}
+    batch_ranges = []
+    for (image_batch, overlap), idle in zip(image_batches, idle_spans):
+        first = frame_positions[image_batch[0].number]
+        batch_ranges.append((first, first + len(image_batch), overlap, idle, batch_planner.max_change(image_batch)))
+
     return {
-        "event": event,
         "status": "OK",
         "message": "Video processed!", 
         "image_batches": [
@@ -130,14 +364,25 @@ def lambda_handler(event: S3Event, context: LambdaContext):
                     "video_id": video_id, 
                     "video_s3_uri": video_s3_uri,
                     "video_url": video_url,
-                    "sequence_id": f"sequence-{k+1}"
+                    "sequence_id": f"sequence-{chunk['index']+1}-{k+1}" if chunk else f"sequence-{k+1}"
                 },
                 "image_path": image_path,
-                "image_list": image_batch
-            } for k, image_batch in enumerate(image_batches)
+                "manifest": {
+                    "key": manifest_key,
+                    "byte_range": [manifest_offsets[first], manifest_offsets[end]]
+                },
+                "frame_range": [first, end],
+                **({"overlap": overlap} if overlap else {}),
+                **({"tile_grid": str(tile_grid)} if tile_grid.cells > 1 else {}),
+                **({"idle": idle} if idle else {}),
+                **({"change": round(change, 4)} if change is not None else {})
+            } for k, (first, end, overlap, idle, change) in enumerate(batch_ranges)
         ]
     }
-    # Example of 'image_batches' below
+    # Example of 'image_batches' below, the frames of a batch being the lines of the manifest in 'byte_range'
+    #  batches where nothing changes on the screen also come with their time span, e.g. "idle": [120.0, 139.0], and
+    #  batches whose changes were measured with the largest share of the screen that changed between two frames, e.g. "change": 0.42
+    #  {"number":1,"filename":"00001.png","timestamp":0.0,"size":183744,"width":1920,"height":1080,"sha256":"9f86d0..."}
     '''        
         "image_batches": [
             {  
@@ -148,10 +393,11 @@ def lambda_handler(event: S3Event, context: LambdaContext):
                     "sequence_id": "sequence-1"
                 },
                 "image_path": image_path,
-                "image_list": [
-                    "0001.png", "0002.png", "0003.png", "0004.png", "0005.png", "0006.png", "0007.png", "0008.png", "0009.png", "0010.png",
-                    "0011.png", "0012.png", "0013.png", "0014.png", "0015.png", "0016.png", "0017.png", "0018.png", "0019.png", "0020.png"
-                ] 
+                "manifest": {
+                    "key": "hello-world/manifest.jsonl",
+                    "byte_range": [0, 2540]
+                },
+                "frame_range": [0, 20]
             },
             {
                 "batch_info": { 
@@ -161,10 +407,11 @@ def lambda_handler(event: S3Event, context: LambdaContext):
                     "sequence_id": "sequence-2"
                 },
                 "image_path": image_path,
-                "image_list": [
-                    "0021.png", "0022.png", "0023.png", "0024.png", "0025.png", "0026.png", "0027.png", "0028.png", "0029.png", "0030.png",
-                    "0031.png", "0032.png", "0033.png", "0034.png", "0035.png", "0036.png", "0037.png", "0038.png", "0039.png", "0040.png"
-                ] 
+                "manifest": {
+                    "key": "hello-world/manifest.jsonl",
+                    "byte_range": [2540, 5080]
+                },
+                "frame_range": [20, 40]
             },
             {
                 "batch_info": { 
@@ -174,9 +421,20 @@ def lambda_handler(event: S3Event, context: LambdaContext):
                     "sequence_id": "sequence-3"
                 },
                 "image_path": image_path,
-                "image_list": [
-                    "0041.png"
-                ] 
+                "manifest": {
+                    "key": "hello-world/manifest.jsonl",
+                    "byte_range": [5080, 5207]
+                },
+                "frame_range": [40, 41]
             }
         ]
-    '''
\ No newline at end of file
+    '''
+
+
+# Remove the temporary files of the extraction
+def _clean_up_temporary_files(*paths: str) -> None:
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
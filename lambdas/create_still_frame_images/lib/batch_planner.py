@@ -0,0 +1,94 @@
+import math
+from dataclasses import dataclass, replace
+from typing import List, Sequence
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# Limits of a single request to the analysis model
+#  'max_images': number of images per request
+#  'max_bytes': total size of the images per request, in bytes
+#  'max_image_tokens': total number of (estimated) image tokens per request, 0 means no limit
+#  'overlap': number of frames repeated at the start of a batch from the end of the previous one, so that
+#   actions spanning two batches are seen as a whole by at least one request
+@dataclass
+class BatchBudget:
+    max_images: int = 20
+    max_bytes: int = 20 * 1024 * 1024
+    max_image_tokens: int = 0
+    overlap: int = 0
+
+
+# Default budgets per model, matched on the beginning of the model ID (at the time of writing)
+#  Anthropic Claude: up to 20 images per request on Bedrock, each image costing about (width * height) / 750 tokens
+#  Amazon Nova: up to 20 images per request, 25MB per request
+MODEL_BUDGETS = {
+    "anthropic.claude": BatchBudget(max_images=20, max_bytes=20 * 1024 * 1024),
+    "amazon.nova": BatchBudget(max_images=20, max_bytes=24 * 1024 * 1024),
+}
+
+# Claude downscales images whose long edge exceeds 1568 pixels or whose size exceeds about 1.15 megapixels
+MAX_IMAGE_EDGE = 1568
+MAX_IMAGE_PIXELS = 1_150_000
+PIXELS_PER_TOKEN = 750
+
+######################################## DEFINE FUNCTIONS ########################################
+# Budget of the given model, the cross-region inference prefix (e.g. 'us.') being ignored. Non-zero
+#  values of 'overrides' replace the model's defaults.
+def model_budget(model_id: str, **overrides) -> BatchBudget:
+    base_model_id = model_id.split(".", 1)[1] if model_id.split(".", 1)[0] in ("us", "eu", "apac") else model_id
+    budget = next((budget for prefix, budget in MODEL_BUDGETS.items() if base_model_id.startswith(prefix)), BatchBudget())
+    return replace(budget, **{key: value for key, value in overrides.items() if value})
+
+
+# Estimated number of tokens the model spends on an image, once downscaled as the model does.
+#  Images of unknown dimensions are assumed to be as large as the model accepts.
+def estimate_image_tokens(width: int, height: int) -> int:
+    if not width or not height:
+        return math.ceil(MAX_IMAGE_PIXELS / PIXELS_PER_TOKEN)
+    scale = min(1.0, MAX_IMAGE_EDGE / max(width, height), math.sqrt(MAX_IMAGE_PIXELS / (width * height)))
+    return math.ceil(width * height * scale * scale / PIXELS_PER_TOKEN)
+
+
+# Pack the frames (in order) into batches that fit the budget, each batch after the first starting with the
+#  last 'budget.overlap' frames of the previous one (fewer if they don't fit along with a new frame).
+#  A frame exceeding the budget on its own gets a batch of its own. Returns the batches along with the
+#  number of overlapping frames each of them starts with.
+def plan_batches(frames: Sequence, budget: BatchBudget) -> List[tuple[List, int]]:
+    batches = []
+    batch = []
+    overlap = 0
+    for frame in frames:
+        if len(batch) > overlap and not _fits(batch + [frame], budget):
+            batches.append((batch, overlap))
+            batch = batch[len(batch) - min(budget.overlap, len(batch) - 1):] if budget.overlap else []
+            while batch and not _fits(batch + [frame], budget):
+                batch = batch[1:]
+            overlap = len(batch)
+        if not _fits([frame], budget):
+            logger.warning(f"Still frame image '{frame.filename}' ({frame.size} bytes) exceeds the batch budget on its own")
+        batch.append(frame)
+    if len(batch) > overlap:
+        batches.append((batch, overlap))
+    logger.debug(f"Planned {len(batches)} batches for {len(frames)} still frame images with {budget}")
+    return batches
+
+
+# Time span [first, last timestamp] of a batch showing no activity: every frame (or frame of a tile) changed by at
+#  most 'threshold' of its thumbnail since the frame before it. None if anything changed or a change wasn't measured.
+def idle_span(batch: Sequence, threshold: float) -> List[float] | None:
+    if not batch or any(frame.change is None or frame.change > threshold for frame in batch):
+        return None
+    return [batch[0].timestamp, (batch[-1].cell_timestamps or [batch[-1].timestamp])[-1]]
+
+
+# Largest share of a thumbnail that changed between two frames of the batch, None if no change was measured
+def max_change(batch: Sequence) -> float | None:
+    changes = [frame.change for frame in batch if frame.change is not None]
+    return max(changes) if changes else None
+
+
+def _fits(batch: List, budget: BatchBudget) -> bool:
+    if len(batch) > budget.max_images or sum(frame.size for frame in batch) > budget.max_bytes:
+        return False
+    return not budget.max_image_tokens or sum(estimate_image_tokens(frame.width, frame.height) for frame in batch) <= budget.max_image_tokens
@@ -0,0 +1,66 @@
+import base64, json
+from dataclasses import dataclass, asdict
+from typing import Iterable, Iterator
+from aws_lambda_powertools import Logger
+from lib import frame_extraction # type: ignore
+
+logger = Logger()
+
+CHECKPOINT_FILENAME = "checkpoint.json"
+
+# Progress of the extraction of a video, saved after every time range of the video so that the extraction
+#  can resume where it stopped (next invocation of the state machine's loop, retry after a timeout...)
+#  'execution_id' is the Step Functions execution the checkpoint belongs to, a new execution starts over
+#  'next_start' is the time of the video the extraction resumes from, in seconds
+#  'last_number' is the number of the last extracted frame, scene change sampled frames being numbered in sequence
+#  'last_kept' is the last frame kept (number, timestamp and base64 thumbnail), to compare the next frames with
+#  'extracted' and 'dropped' count the extracted frames and the near-duplicate frames dropped so far
+@dataclass
+class Checkpoint:
+    execution_id: str
+    next_start: float = 0
+    last_number: int = 0
+    last_kept: dict | None = None
+    extracted: int = 0
+    dropped: int = 0
+    done: bool = False
+
+    # Pass the frames through, recording the number of the last one
+    def track_extracted(self, frames: Iterable) -> Iterator:
+        for frame in frames:
+            self.last_number = frame.number
+            yield frame
+
+    # Pass the frames through, recording the last one
+    def track_kept(self, frames: Iterable) -> Iterator:
+        for frame in frames:
+            if frame.thumbnail:
+                self.last_kept = {"number": frame.number, "timestamp": frame.timestamp,
+                                  "thumbnail": base64.b64encode(frame.thumbnail).decode("ascii")}
+            yield frame
+
+    # The last frame kept, without its image data
+    def last_kept_frame(self):
+        if not self.last_kept:
+            return None
+        return frame_extraction.Frame(self.last_kept["number"], self.last_kept["timestamp"], None,
+                                      thumbnail=base64.b64decode(self.last_kept["thumbnail"]))
+
+
+######################################## DEFINE FUNCTIONS ########################################
+# Load the checkpoint at 's3://bucket/key', a fresh one starting at 'start' if there is none or if it belongs to another execution
+def load_checkpoint(s3_client, bucket: str, key: str, execution_id: str, start: float = 0) -> Checkpoint:
+    try:
+        checkpoint = Checkpoint(**json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()))
+    except s3_client.exceptions.NoSuchKey:
+        return Checkpoint(execution_id, start)
+    if checkpoint.execution_id != execution_id:
+        logger.info(f"Ignoring the checkpoint of execution '{checkpoint.execution_id}' at 's3://{bucket}/{key}'")
+        return Checkpoint(execution_id, start)
+    logger.info(f"Resuming the extraction from {checkpoint.next_start}s, {checkpoint.extracted} frames extracted so far")
+    return checkpoint
+
+
+def save_checkpoint(s3_client, checkpoint: Checkpoint, bucket: str, key: str) -> None:
+    s3_client.put_object(Bucket=bucket, Key=key, Body=json.dumps(asdict(checkpoint)).encode("utf-8"), ContentType="application/json")
+    logger.debug(f"Saved the extraction checkpoint at 's3://{bucket}/{key}': next start at {checkpoint.next_start}s")
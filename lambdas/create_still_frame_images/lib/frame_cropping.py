@@ -0,0 +1,80 @@
+import shlex, subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Iterator, List
+from aws_lambda_powertools import Logger
+from lib import frame_dedup, frame_extraction # type: ignore
+
+logger = Logger()
+
+######################################## DEFINE FUNCTIONS ########################################
+# Bounding box [x, y, width, height] of the thumbnail pixels whose gray level moved by more than
+#  'pixel_delta' between the two thumbnails, None if no pixel moved
+def changed_box(previous: bytes, current: bytes, pixel_delta: int = 16) -> List[int] | None:
+    width = frame_dedup.THUMBNAIL_WIDTH
+    changed = [k for k, (a, b) in enumerate(zip(previous, current)) if abs(a - b) > pixel_delta]
+    if not changed:
+        return None
+    rows = [k // width for k in changed]
+    columns = [k % width for k in changed]
+    return [min(columns), min(rows), max(columns) - min(columns) + 1, max(rows) - min(rows) + 1]
+
+
+# Region [x, y, width, height] of the full resolution frame matching a box of its thumbnail,
+#  grown by 'margin' pixels on every side to keep some context and clipped to the frame
+def frame_region(box: List[int], frame_width: int, frame_height: int, margin: int = 0) -> List[int]:
+    scale_x = frame_width / frame_dedup.THUMBNAIL_WIDTH
+    scale_y = frame_height / frame_dedup.THUMBNAIL_HEIGHT
+    left = max(int(box[0] * scale_x) - margin, 0)
+    top = max(int(box[1] * scale_y) - margin, 0)
+    right = min(int((box[0] + box[2]) * scale_x + 0.5) + margin, frame_width)
+    bottom = min(int((box[1] + box[3]) * scale_y + 0.5) + margin, frame_height)
+    return [left, top, right - left, bottom - top]
+
+
+# Crop, for every frame, the region that changed since the previous frame, found by comparing their thumbnails.
+#  The cropped image is attached to the frame ('crop_region', 'crop_data') when the region covers at most
+#  'max_area' of the frame: larger changes are better understood on the full frame. The first frame, and frames
+#  without a thumbnail or whose dimensions are unknown, are left alone. Crops are encoded by up to 'max_workers'
+#  FFmpeg processes at a time while the frames keep their order. 'previous' is the frame before these ones, if any.
+def crop_changed_regions(frames: Iterable, encoding: frame_extraction.FrameEncoding, pixel_delta: int = 16, max_area: float = 0.5,
+                         margin: int = 16, max_workers: int = 4, previous=None) -> Iterator:
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for frame in frames:
+            region = None
+            if previous is not None and previous.thumbnail and frame.thumbnail and frame.width and frame.height:
+                box = changed_box(previous.thumbnail, frame.thumbnail, pixel_delta)
+                if box:
+                    region = frame_region(box, frame.width, frame.height, margin)
+                    if region[2] * region[3] > max_area * frame.width * frame.height:
+                        region = None
+            previous = frame
+            pending.append((frame, executor.submit(_crop, frame, region, encoding) if region else None))
+            while len(pending) > 2 * max_workers or (pending and (pending[0][1] is None or pending[0][1].done())):
+                yield _attach_crop(*pending.popleft())
+        while pending:
+            yield _attach_crop(*pending.popleft())
+
+
+# FFmpeg command cropping 'region' out of the image read from the standard input
+def build_crop_command(region: List[int], encoding: frame_extraction.FrameEncoding) -> str:
+    x, y, width, height = region
+    return f"ffmpeg -v error -f image2pipe -i pipe:0 -vf crop={width}:{height}:{x}:{y} -frames:v 1 -f image2pipe {encoding.codec_options()}pipe:1"
+
+
+def _crop(frame, region: List[int], encoding: frame_extraction.FrameEncoding) -> tuple[List[int], bytes]:
+    ffmpeg_cmd = build_crop_command(region, encoding)
+    logger.debug(f"Executing the following ffmpeg command: {ffmpeg_cmd}")
+    return region, subprocess.run(shlex.split(ffmpeg_cmd), input=frame.data, stdout=subprocess.PIPE, check=True).stdout
+
+
+def _attach_crop(frame, crop):
+    if crop is not None:
+        try:
+            frame.crop_region, frame.crop_data = crop.result()
+            frame.crop_size = len(frame.crop_data)
+        except Exception as e:
+            # the full frame is still there
+            logger.warning(f"Could not crop the changed region of still frame image '{frame.filename}': {e}")
+    return frame
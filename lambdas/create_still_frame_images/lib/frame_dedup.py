@@ -0,0 +1,78 @@
+from typing import BinaryIO, Iterable, Iterator
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# Size of the grayscale thumbnails FFmpeg renders next to each still frame image.
+# Frames are compared on these thumbnails rather than on the full resolution images,
+# which keeps the comparison cheap and makes it tolerant to compression noise.
+THUMBNAIL_WIDTH = 160
+THUMBNAIL_HEIGHT = 90
+THUMBNAIL_SIZE = THUMBNAIL_WIDTH * THUMBNAIL_HEIGHT
+
+######################################## DEFINE FUNCTIONS ########################################
+# FFmpeg filter graph rendering the thumbnails as raw 8-bit grayscale pixels
+def thumbnail_filter() -> str:
+    return f"scale={THUMBNAIL_WIDTH}:{THUMBNAIL_HEIGHT},format=gray"
+
+
+# Read the raw thumbnails written by FFmpeg, one thumbnail per extracted still frame image
+def read_thumbnails(stream: BinaryIO) -> Iterator[bytes]:
+    while True:
+        thumbnail = stream.read(THUMBNAIL_SIZE)
+        if len(thumbnail) < THUMBNAIL_SIZE:
+            return
+        yield thumbnail
+
+
+# Share of the thumbnail pixels whose gray level moved by more than 'pixel_delta'
+def changed_fraction(previous: bytes, current: bytes, pixel_delta: int = 16) -> float:
+    if previous == current:
+        return 0.0
+    changed = sum(1 for a, b in zip(previous, current) if abs(a - b) > pixel_delta)
+    return changed / len(current)
+
+
+# Record on every frame the share of its thumbnail that changed since the frame before it ('change'), 'previous'
+#  being the frame before these ones, if any. Frames without a thumbnail or a frame to compare with are left alone.
+def measure_changes(frames: Iterable, pixel_delta: int = 16, previous=None) -> Iterator:
+    for frame in frames:
+        if previous is not None and previous.thumbnail and frame.thumbnail:
+            frame.change = changed_fraction(previous.thumbnail, frame.thumbnail, pixel_delta)
+        previous = frame
+        yield frame
+
+
+# Release the thumbnail of every frame once the frame after it comes through, to be placed at the end of the
+#  pipeline: by then the frame after it has been compared with it (deduplication, change measurement, cropping),
+#  so that only a frame or two hold a thumbnail at any time instead of every frame of the video
+def release_thumbnails(frames: Iterable) -> Iterator:
+    previous = None
+    for frame in frames:
+        if previous is not None:
+            previous.thumbnail = None
+        previous = frame
+        yield frame
+    if previous is not None:
+        previous.thumbnail = None
+
+
+# Drop every frame that is a near-duplicate of the last kept one. A frame is kept anyway once
+#  'max_gap' frames have been dropped in a row (0 means no limit) so that long idle periods
+#  still show up in the analysis. 'stats' (if any) receives the number of extracted and dropped frames.
+#  'last_kept' is the frame kept last before these ones, if any (e.g. when resuming an extraction).
+def drop_near_duplicates(frames: Iterable, threshold: float, pixel_delta: int = 16, max_gap: int = 0, stats: dict | None = None,
+                         last_kept=None) -> Iterator:
+    extracted = dropped = 0
+    for frame in frames:
+        extracted += 1
+        if last_kept is None \
+            or (max_gap > 0 and frame.number - last_kept.number > max_gap) \
+            or changed_fraction(last_kept.thumbnail, frame.thumbnail, pixel_delta) > threshold:
+            last_kept = frame
+            yield frame
+        else:
+            dropped += 1
+        if stats is not None:
+            stats.update(extracted=extracted, dropped=dropped)
+    logger.debug(f"Dropped {dropped} near-duplicate frames out of {extracted}")
@@ -0,0 +1,554 @@
+import os, sys, subprocess, math, re, hashlib, json
+import shlex, shutil, queue, threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import BinaryIO, Iterator, List
+from aws_lambda_powertools import Logger
+from lib import frame_dedup # type: ignore
+
+logger = Logger()
+
+# Sampling rate of the still frame images
+FPS = 1
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_START_MARKER = b"\xff\xd8"
+JPEG_END_MARKER = b"\xff\xd9"
+
+# File extension of the still frame images for each supported image format
+IMAGE_EXTENSIONS = {"png": "png", "jpeg": "jpg", "webp": "webp"}
+
+# Ways of decoding the video to sample frames at a fixed rate, see choose_decode_mode
+DECODE_MODES = ("full", "keyframes", "seek")
+# Keyframe-only decoding is chosen when keyframes are at most that many sampling intervals apart
+KEYFRAME_INTERVAL_TOLERANCE = 1.25
+# Cost of starting an FFmpeg process and opening the video for every seek, in decoded frames
+SEEK_OVERHEAD_FRAMES = 30
+
+# Encoding of the still frame images
+#  'format' is one of 'png' (lossless), 'jpeg' or 'webp'
+#  'quality' goes from 1 (smallest files) to 100 (best quality), it is ignored for PNG images
+#  'max_edge' caps the long edge of the images in pixels (0 keeps the original resolution), images are never upscaled
+@dataclass
+class FrameEncoding:
+    format: str = "png"
+    quality: int = 85
+    max_edge: int = 0
+
+    @property
+    def extension(self) -> str:
+        return IMAGE_EXTENSIONS[self.format]
+
+    # Filter downscaling the images, if needed
+    def filter(self) -> str:
+        if not self.max_edge:
+            return ""
+        return f"scale=w=min(iw\\,{self.max_edge}):h=min(ih\\,{self.max_edge}):force_original_aspect_ratio=decrease:flags=lanczos"
+
+    # FFmpeg encoder and its options
+    def codec_options(self) -> str:
+        if self.format == "jpeg":
+            # mjpeg's quality scale goes from 2 (best) to 31 (worst), full chroma resolution keeps colored text readable
+            return f"-c:v mjpeg -q:v {round(31 - 29 * min(max(self.quality, 1), 100) / 100)} -pix_fmt yuvj444p "
+        if self.format == "webp":
+            return f"-c:v libwebp -lossless 0 -quality {self.quality} "
+        return "-c:v png "
+
+# Adaptive sampling driven by FFmpeg's scene change score: a frame is kept when it differs enough from the
+#  previous one ('threshold', a scene score between 0 and 1), but no sooner than 'min_interval' seconds after
+#  the last kept frame, and a frame is kept anyway after 'max_interval' seconds without any
+@dataclass
+class SceneSampling:
+    threshold: float = 0.01
+    min_interval: float = 0.5
+    max_interval: float = 10
+
+    def filter(self) -> str:
+        return "select=isnan(prev_selected_t)" \
+            f"+gte(t-prev_selected_t\\,{self.max_interval})" \
+            f"+gt(scene\\,{self.threshold})*gte(t-prev_selected_t\\,{self.min_interval})"
+
+
+# Codec parameters of the video stream, as probed by ffprobe
+#  'frame_rate' is the average number of frames per second
+#  'keyframe_interval' is the average time between two keyframes in seconds, infinite when there is only one
+@dataclass
+class VideoStreamInfo:
+    codec: str
+    frame_rate: float
+    keyframe_interval: float
+
+
+# A still frame image extracted from the video
+#  'number' gives the image its file name: with the fixed rate sampling, it is the rank of the frame at FPS frames
+#   per second, starting at 1, with the scene change sampling, frames are simply numbered in sequence
+#  'timestamp' is the time of the frame in the video, in seconds
+#  'data' is released once the image is uploaded, 'size', 'width', 'height' and 'sha256' are read from it beforehand
+#  'thumbnail' is only rendered when near-duplicate frames have to be detected, and released once the next frame was compared with it
+#  'cell_timestamps' lists the timestamps of the frames packed into a tile (see frame_tiling)
+#  'crop_region' ([x, y, width, height]) and 'crop_data' hold the region that changed since the previous frame (see frame_cropping)
+#  'change' is the share of the thumbnail that changed since the previous frame, when measured (see frame_dedup.measure_changes)
+@dataclass
+class Frame:
+    number: int
+    timestamp: float
+    data: bytes | None
+    thumbnail: bytes | None = None
+    extension: str = "png"
+    size: int = 0
+    cell_timestamps: List[float] | None = None
+    width: int = 0
+    height: int = 0
+    sha256: str = ""
+    crop_region: List[int] | None = None
+    crop_data: bytes | None = None
+    crop_size: int = 0
+    change: float | None = None
+
+    def __post_init__(self):
+        if self.data is not None and not self.size:
+            self.size = len(self.data)
+        if self.data is not None and not self.width:
+            self.width, self.height = image_dimensions(self.data)
+        if self.data is not None and not self.sha256:
+            self.sha256 = hashlib.sha256(self.data).hexdigest()
+
+    @property
+    def filename(self) -> str:
+        return f"{self.number:05d}.{self.extension}"
+
+    @property
+    def crop_filename(self) -> str:
+        return f"{self.number:05d}-crop.{self.extension}"
+
+
+######################################## DEFINE FUNCTIONS ########################################
+# Build the FFmpeg command sampling still frames out of the video, FPS frames per second by default
+#  when 'scene_sampling' is set, frames are sampled on scene changes instead and their timestamps logged (showinfo)
+#  'encoding' sets the format, quality and maximum size of the images (full resolution PNG images by default)
+#  when 'thumbnail_output' is set, a grayscale thumbnail of every frame is rendered there in the same pass
+#  when 'start' and/or 'duration' are set, only that time range of the video is decoded
+#  'video_path' can also be an HTTP(S) URL, read with range requests, or 'pipe:0' for the standard input
+def build_ffmpeg_command(video_path: str, frame_output: str, thumbnail_output: str | None = None, output_options: str = "",
+                         start: float = 0, duration: float | None = None, scene_sampling: SceneSampling | None = None,
+                         encoding: FrameEncoding | None = None, keyframes_only: bool = False) -> str:
+    encoding = encoding or FrameEncoding()
+    input_options = ""
+    if keyframes_only:
+        # the decoder skips every frame but the keyframes, the sampling filter picks among them
+        input_options += "-skip_frame nokey "
+    if video_path.startswith(("http://", "https://")):
+        # resume the download where it stopped if the connection drops
+        input_options += "-reconnect 1 -reconnect_on_network_error 1 -reconnect_delay_max 10 "
+    if start:
+        input_options += f"-ss {start} "
+    if duration:
+        input_options += f"-t {duration} "
+    frame_limit = ""
+    if scene_sampling:
+        sampling_filter = f"{scene_sampling.filter()},showinfo"
+        # only write the selected frames, without duplicating them to keep a constant frame rate
+        output_options = f"-fps_mode vfr {output_options}"
+    else:
+        sampling_filter = f"fps={FPS}"
+        if duration:
+            # the fps filter may emit one extra frame at the very end of the range, cap the number of frames (and thumbnails)
+            frame_limit = f"-frames:v {math.ceil(duration * FPS)} "
+            output_options = f"{frame_limit}{output_options}"
+    output_options = f"{output_options}{encoding.codec_options()}"
+    scale_filter = encoding.filter()
+    if thumbnail_output:
+        # thumbnails are rendered from the full resolution frames
+        frame_filter = f"[sampled]{scale_filter}[frames];" if scale_filter else ""
+        filter_graph = f"[0:v]{sampling_filter},split=2[{'sampled' if scale_filter else 'frames'}][thumbnails];{frame_filter}" \
+            f"[thumbnails]{frame_dedup.thumbnail_filter()}[gray]"
+        return f'ffmpeg {input_options}-i {shlex.quote(video_path)} -filter_complex {shlex.quote(filter_graph)} ' \
+            f'-map [frames] {output_options}{shlex.quote(frame_output)} -map [gray] {frame_limit}-f rawvideo {shlex.quote(thumbnail_output)}'
+    video_filter = f"{sampling_filter},{scale_filter}" if scale_filter else sampling_filter
+    return f'ffmpeg {input_options}-i {shlex.quote(video_path)} -vf {shlex.quote(video_filter)} {output_options}{shlex.quote(frame_output)}'
+
+
+# Encode the frame at 'timestamp' as a full resolution PNG image, the default encoding, to measure what other encodings save
+def encode_reference_frame(video_path: str, timestamp: float = 0) -> bytes:
+    ffmpeg_cmd = f"ffmpeg -v error -ss {timestamp} -i {shlex.quote(video_path)} -frames:v 1 -f image2pipe -c:v png pipe:1"
+    logger.debug(f"Executing the following ffmpeg command: {_redact(ffmpeg_cmd)}")
+    return subprocess.check_output(shlex.split(ffmpeg_cmd), stdin=subprocess.DEVNULL)
+
+
+# Duration of the video in seconds, as reported by ffprobe
+def probe_duration(video_path: str) -> float:
+    ffprobe_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 {shlex.quote(video_path)}"
+    logger.debug(f"Executing the following ffprobe command: {_redact(ffprobe_cmd)}")
+    return float(subprocess.check_output(shlex.split(ffprobe_cmd), text=True).strip())
+
+
+# Codec, frame rate and keyframe interval of the video stream, the keyframes being spotted in the packets of the
+#  first 'probe_seconds' seconds of the video (packets are only read, not decoded)
+def probe_video_stream(video_path: str, probe_seconds: int = 60) -> VideoStreamInfo:
+    ffprobe_cmd = f"ffprobe -v error -select_streams v:0 -show_entries stream=codec_name,avg_frame_rate,r_frame_rate:packet=pts_time,flags " \
+        f"-read_intervals %+{probe_seconds} -of json {shlex.quote(video_path)}"
+    logger.debug(f"Executing the following ffprobe command: {_redact(ffprobe_cmd)}")
+    probe = json.loads(subprocess.check_output(shlex.split(ffprobe_cmd), text=True))
+    stream = probe["streams"][0]
+    frame_rate = _parse_rate(stream.get("avg_frame_rate")) or _parse_rate(stream.get("r_frame_rate"))
+    keyframe_times = sorted(float(packet["pts_time"]) for packet in probe.get("packets", [])
+                            if "K" in packet.get("flags", "") and packet.get("pts_time", "N/A") != "N/A")
+    keyframe_interval = math.inf
+    if len(keyframe_times) > 1:
+        keyframe_interval = (keyframe_times[-1] - keyframe_times[0]) / (len(keyframe_times) - 1)
+    return VideoStreamInfo(stream.get("codec_name", ""), frame_rate, keyframe_interval)
+
+
+# Cheapest way of decoding the video to sample a frame every 1/FPS seconds, counting the frames each mode decodes per sample:
+#  'full' decodes every frame of the video
+#  'keyframes' only decodes keyframes, which is only an option when they are about as frequent as the samples
+#   (the sampled frame may otherwise be up to a keyframe interval old)
+#  'seek' jumps to every sample point, decoding from the keyframe before it: half a keyframe interval on average
+# Scene change sampling compares every frame with the previous one, it always decodes the whole video
+def choose_decode_mode(stream_info: VideoStreamInfo, scene_sampling: SceneSampling | None = None) -> str:
+    if scene_sampling or not stream_info.frame_rate:
+        return "full"
+    sampling_interval = 1 / FPS
+    costs = {
+        "full": stream_info.frame_rate * sampling_interval,
+        "seek": stream_info.frame_rate * stream_info.keyframe_interval / 2 + SEEK_OVERHEAD_FRAMES,
+    }
+    if stream_info.keyframe_interval <= sampling_interval * KEYFRAME_INTERVAL_TOLERANCE:
+        costs["keyframes"] = max(sampling_interval / stream_info.keyframe_interval, 1)
+    return min(costs, key=costs.get)
+
+
+# Staged extraction: FFmpeg writes every frame in 'image_dir' first, frames are then read back one by one
+#  'video_stream' (if any) is a file-like object piped into FFmpeg's standard input, 'video_path' being 'pipe:0'
+#  In this function and the next ones, 'start' and 'duration' restrict the extraction to a time range of the video
+#  and 'first_number' is the number of the frame before the range (round(start * FPS) with the fixed rate sampling)
+def extract_frames(video_path: str, image_dir: str, thumbnail_path: str | None = None, video_stream: BinaryIO | None = None,
+                   scene_sampling: SceneSampling | None = None, encoding: FrameEncoding | None = None,
+                   start: float = 0, duration: float | None = None, first_number: int = 0, keyframes_only: bool = False) -> Iterator[Frame]:
+    timestamps = _extract_to_directory(video_path, image_dir, thumbnail_path, start, duration, video_stream=video_stream,
+                                       scene_sampling=scene_sampling, encoding=encoding, keyframes_only=keyframes_only)
+    yield from _read_extracted_frames(image_dir, thumbnail_path, start, first_number, timestamps=timestamps)
+
+
+# Parallel extraction: the video is split into time ranges of 'segment_duration' seconds (by default,
+#  as many ranges as workers) decoded by concurrent FFmpeg processes, one per CPU core. Each process
+#  writes its frames in its own directory and the frames are handed over in order, range after range,
+#  as soon as the range they belong to is decoded. Frames are numbered as if extracted in a single pass.
+def extract_frames_in_parallel(video_path: str, image_dir: str, with_thumbnails: bool = False,
+                               workers: int = 0, segment_duration: int = 0, scene_sampling: SceneSampling | None = None,
+                               encoding: FrameEncoding | None = None, start: int = 0, duration: float | None = None,
+                               first_number: int = 0, keyframes_only: bool = False) -> Iterator[Frame]:
+    workers = workers or os.cpu_count() or 1
+    end = probe_duration(video_path)
+    if duration is not None:
+        end = min(end, start + duration)
+    # ranges start on a whole second so that frame numbers line up with the single pass extraction
+    segment_duration = segment_duration or max(1, math.ceil((end - start) / workers))
+    segments = [(segment_start, min(segment_duration, end - segment_start))
+                for segment_start in range(int(start), math.ceil(end), segment_duration)]
+    logger.info(f"Extracting frames from {len(segments)} time ranges of {segment_duration}s with {workers} parallel FFmpeg processes")
+
+    # FFmpeg processes run outside of Python, threads only wait for them to complete
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        extractions = []
+        for k, (segment_start, length) in enumerate(segments):
+            segment_dir = os.path.join(image_dir, f"segment-{k:05d}")
+            thumbnail_path = f"{segment_dir}.gray" if with_thumbnails else None
+            os.makedirs(segment_dir, exist_ok=True)
+            extraction = executor.submit(_extract_to_directory, video_path, segment_dir, thumbnail_path, segment_start, length,
+                                         scene_sampling=scene_sampling, encoding=encoding, keyframes_only=keyframes_only)
+            extractions.append((segment_dir, thumbnail_path, segment_start, extraction))
+        count = 0
+        for segment_dir, thumbnail_path, segment_start, extraction in extractions:
+            timestamps = extraction.result()
+            # scene change sampled frames are numbered in sequence across the ranges
+            segment_first_number = first_number + count if scene_sampling else round(segment_start * FPS)
+            for frame in _read_extracted_frames(segment_dir, thumbnail_path, segment_start, segment_first_number, timestamps):
+                count += 1
+                yield frame
+            # free the ephemeral storage as soon as a range has been handed over
+            shutil.rmtree(segment_dir)
+            if thumbnail_path:
+                os.remove(thumbnail_path)
+
+
+# Streaming extraction: FFmpeg writes the frames to its standard output (image2pipe) and each
+#  frame is handed over as soon as it is decoded, nothing is written to the ephemeral storage
+def stream_frames(video_path: str, with_thumbnails: bool = False, video_stream: BinaryIO | None = None,
+                  scene_sampling: SceneSampling | None = None, encoding: FrameEncoding | None = None,
+                  start: float = 0, duration: float | None = None, first_number: int = 0, keyframes_only: bool = False) -> Iterator[Frame]:
+    encoding = encoding or FrameEncoding()
+    thumbnail_output = None
+    pass_fds = ()
+    if with_thumbnails:
+        # thumbnails go through a second pipe, drained by a separate thread so FFmpeg never blocks on it
+        read_fd, write_fd = os.pipe()
+        thumbnail_output = f"pipe:{write_fd}"
+        pass_fds = (write_fd,)
+    ffmpeg_cmd = build_ffmpeg_command(video_path, "pipe:1", thumbnail_output, "-f image2pipe ", start, duration,
+                                      scene_sampling=scene_sampling, encoding=encoding, keyframes_only=keyframes_only)
+    logger.debug(f"Executing the following ffmpeg command: {_redact(ffmpeg_cmd)}")
+    process = _start_ffmpeg(ffmpeg_cmd, video_stream, stdout=subprocess.PIPE, pass_fds=pass_fds,
+                            stderr=subprocess.PIPE if scene_sampling else None)
+
+    thumbnails = None
+    if with_thumbnails:
+        os.close(write_fd)
+        thumbnails = queue.Queue()
+        threading.Thread(target=_queue_thumbnails, args=(read_fd, thumbnails), daemon=True).start()
+    timestamps = None
+    if scene_sampling:
+        timestamps = queue.Queue()
+        threading.Thread(target=_queue_timestamps, args=(process.stderr, timestamps), daemon=True).start()
+
+    completed = False
+    try:
+        for number, data in enumerate(split_image_stream(process.stdout, encoding.format), start=first_number + 1):
+            timestamp = start + timestamps.get() if timestamps else (number - 1) / FPS
+            yield Frame(number, timestamp, data, thumbnails.get() if thumbnails else None, encoding.extension)
+        completed = True
+    finally:
+        process.stdout.close()
+        if not completed:
+            process.kill()
+        return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, ffmpeg_cmd)
+
+
+# Fast-seek extraction: a short FFmpeg run per sample point (1/FPS seconds apart), seeking straight to it from the
+#  keyframe before it rather than decoding the whole video, up to 'workers' runs at a time (by default, one per
+#  CPU core). Frames are handed over in order, numbered and timed as with the fixed rate sampling.
+def seek_frames(video_path: str, with_thumbnails: bool = False, encoding: FrameEncoding | None = None,
+                start: float = 0, duration: float | None = None, first_number: int = 0, workers: int = 0) -> Iterator[Frame]:
+    encoding = encoding or FrameEncoding()
+    workers = workers or os.cpu_count() or 1
+    if duration is None:
+        duration = probe_duration(video_path) - start
+    numbers = range(first_number + 1, first_number + 1 + math.ceil(duration * FPS))
+    logger.info(f"Seeking to {len(numbers)} sample points with {workers} parallel FFmpeg processes")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # a bounded number of frames are extracted ahead of the one handed over
+        pending = deque()
+        for number in numbers:
+            pending.append(executor.submit(_seek_frame, video_path, number, with_thumbnails, encoding))
+            if len(pending) >= 2 * workers:
+                frame = pending.popleft().result()
+                if frame:
+                    yield frame
+        while pending:
+            frame = pending.popleft().result()
+            if frame:
+                yield frame
+
+
+# Split a stream of concatenated images of the given format into individual images
+def split_image_stream(stream: BinaryIO, image_format: str = "png") -> Iterator[bytes]:
+    if image_format == "jpeg":
+        return split_jpeg_stream(stream)
+    if image_format == "webp":
+        return split_webp_stream(stream)
+    return split_png_stream(stream)
+
+
+# Split a stream of concatenated PNG images into individual images, following the PNG chunks layout
+#  (8 bytes signature, then chunks made of a 4 bytes length, a 4 bytes type, the data and a 4 bytes CRC)
+def split_png_stream(stream: BinaryIO) -> Iterator[bytes]:
+    while True:
+        signature = stream.read(len(PNG_SIGNATURE))
+        if not signature:
+            return
+        if signature != PNG_SIGNATURE:
+            raise ValueError("Unexpected data in FFmpeg's output stream, expected a PNG image")
+        image = bytearray(signature)
+        while True:
+            chunk_header = _read_exactly(stream, 8)
+            chunk_length = int.from_bytes(chunk_header[:4], "big")
+            image += chunk_header
+            image += _read_exactly(stream, chunk_length + 4)
+            if chunk_header[4:8] == b"IEND":
+                break
+        yield bytes(image)
+
+
+# Split a stream of concatenated JPEG images into individual images. FFmpeg's JPEG images carry no embedded
+#  thumbnail and 0xFF bytes are escaped in the compressed data, so the first end of image marker ends the image
+def split_jpeg_stream(stream: BinaryIO) -> Iterator[bytes]:
+    buffer = b""
+    while True:
+        data = stream.read(64 * 1024)
+        if not data:
+            if buffer:
+                raise EOFError("FFmpeg's output stream ended in the middle of an image")
+            return
+        buffer += data
+        while True:
+            if len(buffer) >= 2 and not buffer.startswith(JPEG_START_MARKER):
+                raise ValueError("Unexpected data in FFmpeg's output stream, expected a JPEG image")
+            end = buffer.find(JPEG_END_MARKER, 2)
+            if end < 0:
+                break
+            yield buffer[:end + 2]
+            buffer = buffer[end + 2:]
+
+
+# Split a stream of concatenated WebP images into individual images, each being a RIFF container
+#  whose size is given in its header ('RIFF', 4 bytes little endian size, 'WEBP', ...)
+def split_webp_stream(stream: BinaryIO) -> Iterator[bytes]:
+    while True:
+        header = stream.read(8)
+        if not header:
+            return
+        if len(header) < 8 or header[:4] != b"RIFF":
+            raise ValueError("Unexpected data in FFmpeg's output stream, expected a WebP image")
+        size = int.from_bytes(header[4:8], "little")
+        # RIFF chunks are padded to an even size
+        yield header + _read_exactly(stream, size + size % 2)
+
+
+# Width and height of a PNG, JPEG or WebP image read from its header, (0, 0) if they can't be found
+def image_dimensions(data: bytes) -> tuple[int, int]:
+    if data.startswith(PNG_SIGNATURE) and data[12:16] == b"IHDR":
+        return int.from_bytes(data[16:20], "big"), int.from_bytes(data[20:24], "big")
+    if data.startswith(JPEG_START_MARKER):
+        # walk the segments up to the start of frame (SOFn, excluding the DHT, JPG and DAC markers sharing the range)
+        offset = 2
+        while offset + 9 <= len(data) and data[offset] == 0xFF:
+            marker = data[offset + 1]
+            if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+                return int.from_bytes(data[offset + 7:offset + 9], "big"), int.from_bytes(data[offset + 5:offset + 7], "big")
+            offset += 2 + int.from_bytes(data[offset + 2:offset + 4], "big")
+        return 0, 0
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        chunk = data[12:16]
+        if chunk == b"VP8 ":
+            return int.from_bytes(data[26:28], "little") & 0x3FFF, int.from_bytes(data[28:30], "little") & 0x3FFF
+        if chunk == b"VP8L":
+            bits = int.from_bytes(data[21:25], "little")
+            return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+        if chunk == b"VP8X":
+            return int.from_bytes(data[24:27], "little") + 1, int.from_bytes(data[27:30], "little") + 1
+    return 0, 0
+
+
+# Run FFmpeg writing the frames in 'image_dir', return the frames' timestamps with the scene change sampling
+def _extract_to_directory(video_path: str, image_dir: str, thumbnail_path: str | None = None, start: float = 0, duration: float | None = None,
+                          video_stream: BinaryIO | None = None, scene_sampling: SceneSampling | None = None,
+                          encoding: FrameEncoding | None = None, keyframes_only: bool = False) -> List[float] | None:
+    encoding = encoding or FrameEncoding()
+    ffmpeg_cmd = build_ffmpeg_command(video_path, f"{image_dir}/%05d.{encoding.extension}", thumbnail_path, start=start, duration=duration,
+                                      scene_sampling=scene_sampling, encoding=encoding, keyframes_only=keyframes_only)
+    logger.debug(f"Executing the following ffmpeg command: {_redact(ffmpeg_cmd)}")
+    process = _start_ffmpeg(ffmpeg_cmd, video_stream, stderr=subprocess.PIPE if scene_sampling else None)
+    timestamps = None
+    if scene_sampling:
+        timestamps_queue = queue.Queue()
+        _queue_timestamps(process.stderr, timestamps_queue)
+        timestamps = list(iter(timestamps_queue.get_nowait, None))
+    return_code = process.wait()
+    if return_code != 0:
+        raise subprocess.CalledProcessError(return_code, ffmpeg_cmd)
+    return timestamps
+
+
+# Extract the frame number 'number' of the fixed rate sampling by seeking to it, None past the end of the video
+def _seek_frame(video_path: str, number: int, with_thumbnails: bool, encoding: FrameEncoding) -> Frame | None:
+    timestamp = (number - 1) / FPS
+    thumbnail_output = None
+    pass_fds = ()
+    if with_thumbnails:
+        # a single thumbnail fits in the pipe's buffer, it is read once FFmpeg is done
+        read_fd, write_fd = os.pipe()
+        thumbnail_output = f"pipe:{write_fd}"
+        pass_fds = (write_fd,)
+    ffmpeg_cmd = build_ffmpeg_command(video_path, "pipe:1", thumbnail_output, "-f image2pipe ", timestamp, 1 / FPS, encoding=encoding)
+    logger.debug(f"Executing the following ffmpeg command: {_redact(ffmpeg_cmd)}")
+    try:
+        data = subprocess.run(shlex.split(ffmpeg_cmd), stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, pass_fds=pass_fds, check=True).stdout
+    finally:
+        if with_thumbnails:
+            os.close(write_fd)
+            with os.fdopen(read_fd, "rb") as stream:
+                thumbnail = stream.read(frame_dedup.THUMBNAIL_SIZE)
+    if not data:
+        return None
+    return Frame(number, timestamp, data, thumbnail if with_thumbnails else None, encoding.extension)
+
+
+# Start FFmpeg, feeding 'video_stream' (if any) into its standard input from a separate thread
+def _start_ffmpeg(ffmpeg_cmd: str, video_stream: BinaryIO | None = None, **popen_kwargs) -> subprocess.Popen:
+    process = subprocess.Popen(shlex.split(ffmpeg_cmd), stdin=subprocess.PIPE if video_stream else subprocess.DEVNULL, **popen_kwargs)
+    if video_stream:
+        threading.Thread(target=_feed_video, args=(video_stream, process.stdin), daemon=True).start()
+    return process
+
+
+def _feed_video(video_stream: BinaryIO, ffmpeg_stdin: BinaryIO) -> None:
+    try:
+        shutil.copyfileobj(video_stream, ffmpeg_stdin, 1024 * 1024)
+        ffmpeg_stdin.close()
+    except (BrokenPipeError, ValueError):
+        # FFmpeg stopped reading its input (e.g. it failed), its exit code tells why
+        pass
+
+
+# Read back the frames FFmpeg wrote in 'image_dir', 'start' being the time the extraction started from
+#  and 'first_number' the number of frames extracted before, 'timestamps' (if any) those logged by FFmpeg
+def _read_extracted_frames(image_dir: str, thumbnail_path: str | None = None, start: float = 0, first_number: int = 0,
+                           timestamps: List[float] | None = None) -> Iterator[Frame]:
+    thumbnails = None
+    if thumbnail_path:
+        thumbnail_file = open(thumbnail_path, "rb")
+        thumbnails = frame_dedup.read_thumbnails(thumbnail_file)
+    try:
+        for k, filename in enumerate(sorted(os.listdir(image_dir))): # force alphabetical order to have images in the right sequential order
+            name, extension = os.path.splitext(filename)
+            number = first_number + int(name)
+            timestamp = start + timestamps[k] if timestamps is not None else (number - 1) / FPS
+            with open(os.path.join(image_dir, filename), "rb") as image:
+                data = image.read()
+            yield Frame(number, timestamp, data, next(thumbnails) if thumbnails else None, extension[1:])
+    finally:
+        if thumbnail_path:
+            thumbnail_file.close()
+
+
+# Pick the frames' timestamps from the showinfo filter's log lines on FFmpeg's standard error,
+#  passing every other line through so that FFmpeg's messages still reach the logs
+def _queue_timestamps(stderr: BinaryIO, timestamps: queue.Queue) -> None:
+    for line in stderr:
+        if b"Parsed_showinfo" in line:
+            match = re.search(rb"pts_time:\s*(-?[\d.]+)", line)
+            if match:
+                timestamps.put(round(float(match.group(1)), 3))
+        else:
+            sys.stderr.buffer.write(line)
+    timestamps.put(None)
+
+
+# Frame rate given as a fraction by ffprobe ('30000/1001'), 0 when unknown ('0/0')
+def _parse_rate(rate: str | None) -> float:
+    numerator, _, denominator = (rate or "0/0").partition("/")
+    denominator = float(denominator or 1)
+    return float(numerator) / denominator if denominator else 0
+
+
+# Presigned URLs carry credentials in their query string, keep them out of the logs
+def _redact(command: str) -> str:
+    return re.sub(r"(https?://[^?\s']+)\?[^\s']*", r"\1?<redacted>", command)
+
+
+def _read_exactly(stream: BinaryIO, size: int) -> bytes:
+    data = stream.read(size)
+    if len(data) < size:
+        raise EOFError("FFmpeg's output stream ended in the middle of an image")
+    return data
+
+
+def _queue_thumbnails(read_fd: int, thumbnails: queue.Queue) -> None:
+    with os.fdopen(read_fd, "rb") as stream:
+        for thumbnail in frame_dedup.read_thumbnails(stream):
+            thumbnails.put(thumbnail)
+    thumbnails.put(None)
@@ -0,0 +1,60 @@
+import json
+from typing import List, Sequence
+from aws_lambda_powertools import Logger
+from lib import frame_extraction # type: ignore
+
+logger = Logger()
+
+MANIFEST_FILENAME = "manifest.jsonl"
+
+######################################## DEFINE FUNCTIONS ########################################
+# One line of the frame manifest, describing an uploaded still frame image
+def manifest_entry(frame) -> dict:
+    entry = {
+        "number": frame.number,
+        "filename": frame.filename,
+        "timestamp": frame.timestamp,
+        "size": frame.size,
+        "width": frame.width,
+        "height": frame.height,
+        "sha256": frame.sha256,
+    }
+    if frame.cell_timestamps:
+        entry["cell_timestamps"] = frame.cell_timestamps
+    if frame.change is not None:
+        entry["change"] = round(frame.change, 5)
+    if frame.crop_region:
+        entry["crop"] = {"filename": frame.crop_filename, "region": frame.crop_region, "size": frame.crop_size}
+    return entry
+
+
+# Write the frame manifest, one JSON line per frame in order, to 's3://bucket/key'. Returns the byte offset of
+#  every line (plus the end of the manifest), so that any range of frames can be read back with a ranged GET
+#  without passing the frames themselves around.
+def write_manifest(s3_client, frames: Sequence, bucket: str, key: str) -> List[int]:
+    lines = [(json.dumps(manifest_entry(frame), separators=(",", ":")) + "\n").encode("utf-8") for frame in frames]
+    offsets = [0]
+    for line in lines:
+        offsets.append(offsets[-1] + len(line))
+    s3_client.put_object(Bucket=bucket, Key=key, Body=b"".join(lines), ContentType="application/x-ndjson")
+    logger.debug(f"Wrote the manifest of {len(lines)} still frame images to 's3://{bucket}/{key}' ({offsets[-1]} bytes)")
+    return offsets
+
+
+# Read back the frames of the manifest at 's3://bucket/key' (their image data excluded), no frames if it doesn't exist
+def read_manifest(s3_client, bucket: str, key: str) -> List:
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()
+    except s3_client.exceptions.NoSuchKey:
+        return []
+    return [frame_from_entry(json.loads(line)) for line in body.decode("utf-8").splitlines() if line]
+
+
+# Frame described by a line of the manifest, without its image data
+def frame_from_entry(entry: dict):
+    extension = entry["filename"].rsplit(".", 1)[1]
+    crop = entry.get("crop") or {}
+    return frame_extraction.Frame(entry["number"], entry["timestamp"], None, extension=extension, size=entry["size"],
+                                  cell_timestamps=entry.get("cell_timestamps"), width=entry["width"], height=entry["height"],
+                                  sha256=entry["sha256"], crop_region=crop.get("region"), crop_size=crop.get("size", 0),
+                                  change=entry.get("change"))
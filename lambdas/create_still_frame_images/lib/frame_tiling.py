@@ -0,0 +1,96 @@
+import os, shlex, subprocess
+from dataclasses import dataclass
+from typing import Iterable, Iterator, List
+from aws_lambda_powertools import Logger
+from lib import frame_extraction # type: ignore
+
+logger = Logger()
+
+# Space between the cells of a tile, in pixels
+TILE_PADDING = 4
+
+# Grid the still frame images are packed into, e.g. 2x2 (4 frames per image) or 3x3 (9 frames per image).
+#  Frames fill the grid left to right, then top to bottom.
+@dataclass
+class TileGrid:
+    columns: int = 1
+    rows: int = 1
+
+    @property
+    def cells(self) -> int:
+        return self.columns * self.rows
+
+    def __str__(self) -> str:
+        return f"{self.columns}x{self.rows}"
+
+    # Parse a grid given as '<columns>x<rows>', e.g. '3x3'
+    @classmethod
+    def parse(cls, grid: str) -> "TileGrid":
+        columns, _, rows = grid.lower().partition("x")
+        tile_grid = cls(int(columns), int(rows or columns))
+        if tile_grid.columns < 1 or tile_grid.rows < 1:
+            raise ValueError(f"Invalid tile grid '{grid}'")
+        return tile_grid
+
+    # Encoding of the frames before they are tiled: lossless, so that the tile is only compressed once,
+    #  and downscaled so that the whole tile fits within the maximum size of the images
+    def cell_encoding(self, encoding: frame_extraction.FrameEncoding) -> frame_extraction.FrameEncoding:
+        cells_per_edge = max(self.columns, self.rows)
+        max_edge = max((encoding.max_edge - (cells_per_edge - 1) * TILE_PADDING) // cells_per_edge, 1) if encoding.max_edge else 0
+        return frame_extraction.FrameEncoding(format="png", max_edge=max_edge)
+
+
+######################################## DEFINE FUNCTIONS ########################################
+# Pack consecutive frames into tiles of 'grid.cells' frames, the last tile being left partly empty if need be.
+#  Tiles are frames themselves: they are named after, and take the timestamp of, their first frame and list the
+#  timestamps of all their frames in 'cell_timestamps'. When a font file is given, every frame is labelled with
+#  its timestamp in the tile (FFmpeg's drawtext filter needs a font file, Lambda doesn't come with any font).
+#  The frames are written to 'work_dir' for FFmpeg to read them.
+def tile_frames(frames: Iterable, grid: TileGrid, encoding: frame_extraction.FrameEncoding, work_dir: str,
+                font_path: str | None = None) -> Iterator:
+    os.makedirs(work_dir, exist_ok=True)
+    cells = []
+    for frame in frames:
+        cells.append(frame)
+        if len(cells) == grid.cells:
+            yield _tile(cells, grid, encoding, work_dir, font_path)
+            cells = []
+    if cells:
+        yield _tile(cells, grid, encoding, work_dir, font_path)
+
+
+# FFmpeg command stacking the images in 'cell_paths' into a single image
+def build_tile_command(cell_paths: List[str], grid: TileGrid, encoding: frame_extraction.FrameEncoding,
+                       labels: List[str] | None = None, font_path: str | None = None) -> str:
+    inputs = " ".join(f"-i {shlex.quote(path)}" for path in cell_paths)
+    if labels and font_path:
+        filter_graph = "".join(f"[{k}:v]{_label_filter(label, font_path)}[cell{k}];" for k, label in enumerate(labels))
+        filter_graph += "".join(f"[cell{k}]" for k in range(len(cell_paths)))
+    else:
+        filter_graph = "".join(f"[{k}:v]" for k in range(len(cell_paths)))
+    filter_graph += f"concat=n={len(cell_paths)}:v=1:a=0,tile={grid}:padding={TILE_PADDING}"
+    return f"ffmpeg -v error {inputs} -filter_complex {shlex.quote(filter_graph)} -frames:v 1 -f image2pipe {encoding.codec_options()}pipe:1"
+
+
+# Label a frame with 'label' in its top left corner, on a dark box to stay readable on any background
+def _label_filter(label: str, font_path: str) -> str:
+    return f"drawtext=fontfile='{font_path}':text='{label}':x=8:y=8:fontsize=h/16:fontcolor=white:box=1:boxcolor=black@0.6:boxborderw=4"
+
+
+def _tile(cells: List, grid: TileGrid, encoding: frame_extraction.FrameEncoding, work_dir: str, font_path: str | None = None):
+    cell_paths = []
+    for k, cell in enumerate(cells):
+        cell_path = os.path.join(work_dir, f"cell-{k}.{cell.extension}")
+        with open(cell_path, "wb") as f:
+            f.write(cell.data)
+        cell_paths.append(cell_path)
+    labels = [f"{cell.timestamp:g}s" for cell in cells]
+    ffmpeg_cmd = build_tile_command(cell_paths, grid, encoding, labels, font_path)
+    logger.debug(f"Executing the following ffmpeg command: {ffmpeg_cmd}")
+    data = subprocess.check_output(shlex.split(ffmpeg_cmd), stdin=subprocess.DEVNULL)
+    first = cells[0]
+    # the tile changed as much as its most changed frame
+    changes = [cell.change for cell in cells]
+    return frame_extraction.Frame(first.number, first.timestamp, data, extension=encoding.extension,
+                                  cell_timestamps=[cell.timestamp for cell in cells],
+                                  change=max(changes) if None not in changes else None)
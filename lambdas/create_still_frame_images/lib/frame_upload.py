@@ -0,0 +1,64 @@
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Iterable, List
+from botocore.config import Config
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+CONTENT_TYPES = {"png": "image/png", "jpg": "image/jpeg", "webp": "image/webp"}
+
+######################################## DEFINE FUNCTIONS ########################################
+# S3 client configuration for concurrent uploads
+#  - the connection pool must be at least as large as the number of upload threads, or threads wait for a connection
+#  - transient errors (throttling, 5xx, connection resets) are retried by botocore with exponential backoff
+#  - presigned URLs (e.g. for FFmpeg to read the video from) are signed with SigV4
+def s3_client_config(region: str, max_pool_connections: int = 16, max_attempts: int = 5) -> Config:
+    return Config(
+        region_name=region,
+        signature_version="s3v4",
+        max_pool_connections=max_pool_connections,
+        retries={"max_attempts": max_attempts, "mode": "standard"},
+    )
+
+
+# Upload the frames to 's3://bucket/prefix/<frame file name>' from a bounded pool of threads.
+#  Frames are consumed as they come (e.g. while FFmpeg is still decoding) and at most 'max_pending'
+#  of them wait for their upload at any time, which bounds the memory footprint. The frames are
+#  returned in their original order with their image data released. The cropped changed region of a
+#  frame, if any, is uploaded along with it. Any upload still failing after botocore's retries is
+#  logged and reported by raising an exception once all the uploads are done.
+def upload_frames(s3_client, frames: Iterable, bucket: str, prefix: str, max_workers: int = 16, max_pending: int = 0) -> List:
+    pending = threading.BoundedSemaphore(max_pending or 2 * max_workers)
+    uploaded = []
+    uploads: List[Future] = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for frame in frames:
+            pending.acquire()
+            upload = executor.submit(_upload_frame, s3_client, frame, bucket, prefix)
+            upload.add_done_callback(lambda _: pending.release())
+            uploads.append(upload)
+            uploaded.append(frame)
+
+    failed = [frame.filename for frame, upload in zip(uploaded, uploads) if upload.exception() is not None]
+    if failed:
+        raise RuntimeError(f"Failed to upload {len(failed)} still frame image(s) to 's3://{bucket}/{prefix}/': {', '.join(failed)}")
+    logger.debug(f"Uploaded {len(uploaded)} still frame images to 's3://{bucket}/{prefix}/'")
+    return uploaded
+
+
+def _upload_frame(s3_client, frame, bucket: str, prefix: str) -> None:
+    key = f"{prefix}/{frame.filename}"
+    try:
+        content_type = CONTENT_TYPES.get(frame.extension, "binary/octet-stream")
+        s3_client.put_object(Bucket=bucket, Key=key, Body=frame.data, ContentType=content_type)
+        frame.data = None # the image is on S3 now, no need to keep it in memory
+        if getattr(frame, "crop_data", None):
+            key = f"{prefix}/{frame.crop_filename}"
+            s3_client.put_object(Bucket=bucket, Key=key, Body=frame.crop_data, ContentType=content_type)
+            frame.crop_data = None
+    except Exception as e:
+        logger.error(f"Error uploading still frame image to 's3://{bucket}/{key}': {e}")
+        logger.error(traceback.format_exc())
+        raise
@@ -0,0 +1,53 @@
+import os
+import math
+import boto3
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from aws_lambda_powertools.utilities.typing import LambdaContext
+from aws_lambda_powertools.utilities.data_classes import S3Event
+from lib import frame_extraction, frame_upload # type: ignore
+
+logger = Logger()
+metrics = Metrics()
+
+aws_region = os.environ['AWS_REGION']
+s3_client = boto3.client('s3', config=frame_upload.s3_client_config(aws_region))
+
+@logger.inject_lambda_context
+@metrics.log_metrics
+def lambda_handler(event: S3Event, context: LambdaContext):
+    logger.debug('## EVENT')
+    logger.debug(event)
+
+    video_bucket = os.environ["VIDEO_BUCKET"]
+    # CHUNK_DURATION: length in seconds of the chunks of video extracted by separate invocations of the frame extraction,
+    #  each chunk's images being analysed as soon as the chunk is extracted
+    chunk_duration = int(os.environ.get("CHUNK_DURATION", "600"))
+
+    # Probe the video (see create_still_frame_images for the event's layout) from a presigned URL, ffprobe only reads its header
+    video_object_key = event["Input"]["Execution"]["Input"]["detail"]["object"]["key"]
+    video_url = s3_client.generate_presigned_url("get_object", Params={"Bucket": video_bucket, "Key": video_object_key}, ExpiresIn=300)
+    video_duration = frame_extraction.probe_duration(video_url)
+
+    # Split the video into chunks starting on a whole second, so that frames are numbered as in a single pass
+    chunks = [
+        {"index": k, "start": start, "duration": min(chunk_duration, video_duration - start)}
+        for k, start in enumerate(range(0, math.ceil(video_duration), chunk_duration))
+    ]
+    logger.info(f"Splitting video file 's3://{video_bucket}/{video_object_key}' ({video_duration:.0f}s) into {len(chunks)} chunks of {chunk_duration}s")
+    metrics.add_metric(name="VideoChunks", unit=MetricUnit.Count, value=len(chunks))
+
+    return {
+        "status": "OK",
+        "message": "Video planned!",
+        "video_duration": video_duration,
+        "chunks": chunks
+    }
+    # Example of 'chunks' below
+    '''
+        "chunks": [
+            {"index": 0, "start": 0, "duration": 600},
+            {"index": 1, "start": 600, "duration": 600},
+            {"index": 2, "start": 1200, "duration": 143.5}
+        ]
+    '''
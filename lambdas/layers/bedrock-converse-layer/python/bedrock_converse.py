@@ -0,0 +1,225 @@
+import botocore
+import os
+import random
+import time
+from typing import Callable
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import EphemeralMetrics, MetricUnit
+import rate_limiter # type: ignore
+
+logger = Logger()
+# metrics are flushed along with the handler's
+metrics = Metrics()
+
+# Helpers shared by the functions calling Bedrock's Converse API (image transcription and aggregation), shipped to
+#  them in the bedrock-converse layer. The Bedrock runtime and DynamoDB clients are the calling function's.
+
+# Requests to Bedrock that are throttled or fail on a transient error are retried with jittered exponential backoff
+#  BEDROCK_MAX_ATTEMPTS: attempts per request, BedrockUnavailableError is raised once they are exhausted
+#  BEDROCK_BACKOFF_BASE, BEDROCK_BACKOFF_MAX: the wait before attempt N is drawn between 0 and BASE * 2^N seconds, capped at MAX
+bedrock_max_attempts = int(os.environ.get("BEDROCK_MAX_ATTEMPTS", "6"))
+bedrock_backoff_base = float(os.environ.get("BEDROCK_BACKOFF_BASE", "1"))
+bedrock_backoff_max = float(os.environ.get("BEDROCK_BACKOFF_MAX", "60"))
+# Requests of all the concurrent invocations are paced by a token bucket per model, see rate_limiter
+#  RATE_LIMIT_TABLE: DynamoDB table holding the token buckets, empty (default) disables the rate limiting
+#  RATE_LIMIT_MAX_RATE, RATE_LIMIT_MIN_RATE: bounds of the request rate in requests per second
+#  RATE_LIMIT_BURST: requests let through at once after an idle period
+rate_limit_table = os.environ.get("RATE_LIMIT_TABLE", "")
+rate_limit = rate_limiter.RateLimit(
+    max_rate=float(os.environ.get("RATE_LIMIT_MAX_RATE", "2")),
+    min_rate=float(os.environ.get("RATE_LIMIT_MIN_RATE", "0.05")),
+    burst=float(os.environ.get("RATE_LIMIT_BURST", "5")),
+)
+
+# BEDROCK_STREAMING: 'true' to stream the model's responses (ConverseStream), reporting the time to first token and the
+#  output rate as metrics and passing the partial response on as it comes, 'false' (default) waits for the whole response
+# PARTIAL_WRITE_INTERVAL: seconds between two writes of the partial response to the transcripts table when streaming
+bedrock_streaming = os.environ.get("BEDROCK_STREAMING", "false").lower() == "true"
+partial_write_interval = float(os.environ.get("PARTIAL_WRITE_INTERVAL", "5"))
+
+# Prompts are cached across warm invocations of the function, they only change a few times a month
+#  PROMPT_CACHE_TTL: seconds a cached prompt is used before its latest version pointer ('v0') is read again,
+#   the prompt itself being read again only if a new version was published; 0 disables the cache
+prompt_cache_ttl = int(os.environ.get("PROMPT_CACHE_TTL", "300"))
+prompt_cache = {}
+
+# Errors worth retrying, the throttling ones lowering the shared request rate
+THROTTLING_ERRORS = {"ThrottlingException", "ServiceQuotaExceededException"}
+TRANSIENT_ERRORS = THROTTLING_ERRORS | {"ServiceUnavailableException", "InternalServerException", "ModelNotReadyException", "ModelTimeoutException"}
+
+# Raised when Bedrock keeps throttling or failing on transient errors, for the Step Functions task to be retried
+#  later rather than storing an empty analysis or summary
+class BedrockUnavailableError(Exception):
+    pass
+
+# Usage of every call to the model, reported as metrics and stored on the transcript items, with the metrics' units
+CALL_METRICS = {
+    "InputTokens": MetricUnit.Count,
+    "OutputTokens": MetricUnit.Count,
+    "LatencyMs": MetricUnit.Milliseconds,
+    "ImageCount": MetricUnit.Count,
+    "PayloadBytes": MetricUnit.Bytes,
+    "EstimatedCost": MetricUnit.NoUnit,
+}
+# Price of the models in USD per 1,000 input and output tokens (on-demand, at the time of writing), matched on the
+#  beginning of the model ID, the cross-region inference prefix (e.g. 'us.') being ignored
+MODEL_PRICES = {
+    "anthropic.claude-3-haiku": (0.00025, 0.00125),
+    "anthropic.claude-3-sonnet": (0.003, 0.015),
+    "anthropic.claude-3-5-sonnet": (0.003, 0.015),
+    "anthropic.claude-3-opus": (0.015, 0.075),
+    "amazon.nova-lite": (0.00006, 0.00024),
+    "amazon.nova-pro": (0.0008, 0.0032),
+    "meta.llama3-70b-instruct": (0.00265, 0.0035),
+    "ai21.jamba-instruct": (0.0005, 0.0007),
+}
+
+######################################## DEFINE FUNCTIONS ########################################
+# Call Bedrock's Converse API with 'bedrock_runtime_client', retrying throttled requests and transient errors with
+#  jittered exponential backoff (full jitter). Other errors, such as invalid requests, are raised right away. With
+#  RATE_LIMIT_TABLE, the requests take their turn from the model's token bucket through 'ddb_client'. With BEDROCK_STREAMING,
+#  the response is streamed, 'on_partial' receiving the partial response, and errors in the middle of the stream are retried too.
+def converse_with_retries(bedrock_runtime_client, ddb_client=None, on_partial: Callable[[str], None] | None = None, **request) -> dict:
+    rate_limited = bool(rate_limit_table) and ddb_client is not None
+    for attempt in range(1, bedrock_max_attempts + 1):
+        if rate_limited:
+            try:
+                waited = rate_limiter.acquire(ddb_client, rate_limit_table, request["modelId"], rate_limit)
+            except TimeoutError as e:
+                raise BedrockUnavailableError(str(e)) from e
+            if waited:
+                logger.debug(f"Waited {waited:.1f}s for the request rate of '{request['modelId']}'")
+        try:
+            response = _converse_stream(bedrock_runtime_client, request, on_partial) if bedrock_streaming else bedrock_runtime_client.converse(**request)
+            if rate_limited:
+                rate_limiter.record_success(ddb_client, rate_limit_table, request["modelId"], rate_limit)
+            return response
+        except botocore.exceptions.ClientError as e:
+            error_code = e.response.get("Error", {}).get("Code", "")
+            # errors in the middle of a stream are named after the stream's event, e.g. 'throttlingException'
+            error_code = error_code[:1].upper() + error_code[1:]
+            if error_code not in TRANSIENT_ERRORS:
+                raise
+            if error_code in THROTTLING_ERRORS and rate_limited:
+                rate_limiter.record_throttle(ddb_client, rate_limit_table, request["modelId"], rate_limit)
+            error = e
+        except (botocore.exceptions.ConnectionError, botocore.exceptions.ReadTimeoutError) as e:
+            error = e
+        if attempt == bedrock_max_attempts:
+            raise BedrockUnavailableError(f"Bedrock request failed after {attempt} attempts: {error}") from error
+        delay = random.uniform(0, min(bedrock_backoff_max, bedrock_backoff_base * 2 ** attempt))
+        logger.warning(f"Bedrock request failed ({error}), attempt {attempt} of {bedrock_max_attempts}, retrying in {delay:.1f}s")
+        time.sleep(delay)
+
+
+# Call Bedrock's ConverseStream API, assembling the response as it comes. 'on_partial' (if any) receives the text
+#  received so far every PARTIAL_WRITE_INTERVAL seconds. Returns the response in the same shape as the Converse API's.
+def _converse_stream(bedrock_runtime_client, request: dict, on_partial: Callable[[str], None] | None = None) -> dict:
+    started = time.perf_counter()
+    response = bedrock_runtime_client.converse_stream(**request)
+    chunks = []
+    first_token = None
+    last_partial = started
+    stop_reason = None
+    usage = {}
+    call_metrics = {}
+    for event in response["stream"]:
+        if "contentBlockDelta" in event:
+            now = time.perf_counter()
+            if first_token is None:
+                first_token = now
+                metrics.add_metric(name="TimeToFirstToken", unit=MetricUnit.Milliseconds, value=(first_token - started) * 1000)
+            chunks.append(event["contentBlockDelta"]["delta"].get("text", ""))
+            if on_partial and partial_write_interval > 0 and now - last_partial >= partial_write_interval:
+                on_partial("".join(chunks))
+                last_partial = now
+        elif "messageStop" in event:
+            stop_reason = event["messageStop"].get("stopReason")
+        elif "metadata" in event:
+            usage = event["metadata"].get("usage", {})
+            call_metrics = event["metadata"].get("metrics", {})
+    ended = time.perf_counter()
+    if first_token is not None and usage.get("outputTokens") and ended > first_token:
+        metrics.add_metric(name="OutputTokensPerSecond", unit=MetricUnit.CountPerSecond, value=usage["outputTokens"] / (ended - first_token))
+    return {"output": {"message": {"role": "assistant", "content": [{"text": "".join(chunks)}]}}, "stopReason": stop_reason, "usage": usage,
+            "metrics": call_metrics}
+
+
+# Latest version number and item of the prompt 'prompt_id' of 'prompt_table', from the cache while it is fresh
+def load_prompt_item(ddb_client, prompt_table: str, prompt_id: str) -> tuple[str, dict]:
+    cached = prompt_cache.get((prompt_table, prompt_id))
+    if cached and time.monotonic() < cached["expires"]:
+        return cached["version"], cached["item"]
+    version_zero = ddb_client.get_item(
+        TableName=prompt_table,
+        Key={
+            "PromptID": {"S": prompt_id},
+            "VersionID": {"S": "v0"}
+        }
+    )
+    latest_version = version_zero["Item"]["Latest"]["N"]
+    if cached and cached["version"] == latest_version:
+        # same version as the cached one, no need to read the prompt again
+        prompt_item = cached["item"]
+    else:
+        logger.debug(f"Reading version {latest_version} of prompt '{prompt_id}'")
+        prompt_item = ddb_client.get_item(
+            TableName=prompt_table,
+            Key={
+                "PromptID": {"S": prompt_id},
+                "VersionID": {"S": f"v{latest_version}"}
+            }
+        )["Item"]
+    if prompt_cache_ttl > 0:
+        prompt_cache[(prompt_table, prompt_id)] = {"version": latest_version, "item": prompt_item, "expires": time.monotonic() + prompt_cache_ttl}
+    return latest_version, prompt_item
+
+
+# Report the usage of a call to the model as metrics, with the model and the prompt version as dimensions, and add it
+#  to 'call_stats' (if any), which sums the usage of the calls made for an analysis under the names of CALL_METRICS
+def record_call_usage(response: dict, model_id: str, prompt_version: str | None, image_count: int, payload_bytes: int,
+                      call_stats: dict | None = None) -> None:
+    usage = response.get("usage", {})
+    call = {
+        "InputTokens": usage.get("inputTokens", 0),
+        "OutputTokens": usage.get("outputTokens", 0),
+        "LatencyMs": response.get("metrics", {}).get("latencyMs", 0),
+        "ImageCount": image_count,
+        "PayloadBytes": payload_bytes,
+        "EstimatedCost": estimate_cost(model_id, usage.get("inputTokens", 0), usage.get("outputTokens", 0)),
+    }
+    logger.debug(f"Usage of the call to '{model_id}': {call}")
+    # the dimensions only apply to these metrics, not to the handler's
+    call_metrics = EphemeralMetrics()
+    call_metrics.add_dimension(name="ModelID", value=model_id)
+    if prompt_version:
+        call_metrics.add_dimension(name="PromptVersion", value=prompt_version)
+    for name, unit in CALL_METRICS.items():
+        call_metrics.add_metric(name=name, unit=unit, value=call[name])
+    call_metrics.flush_metrics()
+    if call_stats is not None:
+        for name, value in call.items():
+            call_stats[name] = call_stats.get(name, 0) + value
+
+
+# Estimated cost in USD of a call to the model, 0 for the models missing from MODEL_PRICES
+def estimate_cost(model_id: str, input_tokens: int, output_tokens: int) -> float:
+    base_id = base_model_id(model_id)
+    input_price, output_price = next((prices for prefix, prices in MODEL_PRICES.items() if base_id.startswith(prefix)), (0, 0))
+    return (input_tokens * input_price + output_tokens * output_price) / 1000
+
+
+# DynamoDB attributes of the usage 'call_stats' (if any) summed by record_call_usage, for the transcript items
+def usage_attributes(call_stats: dict | None) -> dict:
+    return {name: {"N": _number(value)} for name, value in (call_stats or {}).items()}
+
+
+# Model ID without its cross-region inference prefix (e.g. 'us.')
+def base_model_id(model_id: str) -> str:
+    prefix, _, rest = model_id.partition(".")
+    return rest if prefix in ("us", "eu", "apac") else model_id
+
+
+# DynamoDB number of 'value', without an exponent
+def _number(value: float) -> str:
+    return str(value) if isinstance(value, int) else f"{value:.8f}".rstrip("0").rstrip(".")
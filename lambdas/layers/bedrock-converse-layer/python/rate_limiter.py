@@ -0,0 +1,100 @@
+import random, time
+from dataclasses import dataclass
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# Rate of the requests to a model, shared by all the concurrent invocations of the function through a token bucket
+#  stored as a DynamoDB item. The rate adapts to the account's quota: it is halved (down to 'min_rate') every time
+#  a request is throttled and raised by 'rate_step' (up to 'max_rate') after every successful request.
+#  'max_rate' and 'min_rate' are in requests per second, 'max_rate' being the initial rate as well
+#  'burst' is the number of requests the bucket lets through at once, after an idle period
+@dataclass
+class RateLimit:
+    max_rate: float = 2
+    min_rate: float = 0.05
+    rate_step: float = 0.05
+    burst: float = 5
+
+
+######################################## DEFINE FUNCTIONS ########################################
+# Take a token from the bucket 'bucket_id' of 'table', waiting for one if the bucket is empty.
+#  Returns the time waited in seconds, raises TimeoutError when no token came within 'max_wait' seconds.
+def acquire(ddb_client, table: str, bucket_id: str, limit: RateLimit, max_wait: float = 300) -> float:
+    waited = 0.0
+    while True:
+        now = time.time()
+        item = ddb_client.get_item(TableName=table, Key={"BucketID": {"S": bucket_id}}, ConsistentRead=True).get("Item")
+        if item:
+            rate = float(item["Rate"]["N"])
+            updated = item["Updated"]["N"]
+            tokens = min(limit.burst, float(item["Tokens"]["N"]) + (now - float(updated)) * rate)
+        else:
+            rate, updated, tokens = limit.max_rate, None, limit.burst
+        if tokens >= 1:
+            try:
+                _put_bucket(ddb_client, table, bucket_id, rate, tokens - 1, now, updated)
+                return waited
+            except ddb_client.exceptions.ConditionalCheckFailedException:
+                # another invocation took a token in the meantime, try again shortly
+                delay = random.uniform(0, 0.05)
+        else:
+            # wait for the next token, with some jitter so that waiting invocations don't all wake up at once
+            delay = (1 - tokens) / rate * random.uniform(1, 1.5)
+        if waited + delay > max_wait:
+            raise TimeoutError(f"No token in bucket '{bucket_id}' after waiting {waited:.1f}s")
+        time.sleep(delay)
+        waited += delay
+
+
+# Halve the rate of the bucket and empty it, so that every invocation backs off
+def record_throttle(ddb_client, table: str, bucket_id: str, limit: RateLimit) -> None:
+    rate = _update_rate(ddb_client, table, bucket_id, limit, lambda rate: max(rate / 2, limit.min_rate), empty=True)
+    if rate is not None:
+        logger.info(f"Lowered the request rate of bucket '{bucket_id}' to {rate:.2f} requests/s")
+
+
+# Raise the rate of the bucket a little, unless it already is at its maximum
+def record_success(ddb_client, table: str, bucket_id: str, limit: RateLimit) -> None:
+    _update_rate(ddb_client, table, bucket_id, limit, lambda rate: min(rate + limit.rate_step, limit.max_rate))
+
+
+# Change the rate of the bucket to 'new_rate(rate)', the tokens being refilled up to now at the former rate (or
+#  emptied). The bucket is written with the same compare-and-set on 'Updated' as acquire, so that neither of them
+#  undoes the other's change; the update is tried again (up to 'attempts' times) when the bucket changed in the
+#  meantime. Returns the new rate, None if the bucket doesn't exist, needs no change or kept changing.
+def _update_rate(ddb_client, table: str, bucket_id: str, limit: RateLimit, new_rate, empty: bool = False, attempts: int = 5) -> float | None:
+    for _ in range(attempts):
+        now = time.time()
+        item = ddb_client.get_item(TableName=table, Key={"BucketID": {"S": bucket_id}}, ConsistentRead=True).get("Item")
+        if not item:
+            return None
+        rate = float(item["Rate"]["N"])
+        updated = item["Updated"]["N"]
+        if new_rate(rate) == rate and not empty:
+            return None
+        tokens = 0 if empty else min(limit.burst, float(item["Tokens"]["N"]) + (now - float(updated)) * rate)
+        try:
+            _put_bucket(ddb_client, table, bucket_id, new_rate(rate), tokens, now, updated)
+            return new_rate(rate)
+        except ddb_client.exceptions.ConditionalCheckFailedException:
+            # another invocation took a token or changed the rate in the meantime, start again from its update
+            time.sleep(random.uniform(0, 0.05))
+    return None
+
+
+# Write the bucket, provided it wasn't updated since 'previous_update' (it must not exist when that is None)
+def _put_bucket(ddb_client, table: str, bucket_id: str, rate: float, tokens: float, updated: float, previous_update: str | None) -> None:
+    condition = {"ConditionExpression": "attribute_not_exists(BucketID)"}
+    if previous_update is not None:
+        condition = {"ConditionExpression": "Updated = :updated", "ExpressionAttributeValues": {":updated": {"N": previous_update}}}
+    ddb_client.put_item(
+        TableName=table,
+        Item={
+            "BucketID": {"S": bucket_id},
+            "Rate": {"N": str(rate)},
+            "Tokens": {"N": str(tokens)},
+            "Updated": {"N": repr(updated)},
+        },
+        **condition,
+    )
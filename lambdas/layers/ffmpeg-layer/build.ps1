@@ -31,10 +31,12 @@ New-Item -ItemType Directory -Force -Path ".\build" | Out-Null
 7z x "ffmpeg-release-amd64-static.tar.xz" 
 tar -xf "ffmpeg-release-amd64-static.tar" -C ".\build"
 
-# Create ffmpeg directory and copy the ffmpeg binary
+# Create ffmpeg directory and copy the ffmpeg and ffprobe binaries
 New-Item -ItemType Directory -Force -Path ".\ffmpeg\bin" | Out-Null
 $buildpath = Resolve-Path ".\build\ffmpeg-*-amd64-static\ffmpeg" | Select -ExpandProperty Path
 Copy-Item -Path $buildpath -Destination ".\ffmpeg\bin\" -Force
+$buildpath = Resolve-Path ".\build\ffmpeg-*-amd64-static\ffprobe" | Select -ExpandProperty Path
+Copy-Item -Path $buildpath -Destination ".\ffmpeg\bin\" -Force
 
 # Change to ffmpeg directory and create a zip file
 Set-Location -Path ".\ffmpeg"
@@ -25,5 +25,6 @@ tar xf ffmpeg-release-amd64-static.tar.xz --directory .build
 
 mkdir -p ffmpeg/bin
 cp .build/ffmpeg-*-amd64-static/ffmpeg ffmpeg/bin/
+cp .build/ffmpeg-*-amd64-static/ffprobe ffmpeg/bin/
 cd ffmpeg
 zip -r ../ffmpeg.zip .
\ No newline at end of file
@@ -0,0 +1,75 @@
+import json
+import os
+import boto3
+from botocore.config import Config
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from lib import batch_inference # type: ignore
+
+logger = Logger()
+metrics = Metrics()
+
+aws_region = os.environ['AWS_REGION']
+s3_client = boto3.client('s3', region_name=aws_region)
+bedrock_client = boto3.client('bedrock', region_name=aws_region)
+# the requests of the local jobs are retried by the client, which also paces them when they are throttled
+bedrock_runtime_client = boto3.client('bedrock-runtime', config=Config(read_timeout=1000, region_name=aws_region,
+                                                                       retries={"mode": "adaptive", "max_attempts": 10}))
+
+# BATCH_JOB_API: 'bedrock' (default) submits the jobs to Bedrock's batch inference, 'local' runs them through a
+#  LocalModelInvocationJobs, as are the jobs with fewer records than batch inference accepts
+# BATCH_JOB_MIN_RECORDS: fewest records of a batch inference job (100 at the time of writing)
+# BATCH_JOB_ROLE_ARN: service role batch inference assumes to read the records and write the results
+# BATCH_FILE_MAX_RECORDS, BATCH_FILE_MAX_BYTES: most records and bytes of an input file of a job, within batch
+#  inference's quotas on input files (1 GB at the time of writing)
+# BATCH_JOB_LOCAL_WORKERS: records of a local job sent to the model at the same time
+batch_job_api = os.environ.get("BATCH_JOB_API", "bedrock")
+batch_job_min_records = int(os.environ.get("BATCH_JOB_MIN_RECORDS", "100"))
+batch_job_role_arn = os.environ.get("BATCH_JOB_ROLE_ARN", "")
+batch_file_max_records = int(os.environ.get("BATCH_FILE_MAX_RECORDS", "10000"))
+batch_file_max_bytes = int(os.environ.get("BATCH_FILE_MAX_BYTES", str(1000 * 1000 * 1000)))
+local_jobs = batch_inference.LocalModelInvocationJobs(s3_client, bedrock_runtime_client, int(os.environ.get("BATCH_JOB_LOCAL_WORKERS", "4")))
+
+# Batch inference mode: submit the records written by prepare_batch_record as one model invocation job, or
+#  (when the event carries the 'job' returned by a previous invocation) check on the job. Local jobs are run by
+#  these invocations, each one carrying on with the job until it is about to time out.
+@logger.inject_lambda_context
+@metrics.log_metrics
+def lambda_handler(event, context):
+    logger.debug('## ENVIRONMENT VARIABLES')
+    logger.debug(json.dumps(dict(os.environ), indent=4))
+    logger.debug('## EVENT')
+    logger.debug(event)
+    logger.debug('## CONTEXT')
+    logger.debug(context)
+
+    image_bucket_name = os.environ["IMAGE_BUCKET"]
+    model_id = os.environ["ANALYSIS_MODEL_ID"]
+
+    if "job" in event:
+        job = event["job"]
+        client = local_jobs if job["local"] else bedrock_client
+        if job["local"]:
+            local_jobs.run_job(job["job_arn"], context.get_remaining_time_in_millis)
+        job["status"] = batch_inference.job_status(client, job["job_arn"])
+    else:
+        execution_name = event["execution_name"]
+        records = batch_inference.count_records(s3_client, image_bucket_name, execution_name)
+        job = {"execution_name": execution_name, "records": records, "local": batch_job_api == "local" or records < batch_job_min_records}
+        if not records:
+            # every batch was analysed without the model (e.g. idle batches)
+            job.update(job_arn=None, status="Completed")
+        else:
+            if job["local"] and batch_job_api != "local":
+                logger.info(f"Only {records} records, fewer than batch inference accepts ({batch_job_min_records}), running the job locally")
+            client = local_jobs if job["local"] else bedrock_client
+            batch_inference.pack_records(s3_client, image_bucket_name, execution_name, batch_file_max_records, batch_file_max_bytes)
+            job["job_arn"] = batch_inference.submit_job(client, image_bucket_name, execution_name, model_id, batch_job_role_arn)
+            if job["local"]:
+                local_jobs.run_job(job["job_arn"], context.get_remaining_time_in_millis)
+            job["status"] = batch_inference.job_status(client, job["job_arn"])
+            metrics.add_metric(name="BatchInferenceRecords", unit=MetricUnit.Count, value=records)
+    job["done"] = job["status"] not in batch_inference.ACTIVE_JOB_STATUSES
+    logger.info(f"Batch inference job '{job['job_arn']}' of {job['records']} records is '{job['status']}'")
+
+    return job
@@ -0,0 +1,60 @@
+import json
+import os
+import boto3
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from lib import transcribe_images_converse as ai_lib # type: ignore
+from lib import batch_inference # type: ignore
+
+logger = Logger()
+metrics = Metrics()
+
+aws_region = os.environ['AWS_REGION']
+s3_client = boto3.client('s3', region_name=aws_region)
+
+# Batch inference mode: store the analyses of the execution's batch inference job in DynamoDB, under the same
+#  sequence IDs as transcribe_images, and return them in order for the aggregation
+@logger.inject_lambda_context
+@metrics.log_metrics
+def lambda_handler(event, context):
+    logger.debug('## ENVIRONMENT VARIABLES')
+    logger.debug(json.dumps(dict(os.environ), indent=4))
+    logger.debug('## EVENT')
+    logger.debug(event)
+    logger.debug('## CONTEXT')
+    logger.debug(context)
+
+    image_bucket_name = os.environ["IMAGE_BUCKET"]
+    model_id = os.environ["ANALYSIS_MODEL_ID"]
+    execution_name = event["execution_name"]
+
+    batches = batch_inference.read_batches(s3_client, image_bucket_name, execution_name)
+    results = batch_inference.read_results(s3_client, image_bucket_name, execution_name)
+    analyses = []
+    for batch in batches:
+        batch_info = batch["batch_info"]
+        analysis = batch.get("analysis") or results.get(batch["record_id"])
+        # analyses written without the model (e.g. idle batches) come with the batch
+        analysis_model_id = None if batch.get("analysis") else model_id
+        if not analysis:
+            logger.info(f"Image analysis for video with ID '{batch_info['video_id']}' is incomplete, no result for record '{batch['record_id']}' "
+                        f"of sequence with ID '{batch_info['sequence_id']}'... check the batch inference job's output")
+            metrics.add_metric(name="ImageAnalysisError", unit=MetricUnit.Count, value=1)
+            analysis = "Empty analysis due to image analysis error - check out the batch inference job's output"
+        # store the sequence analysis in DynamoDB, along with the model it comes from
+        ai_lib.store_analysis(batch_info["video_id"], batch_info["sequence_id"], analysis, batch["prompt_version"], model_id=analysis_model_id)
+        analyses.append({
+            "video_id": batch_info["video_id"],
+            "video_s3_uri": batch_info["video_s3_uri"],
+            "video_url": batch_info["video_url"],
+            "sequence_id": batch_info["sequence_id"],
+            "model_id": analysis_model_id,
+            "description": analysis
+        })
+    logger.info(f"###### Stored the analyses of {len(analyses)} sequences ######")
+
+    return {
+        "status": "OK",
+        "message": "Batch results collected!",
+        "analyses": analyses
+    }
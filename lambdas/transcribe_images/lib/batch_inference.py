@@ -0,0 +1,312 @@
+import base64
+import json
+import os
+import re
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+from aws_lambda_powertools import Logger
+
+logger = Logger()
+
+# Files of the batch inference jobs in the image bucket, one folder per execution of the pipeline:
+#  'records/' holds the record of every batch of images as it is prepared (one file each, as the batches are
+#  prepared concurrently), 'input/' the JSONL files the records are packed into for the job, 'batches/' the
+#  sequence each record is about and 'output/' the results written by the job
+BATCH_INFERENCE_PREFIX = "batch-inference"
+
+# Size of the parts the input files are uploaded in (S3 multipart uploads take parts of 5 MiB at least)
+#  and number of records read at the same time while packing them
+INPUT_PART_SIZE = 8 * 1024 * 1024
+PACK_READ_WORKERS = 10
+
+# Statuses of a model invocation job still on its way, and of a job whose results can be collected
+ACTIVE_JOB_STATUSES = {"Submitted", "Validating", "Scheduled", "InProgress", "Stopping"}
+DONE_JOB_STATUSES = {"Completed", "PartiallyCompleted"}
+
+# Batch inference takes the request bodies of the InvokeModel API rather than the Converse API's, i.e. the
+#  Anthropic Messages API for Claude models
+ANTHROPIC_VERSION = "bedrock-2023-05-31"
+MEDIA_TYPES = {"png": "image/png", "jpeg": "image/jpeg", "gif": "image/gif", "webp": "image/webp"}
+
+######################################## DEFINE FUNCTIONS ########################################
+# Prefix of the files of the batch inference job of the pipeline's execution 'execution_name'
+def execution_prefix(execution_name: str) -> str:
+    return f"{BATCH_INFERENCE_PREFIX}/{execution_name}"
+
+
+# ID of the record of the sequence 'sequence_id' ('sequence-K' or 'sequence-C-K' when the video is extracted in
+#  chunks), as the 11 alphanumeric characters batch inference expects. The IDs sort in the order of the sequences.
+def record_id(sequence_id: str) -> str:
+    numbers = [int(number) for number in re.findall(r"\d+", sequence_id)]
+    chunk, sequence = numbers if len(numbers) == 2 else (0, numbers[-1])
+    return f"{chunk:05d}{sequence:06d}"
+
+
+# Body of the InvokeModel request equivalent to the Converse request analyse_images sends for 'content'
+def model_input(model_id: str, content: List[dict], prompt: str, max_tokens: int = 4096, temperature: float = 0, top_p: float = 0.999,
+                top_k: int = 250) -> dict:
+    if "anthropic.claude" not in model_id:
+        raise ValueError(f"Batch inference of model '{model_id}' is not supported, only Anthropic Claude models are")
+    blocks = []
+    for block in content:
+        if "image" in block:
+            blocks.append({"type": "image", "source": {"type": "base64", "media_type": MEDIA_TYPES[block["image"]["format"]],
+                                                       "data": base64.b64encode(block["image"]["source"]["bytes"]).decode("ascii")}})
+        else:
+            blocks.append({"type": "text", "text": block["text"]})
+    return {
+        "anthropic_version": ANTHROPIC_VERSION,
+        "max_tokens": max_tokens,
+        "temperature": temperature,
+        "top_p": top_p,
+        "top_k": top_k,
+        "system": prompt,
+        "messages": [{"role": "user", "content": blocks}],
+    }
+
+
+# Text of the response of the model to a record, None if there is none
+def output_text(model_output: dict) -> str | None:
+    texts = [block["text"] for block in model_output.get("content", []) if block.get("type") == "text"]
+    return "".join(texts) if texts else None
+
+
+# Write the record of a batch of images, to be packed into the job's input by pack_records
+def write_record(s3_client, bucket: str, execution_name: str, record_id: str, model_input: dict) -> None:
+    record = json.dumps({"recordId": record_id, "modelInput": model_input})
+    s3_client.put_object(Bucket=bucket, Key=f"{execution_prefix(execution_name)}/records/{record_id}.jsonl", Body=record.encode("utf-8"),
+                         ContentType="application/jsonl")
+
+
+# Write what the record 'record_id' is about: the 'batch_info' of the sequence and the version of the prompt it was
+#  built with, along with its 'analysis' when the analysis didn't need the model (e.g. an idle batch)
+def write_batch(s3_client, bucket: str, execution_name: str, record_id: str, batch_info: dict, prompt_version: str,
+                analysis: str | None = None) -> None:
+    batch = {"record_id": record_id, "batch_info": batch_info, "prompt_version": prompt_version}
+    if analysis is not None:
+        batch["analysis"] = analysis
+    s3_client.put_object(Bucket=bucket, Key=f"{execution_prefix(execution_name)}/batches/{record_id}.json", Body=json.dumps(batch).encode("utf-8"),
+                         ContentType="application/json")
+
+
+# Number of records written by write_record
+def count_records(s3_client, bucket: str, execution_name: str) -> int:
+    return sum(1 for key in _list_keys(s3_client, bucket, f"{execution_prefix(execution_name)}/records/") if key.endswith(".jsonl"))
+
+
+# Pack the records written by write_record into the job's input, in the order of the sequences: the records are
+#  appended to shared JSONL files ('part-00000.jsonl'...), a new file being started before one would exceed
+#  'max_records' records or 'max_bytes' bytes (batch inference's quotas on input files). Returns the keys of the files.
+#  Packing again (e.g. when the task is retried) writes the same files.
+def pack_records(s3_client, bucket: str, execution_name: str, max_records: int, max_bytes: int) -> List[str]:
+    prefix = execution_prefix(execution_name)
+    record_keys = sorted(key for key in _list_keys(s3_client, bucket, f"{prefix}/records/") if key.endswith(".jsonl"))
+    input_keys = []
+    writer = None
+    with ThreadPoolExecutor(max_workers=PACK_READ_WORKERS) as executor:
+        # the records are read a few at a time, so that only those being appended are held in memory
+        for start in range(0, len(record_keys), PACK_READ_WORKERS):
+            keys = record_keys[start:start + PACK_READ_WORKERS]
+            for record in executor.map(lambda key: s3_client.get_object(Bucket=bucket, Key=key)["Body"].read().rstrip(b"\n") + b"\n", keys):
+                if writer and (writer.records >= max_records or writer.size + len(record) > max_bytes):
+                    writer.close()
+                    writer = None
+                if not writer:
+                    input_keys.append(f"{prefix}/input/part-{len(input_keys):05d}.jsonl")
+                    writer = _MultipartWriter(s3_client, bucket, input_keys[-1])
+                writer.write(record)
+    if writer:
+        writer.close()
+    logger.info(f"Packed {len(record_keys)} records into {len(input_keys)} input files")
+    return input_keys
+
+
+# The batches written by write_batch, in the order of the sequences
+def read_batches(s3_client, bucket: str, execution_name: str) -> List[dict]:
+    keys = sorted(_list_keys(s3_client, bucket, f"{execution_prefix(execution_name)}/batches/"))
+    return [json.loads(s3_client.get_object(Bucket=bucket, Key=key)["Body"].read()) for key in keys]
+
+
+# Text of the response to every record in the job's output, None for the records that failed
+def read_results(s3_client, bucket: str, execution_name: str) -> Dict[str, str | None]:
+    results = {}
+    for key in _list_keys(s3_client, bucket, f"{execution_prefix(execution_name)}/output/"):
+        if not key.endswith(".jsonl.out"):
+            continue
+        for line in s3_client.get_object(Bucket=bucket, Key=key)["Body"].iter_lines():
+            if not line:
+                continue
+            result = json.loads(line)
+            if "error" in result:
+                logger.error(f"Record '{result['recordId']}' failed: {result['error']}")
+                results[result["recordId"]] = None
+            else:
+                results[result["recordId"]] = output_text(result.get("modelOutput", {}))
+    return results
+
+
+# Submit the job's input to 'client' (Bedrock's API or a LocalModelInvocationJobs), returns the ARN of the job
+def submit_job(client, bucket: str, execution_name: str, model_id: str, role_arn: str) -> str:
+    # job names are limited to 63 characters out of letters, digits and dashes
+    job_name = re.sub(r"[^a-zA-Z0-9-]", "-", f"transcribe-images-{execution_name}")[:63].rstrip("-")
+    response = client.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=role_arn,
+        modelId=model_id,
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": f"s3://{bucket}/{execution_prefix(execution_name)}/input/", "s3InputFormat": "JSONL"}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": f"s3://{bucket}/{execution_prefix(execution_name)}/output/"}},
+    )
+    logger.info(f"Submitted batch inference job '{response['jobArn']}'")
+    return response["jobArn"]
+
+
+# Status of the job 'job_arn' of 'client'
+def job_status(client, job_arn: str) -> str:
+    job = client.get_model_invocation_job(jobIdentifier=job_arn)
+    if job["status"] not in ACTIVE_JOB_STATUSES | DONE_JOB_STATUSES:
+        logger.error(f"Batch inference job '{job_arn}' ended with status '{job['status']}': {job.get('message', '')}")
+    return job["status"]
+
+
+def _list_keys(s3_client, bucket: str, prefix: str) -> List[str]:
+    paginator = s3_client.get_paginator("list_objects_v2")
+    return [item["Key"] for page in paginator.paginate(Bucket=bucket, Prefix=prefix) for item in page.get("Contents", [])]
+
+
+def _split_s3_uri(s3_uri: str) -> tuple[str, str]:
+    bucket, _, key = s3_uri.removeprefix("s3://").partition("/")
+    return bucket, key
+
+
+# JSONL file written to S3 by a multipart upload, the lines being buffered into parts of INPUT_PART_SIZE
+class _MultipartWriter:
+    def __init__(self, s3_client, bucket: str, key: str):
+        self.s3_client = s3_client
+        self.bucket = bucket
+        self.key = key
+        self.records = 0
+        self.size = 0
+        self.buffer = bytearray()
+        self.parts = []
+        self.upload_id = s3_client.create_multipart_upload(Bucket=bucket, Key=key, ContentType="application/jsonl")["UploadId"]
+
+    def write(self, line: bytes) -> None:
+        self.buffer += line
+        self.records += 1
+        self.size += len(line)
+        if len(self.buffer) >= INPUT_PART_SIZE:
+            self._upload_part()
+
+    def close(self) -> None:
+        try:
+            if self.buffer or not self.parts:
+                self._upload_part()
+            self.s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                     MultipartUpload={"Parts": self.parts})
+        except Exception:
+            self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+            raise
+
+    def _upload_part(self) -> None:
+        part_number = len(self.parts) + 1
+        response = self.s3_client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id, PartNumber=part_number,
+                                              Body=bytes(self.buffer))
+        self.parts.append({"PartNumber": part_number, "ETag": response["ETag"]})
+        self.buffer = bytearray()
+
+
+# Local stand-in for Bedrock's model invocation job API (create_model_invocation_job, get_model_invocation_job): the
+#  records are sent to the InvokeModel API of 'bedrock_runtime_client', 'max_workers' at a time, and the results are
+#  written where a batch inference job writes them. Meant for jobs too small for batch inference and for running the
+#  pipeline without it. Creating a job only registers it, the records are processed by run_job, a slice of
+#  'max_workers' * 4 records at a time, the job's progress being saved after every slice. Each call to run_job
+#  carries on from there until the calling function is about to time out, so a job can span several invocations.
+class LocalModelInvocationJobs:
+    def __init__(self, s3_client, bedrock_runtime_client, max_workers: int = 4, time_margin_ms: int = 60000):
+        self.s3_client = s3_client
+        self.bedrock_runtime_client = bedrock_runtime_client
+        self.max_workers = max_workers
+        self.slice_records = max_workers * 4
+        self.time_margin_ms = time_margin_ms
+
+    def create_model_invocation_job(self, jobName: str, modelId: str, inputDataConfig: dict, outputDataConfig: dict, **kwargs) -> dict:
+        input_bucket, input_prefix = _split_s3_uri(inputDataConfig["s3InputDataConfig"]["s3Uri"])
+        output_uri = outputDataConfig["s3OutputDataConfig"]["s3Uri"]
+        job_arn = f"local:{output_uri}{jobName}"
+        input_keys = sorted(key for key in _list_keys(self.s3_client, input_bucket, input_prefix) if key.endswith(".jsonl"))
+        # the progress of the job: the input file being processed, where its next record starts, and the number of
+        #  result files written so far
+        job = {"jobArn": job_arn, "jobName": jobName, "modelId": modelId, "status": "Submitted", "message": "",
+               "inputBucket": input_bucket, "inputKeys": input_keys, "file": 0, "offset": 0, "part": 0, "records": 0, "failed": 0}
+        self._put_job(job)
+        return {"jobArn": job_arn}
+
+    def get_model_invocation_job(self, jobIdentifier: str) -> dict:
+        output_bucket, job_key = _split_s3_uri(jobIdentifier.removeprefix("local:"))
+        return json.loads(self.s3_client.get_object(Bucket=output_bucket, Key=f"{job_key}/local-job.json")["Body"].read())
+
+    # Process the records of the job 'job_arn' left to process, until they are all processed or fewer than
+    #  'time_margin_ms' milliseconds (plus twice the time the last slice took) are left according to 'remaining_time_ms'
+    def run_job(self, job_arn: str, remaining_time_ms: Callable[[], int]) -> dict:
+        job = self.get_model_invocation_job(job_arn)
+        if job["status"] not in ACTIVE_JOB_STATUSES:
+            return job
+        job["status"] = "InProgress"
+        output_bucket, job_key = _split_s3_uri(job_arn.removeprefix("local:"))
+        slice_ms = 0
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while job["file"] < len(job["inputKeys"]):
+                if remaining_time_ms() < self.time_margin_ms + 2 * slice_ms:
+                    logger.info(f"Stopping local job '{job_arn}' after {job['records']} records, it carries on in the next invocation")
+                    break
+                started = time.monotonic()
+                input_key = job["inputKeys"][job["file"]]
+                lines, next_offset, end_of_file = self._read_lines(job["inputBucket"], input_key, job["offset"], self.slice_records)
+                if lines:
+                    results = list(executor.map(lambda line: self._invoke(job["modelId"], json.loads(line)), lines))
+                    output_key = f"{job_key}/{os.path.basename(input_key).removesuffix('.jsonl')}-{job['part']:05d}.jsonl.out"
+                    self.s3_client.put_object(Bucket=output_bucket, Key=output_key,
+                                              Body="\n".join(json.dumps(result) for result in results).encode("utf-8"))
+                    job["part"] += 1
+                    job["records"] += len(results)
+                    job["failed"] += sum(1 for result in results if "error" in result)
+                job["file"], job["offset"] = (job["file"] + 1, 0) if end_of_file else (job["file"], next_offset)
+                self._put_job(job)
+                slice_ms = (time.monotonic() - started) * 1000
+            else:
+                job["status"] = "Completed" if not job["failed"] else "PartiallyCompleted" if job["failed"] < job["records"] else "Failed"
+                job["message"] = f"{job['records'] - job['failed']} of {job['records']} records processed locally"
+                self._put_job(job)
+        return job
+
+    # Up to 'count' lines of 'key' from the byte 'offset' on, along with the offset of the next line and whether
+    #  the end of the file was reached
+    def _read_lines(self, bucket: str, key: str, offset: int, count: int) -> tuple[List[bytes], int, bool]:
+        response = self.s3_client.get_object(Bucket=bucket, Key=key, **({"Range": f"bytes={offset}-"} if offset else {}))
+        lines = []
+        consumed = 0
+        try:
+            for line in response["Body"].iter_lines(keepends=True):
+                consumed += len(line)
+                if line.strip():
+                    lines.append(line)
+                if len(lines) == count:
+                    break
+        finally:
+            response["Body"].close()
+        return lines, offset + consumed, consumed >= response["ContentLength"]
+
+    def _put_job(self, job: dict) -> None:
+        output_bucket, job_key = _split_s3_uri(job["jobArn"].removeprefix("local:"))
+        self.s3_client.put_object(Bucket=output_bucket, Key=f"{job_key}/local-job.json", Body=json.dumps(job).encode("utf-8"))
+
+    def _invoke(self, model_id: str, record: dict) -> dict:
+        try:
+            response = self.bedrock_runtime_client.invoke_model(modelId=model_id, body=json.dumps(record["modelInput"]))
+            return {"recordId": record["recordId"], "modelInput": record["modelInput"], "modelOutput": json.loads(response["body"].read())}
+        except Exception as e:
+            logger.error(f"Error invoking the model for record '{record['recordId']}': {e}")
+            logger.error(traceback.format_exc())
+            return {"recordId": record["recordId"], "modelInput": record["modelInput"], "error": {"errorMessage": str(e)}}
@@ -1,53 +1,82 @@
 import boto3
+import botocore
 import os
 import json
+import hashlib
 import datetime
 from botocore.config import Config
 import traceback
 import re
 import datetime
-from typing import List
-from aws_lambda_powertools import Logger
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+import bedrock_converse # type: ignore
 
 logger = Logger()
+# metrics are flushed along with the handler's
+metrics = Metrics()
 
 logger.debug(json.dumps(dict(os.environ), indent=4))
 region = os.environ['AWS_REGION']
 
 config = Config(read_timeout=1000, region_name=region)
-s3 = boto3.client("s3", config=config)
-bedrock_runtime = boto3.client("bedrock-runtime", config=config)
+# IMAGE_FETCH_WORKERS: number of images of a batch read from S3 at the same time, each with its own connection
+# WORKER_CONCURRENCY: number of batches analysed at the same time when an invocation is given several batches
+# WORKER_MEMORY_MB: memory a batch takes while it is analysed (its images and the request to the model), the batches
+#  analysed at the same time being also limited to the function's memory divided by it
+image_fetch_workers = int(os.environ.get("IMAGE_FETCH_WORKERS", "10"))
+worker_concurrency = int(os.environ.get("WORKER_CONCURRENCY", "5"))
+worker_memory_mb = int(os.environ.get("WORKER_MEMORY_MB", "200"))
+s3 = boto3.client("s3", config=config.merge(Config(max_pool_connections=image_fetch_workers * worker_concurrency)))
+# Bedrock requests are retried by bedrock_converse.converse_with_retries rather than by the client
+bedrock_runtime = boto3.client("bedrock-runtime", config=config.merge(Config(retries={"mode": "standard", "max_attempts": 1},
+                                                                             max_pool_connections=max(worker_concurrency, 10))))
 
-ddb = boto3.client("dynamodb", config=config)
+# Image format expected by the Converse API for each image file extension
+IMAGE_FORMATS = {".png": "png", ".jpg": "jpeg", ".jpeg": "jpeg", ".webp": "webp", ".gif": "gif"}
+
+# IMAGE_SOURCE_MODE: 'auto' to pass the images by their S3 location to the models accepting it (S3_IMAGE_MODELS), so that
+#  the function doesn't read them, 'bytes' (default) to always read the images and pass them inline
+image_source_mode = os.environ.get("IMAGE_SOURCE_MODE", "bytes")
+# Models whose Converse API accepts images by S3 location (at the time of writing), matched on the beginning of the model ID
+S3_IMAGE_MODELS = ("amazon.nova",)
+
+ddb = boto3.client("dynamodb", config=config.merge(Config(max_pool_connections=max(worker_concurrency, 10))))
 analysis_table = os.environ["ANALYSIS_TABLE"]
 prompt_table = os.environ["PROMPT_TABLE"]
 
 date_timestamp = (datetime.datetime.now()).strftime("%Y-%m-%d_%H:%M:%S")
 
+# Analyses are cached in the image bucket, keyed on everything the model is given, so that a batch analysed before
+#  (e.g. when a video is processed again after a retry) isn't sent to the model again
+#  ANALYSIS_CACHE_PREFIX: prefix of the cached analyses in the image bucket, empty (default) disables the cache
+analysis_cache_bucket = os.environ.get("IMAGE_BUCKET", "")
+analysis_cache_prefix = os.environ.get("ANALYSIS_CACHE_PREFIX", "")
+
+# Model cascade: batches are analysed by ANALYSIS_MODEL_ID first, and again by a stronger model when the first analysis looks uncertain
+#  ESCALATION_MODEL_ID: the stronger model, empty (default) disables the cascade
+#  ESCALATION_MAX_ASSUMPTIONS: most 'ASSUMPTION:' lines an analysis can have without being escalated
+#  ESCALATION_CHANGE: share of the screen changing between two frames above which a batch goes straight to the stronger model,
+#   0 (default) disables it (the changes are measured by the frame extraction, see its IDLE_THRESHOLD)
+#  ESCALATION_COMMAND_LINE: 'true' to escalate the analyses with an 'ASSUMPTION:' line about command-line activity, i.e. a command
+#   the model couldn't read for sure (mentioning a terminal alone doesn't escalate, PAM sessions mostly being terminal sessions)
+escalation_model_id = os.environ.get("ESCALATION_MODEL_ID", "")
+escalation_max_assumptions = int(os.environ.get("ESCALATION_MAX_ASSUMPTIONS", "2"))
+escalation_change = float(os.environ.get("ESCALATION_CHANGE", "0"))
+escalation_command_line = os.environ.get("ESCALATION_COMMAND_LINE", "false").lower() == "true"
+COMMAND_LINE_PATTERN = re.compile(r"\b(command[- ]line|command prompt|terminal|powershell|cmd(\.exe)?|bash|ssh|sudo)\b", re.IGNORECASE)
+
 ######################################## DEFINE FUNCTIONS ########################################
 # Create function to build the prompt
 def build_prompt(response_history: str = "", timelapse: int = 1, number_of_images: int = 20) -> tuple[str, str] | None:
     
     logger.debug(f"###### Retrieving aggregate prompt from DynamoDB table '{prompt_table}' ######")
     try:
-        version_zero = ddb.get_item(
-            TableName=prompt_table,
-            Key={
-                "PromptID": {"S": "analysis-prompt"},
-                "VersionID": {"S": "v0"}
-            }
-        )
-        latest_version = "v" + version_zero["Item"]["Latest"]["N"]
-        results = ddb.get_item(
-            TableName=prompt_table,
-            Key={
-                "PromptID": {"S": "analysis-prompt"},
-                "VersionID": {"S": latest_version}
-            }
-        )
-        prompt_item = results["Item"]
+        latest_version, prompt_item = bedrock_converse.load_prompt_item(ddb, prompt_table, "analysis-prompt")
 
-        prompt_version = f"analysis-v{version_zero["Item"]["Latest"]["N"]}"
+        prompt_version = f"analysis-v{latest_version}"
         logger.debug(f"Analysis prompt:\n---\n{json.dumps(prompt_item)}\n---")
 
         ##### Prompt element 1: Task context
@@ -136,41 +165,152 @@ def build_prompt(response_history: str = "", timelapse: int = 1, number_of_image
         logger.error(traceback.format_exc())
         return None
 
-def create_content(image_bucket_name: str, image_path: str, image_list: List[str]) -> List[dict]:
+# Content of the request to the model for the images, the images being passed by S3 location when 'model_id' accepts it
+#  (see IMAGE_SOURCE_MODE) and read from S3 otherwise
+def create_content(image_bucket_name: str, image_path: str, image_list: List[str], image_timestamps: List[float] | None = None,
+                   image_tile_timestamps: List[List[float]] | None = None, tile_grid: str | None = None, overlap: int = 0,
+                   image_regions: List[List[int] | None] | None = None, model_id: str | None = None) -> List[dict]:
     payload_content_list = []
     logger.debug("###### Reading images from S3 ######")
 
     total_num_images = len(image_list)
     logger.debug(f"batch contains {total_num_images} images")
-    payload_content_list.append({"text": f"reading images in '{','.join(image_list)}'"})
-    # Loop through the image files and build the payload for Bedrock's Converse API
-    for i, image_file in enumerate(image_list):
-        object_key = os.path.join(image_path,image_file)
-        logger.debug(f"reading content of image at {object_key}")
-        payload_content_list.append(
-            {
-                "image": {
-                    "format": "png",
-                    "source": {
-                        "bytes": s3.get_object(
-                            Bucket=image_bucket_name, Key=object_key
-                        )["Body"].read()
-                    },
+    if image_tile_timestamps and tile_grid:
+        # each image is a grid of consecutive video frames, tell the model how to read it and when each frame was taken
+        tile_timestamps = ','.join(f"[{' '.join(f'{t:g}s' for t in timestamps)}]" for timestamps in image_tile_timestamps)
+        payload_content_list.append({"text": f"reading images in '{','.join(image_list)}', each image is a {tile_grid} grid of consecutive video frames "
+                                             f"to read left to right then top to bottom, the frames being taken at '{tile_timestamps}' in the video"})
+    elif image_timestamps:
+        # images may not be evenly spaced in time (e.g. near-duplicate frames were dropped), tell the model when each one was taken
+        payload_content_list.append({"text": f"reading images in '{','.join(image_list)}' taken at '{','.join(f'{t:g}s' for t in image_timestamps)}' in the video"})
+    else:
+        payload_content_list.append({"text": f"reading images in '{','.join(image_list)}'"})
+    if overlap:
+        # the batch starts with the last images of the previous batch, so that actions spanning both are seen as a whole
+        payload_content_list.append({"text": f"the first {overlap} images '{','.join(image_list[:overlap])}' were already part of the previous sequence "
+                                             "and are only given for context"})
+    if image_regions and any(image_regions):
+        # cropped images only show what changed on the screen, tell the model where they sit on the full screen
+        regions = ','.join(f"{image_file} at x={x} y={y} ({w}x{h} pixels)" for image_file, (x, y, w, h) in
+                           ((image_file, region) for image_file, region in zip(image_list, image_regions) if region))
+        payload_content_list.append({"text": f"images '{regions}' are cropped to the part of the screen that changed since the image before them, "
+                                             "the rest of the screen is unchanged"})
+    if model_id and accepts_s3_images(model_id):
+        # the model reads the images from S3 itself
+        for image_file in image_list:
+            payload_content_list.append(
+                {
+                    "image": {
+                        "format": IMAGE_FORMATS.get(os.path.splitext(image_file)[1].lower(), "png"),
+                        "source": {
+                            "s3Location": {"uri": f"s3://{image_bucket_name}/{os.path.join(image_path, image_file)}"}
+                        },
+                    }
                 }
-            }
-        )
+            )
+        return payload_content_list
+    # Read the image files in parallel and build the payload for Bedrock's Converse API, images keeping their order
+    with ThreadPoolExecutor(max_workers=max(min(image_fetch_workers, total_num_images), 1)) as executor:
+        image_contents = executor.map(lambda image_file: _read_image(image_bucket_name, image_path, image_file), image_list)
+        for image_file, image_bytes in zip(image_list, image_contents):
+            payload_content_list.append(
+                {
+                    "image": {
+                        "format": IMAGE_FORMATS.get(os.path.splitext(image_file)[1].lower(), "png"),
+                        "source": {
+                            "bytes": image_bytes
+                        },
+                    }
+                }
+            )
     return payload_content_list
 
 
+def _read_image(image_bucket_name: str, image_path: str, image_file: str) -> bytes:
+    object_key = os.path.join(image_path,image_file)
+    logger.debug(f"reading content of image at {object_key}")
+    return s3.get_object(Bucket=image_bucket_name, Key=object_key)["Body"].read()
+
+
+# Whether the model accepts images by S3 location, with IMAGE_SOURCE_MODE set to 'auto'
+def accepts_s3_images(model_id: str) -> bool:
+    return image_source_mode == "auto" and bedrock_converse.base_model_id(model_id).startswith(S3_IMAGE_MODELS)
+
+
+# The content with the images passed by S3 location read from S3 and passed inline instead, for the models that don't accept S3 locations
+def inline_images(content: List[dict]) -> List[dict]:
+    def inline(block: dict) -> dict:
+        if "image" not in block or "s3Location" not in block["image"]["source"]:
+            return block
+        image_bucket_name, object_key = block["image"]["source"]["s3Location"]["uri"].removeprefix("s3://").split("/", 1)
+        return {"image": {"format": block["image"]["format"], "source": {"bytes": _read_image(image_bucket_name, "", object_key)}}}
+    with ThreadPoolExecutor(max_workers=max(min(image_fetch_workers, len(content)), 1)) as executor:
+        return list(executor.map(inline, content))
+
+
+def _has_s3_images(content: List[dict]) -> bool:
+    return any("image" in block and "s3Location" in block["image"]["source"] for block in content)
+
+
+# Images of the batch described by 'event' (an item of the frame extraction's 'image_batches'), as the keyword
+#  arguments of create_content: the frames are resolved from the frame manifest when the batch refers to one
+def batch_images(image_bucket_name: str, event: dict) -> dict:
+    return batch_images_and_hashes(image_bucket_name, event)[0]
+
+
+# Same as batch_images, along with the SHA-256 hash of every frame of the batch as recorded in the frame manifest
+#  (None when the batch doesn't refer to one), so that the analysis cache can be looked up without reading the images
+def batch_images_and_hashes(image_bucket_name: str, event: dict) -> tuple[dict, List[str] | None]:
+    if "manifest" not in event:
+        return {
+            "image_list": event["image_list"],
+            "image_timestamps": event.get("image_timestamps"),
+            "image_tile_timestamps": event.get("image_tile_timestamps"),
+            "image_regions": None,
+        }, None
+    frames = read_frame_manifest(image_bucket_name, event["manifest"]["key"], event["manifest"]["byte_range"])
+    # the first image of the batch is sent in full, the next ones as the region that changed since the image before
+    image_regions = [None] + [frame["crop"]["region"] if "crop" in frame else None for frame in frames[1:]]
+    return {
+        "image_list": [frame["crop"]["filename"] if region else frame["filename"] for frame, region in zip(frames, image_regions)],
+        "image_timestamps": [frame["timestamp"] for frame in frames],
+        "image_tile_timestamps": [frame.get("cell_timestamps", [frame["timestamp"]]) for frame in frames] if event.get("tile_grid") else None,
+        "image_regions": image_regions,
+    }, [frame["sha256"] for frame in frames]
+
+
+# What the analysis cache keys a batch on besides the model, prompt and inference parameters: everything create_content
+#  builds the request from, with the hash of every frame in place of its image (a cropped image being the region given in
+#  'image_regions' of its frame, compared with the frame before it). None when the hashes are unknown, the batch not being cached.
+def batch_cache_fields(images: dict, image_hashes: List[str] | None, tile_grid: str | None = None, overlap: int = 0) -> dict | None:
+    if not image_hashes:
+        return None
+    return {**images, "image_hashes": image_hashes, "tile_grid": tile_grid, "overlap": overlap}
+
+
+# Read the frames in 'byte_range' of the frame manifest written by the frame extraction, one JSON line per frame
+def read_frame_manifest(image_bucket_name: str, manifest_key: str, byte_range: List[int]) -> List[dict]:
+    start, end = byte_range
+    logger.debug(f"reading frames in bytes {start}-{end - 1} of manifest at {manifest_key}")
+    body = s3.get_object(Bucket=image_bucket_name, Key=manifest_key, Range=f"bytes={start}-{end - 1}")["Body"].read()
+    return [json.loads(line) for line in body.decode("utf-8").splitlines() if line]
+
+
 # Create the function to submit the compiled prompt and images to Bedrock
+#  'content' can be a function returning it, only called when the model is, so that a batch whose analysis is found in
+#   the cache (under 'cache_fields', see batch_cache_fields) doesn't have its images read
 def analyse_images(
     model_id: str,
-    content: List[dict],
+    content: List[dict] | Callable[[], List[dict]],
     prompt: str,
     max_tokens: int = 4096,
     temperature: float = 0,
     top_p: float = 0.999,
     top_k: int = 250,
+    on_partial: Callable[[str], None] | None = None,
+    prompt_version: str | None = None,
+    call_stats: dict | None = None,
+    cache_fields: dict | None = None,
 ):
     logger.debug("###### Sending to Bedrock ######")
     try:
@@ -185,27 +325,129 @@ def analyse_images(
         if (model_id.__contains__("anthropic.claude")):
             additional_model_fields = {"top_k": top_k}
 
-        messages = [{"role": "user", "content": content}]
         system_prompts = [{"text": prompt}]
 
+        # Look for the same request in the cache first, before any image is read
+        cache_key = None
+        if analysis_cache_prefix and analysis_cache_bucket and cache_fields:
+            cache_key = f"{analysis_cache_prefix}/{analysis_cache_key(model_id, cache_fields, prompt, inference_config, additional_model_fields)}.json"
+            cached_analysis = _read_cached_analysis(cache_key)
+            if cached_analysis is not None:
+                logger.info(f"Found the analysis of the images in the cache at '{cache_key}', skipping the call to Bedrock")
+                return cached_analysis
+        if callable(content):
+            content = content()
+
+        # Images passed by S3 location are read and passed inline to the models that don't accept S3 locations
+        if _has_s3_images(content) and not accepts_s3_images(model_id):
+            content = inline_images(content)
+
         # Send the message.
-        resp = bedrock_runtime.converse(
+        request = dict(
             modelId=model_id,
-            messages=messages,
             system=system_prompts,
             inferenceConfig=inference_config,
             additionalModelRequestFields=additional_model_fields,
         )
+        try:
+            resp = bedrock_converse.converse_with_retries(bedrock_runtime, ddb, on_partial=on_partial, messages=[{"role": "user", "content": content}], **request)
+        except botocore.exceptions.ClientError as e:
+            if not _has_s3_images(content) or e.response.get("Error", {}).get("Code") != "ValidationException":
+                raise
+            logger.warning(f"Model '{model_id}' rejected the request with images passed by S3 location ({e}), passing them inline")
+            content = inline_images(content)
+            resp = bedrock_converse.converse_with_retries(bedrock_runtime, ddb, on_partial=on_partial, messages=[{"role": "user", "content": content}], **request)
+        # report the usage of the call, 'call_stats' (if any) summing it for the transcript item
+        #  (an image passed by S3 location only costs its URI in the payload)
+        payload_bytes = len(prompt.encode("utf-8")) + sum(_image_payload_bytes(block["image"]) if "image" in block else len(block["text"].encode("utf-8"))
+                                                          for block in content)
+        bedrock_converse.record_call_usage(resp, model_id, prompt_version, sum(1 for block in content if "image" in block), payload_bytes, call_stats)
         result = resp["output"]["message"]
         logger.debug(f"Bedrock's response={result}")
-        return result["content"][0]["text"]
+        analysis = result["content"][0]["text"]
+        if cache_key:
+            _write_cached_analysis(cache_key, analysis, model_id)
+        return analysis
+    except bedrock_converse.BedrockUnavailableError:
+        raise
     except Exception as e:
         logger.error(f"Error calling Bedrock's Converse API: {e}")
         logger.error(traceback.format_exc())
         return "Empty analysis due to image analysis error - check out Lambda logs in CloudWatch"
 
 
-def store_analysis(video_id: str, sequence_id: str, analysis: str, prompt_version: str) -> None:
+# Analyse the images with ANALYSIS_MODEL_ID ('model_id'), then with ESCALATION_MODEL_ID if the analysis looks uncertain
+#  (see escalation_reasons). Batches whose 'change' exceeds ESCALATION_CHANGE go to ESCALATION_MODEL_ID right away.
+#  Returns the analysis along with the ID of the model it comes from.
+def analyse_images_with_escalation(model_id: str, content: List[dict] | Callable[[], List[dict]], prompt: str, change: float | None = None,
+                                   on_partial: Callable[[str], None] | None = None, **inference_parameters) -> tuple[str, str]:
+    if escalation_model_id and escalation_change > 0 and change is not None and change > escalation_change:
+        logger.info(f"{change:.0%} of the screen changes within the batch, analysing it with '{escalation_model_id}' right away")
+        metrics.add_metric(name="EscalatedSequences", unit=MetricUnit.Count, value=1)
+        model_id = escalation_model_id
+    analysis = analyse_images(model_id=model_id, content=content, prompt=prompt, on_partial=on_partial, **inference_parameters)
+    if not escalation_model_id or model_id == escalation_model_id:
+        return analysis, model_id
+    reasons = escalation_reasons(analysis)
+    if not reasons:
+        return analysis, model_id
+    logger.info(f"Analysing the batch again with '{escalation_model_id}': {', '.join(reasons)}")
+    metrics.add_metric(name="EscalatedSequences", unit=MetricUnit.Count, value=1)
+    return analyse_images(model_id=escalation_model_id, content=content, prompt=prompt, on_partial=on_partial, **inference_parameters), escalation_model_id
+
+
+# Why the analysis should be done again by the stronger model: it failed, has more 'ASSUMPTION:' lines than
+#  ESCALATION_MAX_ASSUMPTIONS or one about command-line activity. Empty if the analysis can be kept.
+def escalation_reasons(analysis: str) -> List[str]:
+    if analysis.startswith("Empty analysis"):
+        return ["the analysis failed"]
+    reasons = []
+    assumptions = [line for line in analysis.splitlines() if "ASSUMPTION:" in line]
+    if len(assumptions) > escalation_max_assumptions:
+        reasons.append(f"{len(assumptions)} assumptions")
+    if escalation_command_line:
+        command_lines = [match.group(0) for match in map(COMMAND_LINE_PATTERN.search, assumptions) if match]
+        if command_lines:
+            reasons.append(f"an assumption about command-line activity ('{command_lines[0]}')")
+    return reasons
+
+
+# Key of the analysis of a batch in the cache: a hash of the model ID, the inference parameters, the prompt and
+#  the batch's 'cache_fields' (see batch_cache_fields), so that no image has to be read to compute it
+def analysis_cache_key(model_id: str, cache_fields: dict, prompt: str, inference_config: dict, additional_model_fields: dict | None) -> str:
+    request = json.dumps({"modelId": model_id, "system": prompt, "batch": cache_fields, "inferenceConfig": inference_config,
+                          "additionalModelRequestFields": additional_model_fields}, sort_keys=True)
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+# The cached analysis at 'cache_key', None if there is none (a failing cache never fails the analysis)
+def _read_cached_analysis(cache_key: str) -> str | None:
+    try:
+        return json.loads(s3.get_object(Bucket=analysis_cache_bucket, Key=cache_key)["Body"].read())["analysis"]
+    except s3.exceptions.NoSuchKey:
+        return None
+    except Exception as e:
+        logger.warning(f"Could not read the analysis cache at '{cache_key}': {e}")
+        return None
+
+
+def _write_cached_analysis(cache_key: str, analysis: str, model_id: str) -> None:
+    try:
+        s3.put_object(Bucket=analysis_cache_bucket, Key=cache_key, ContentType="application/json",
+                      Body=json.dumps({"analysis": analysis, "model_id": model_id, "created": date_timestamp}).encode("utf-8"))
+    except Exception as e:
+        logger.warning(f"Could not write the analysis to the cache at '{cache_key}': {e}")
+
+
+# Analysis of a batch where nothing changes on the screen, written without calling the model
+def idle_analysis(start: float, end: float) -> str:
+    return f"<analysis>\n1. No activity from {start:g}s to {end:g}s in the video, the screen stays unchanged.\n</analysis>"
+
+
+# Store the analysis of a sequence, 'partial' marking an analysis still being streamed (replaced by the final one)
+#  'model_id' (if any) is the model the analysis comes from and 'call_stats' (if any) the usage of the calls made for it
+def store_analysis(video_id: str, sequence_id: str, analysis: str, prompt_version: str, partial: bool = False, model_id: str | None = None,
+                   call_stats: dict | None = None) -> None:
     logger.debug("###### Sending to Bedrock ######")
     try:
         ddb.put_item(
@@ -214,7 +456,10 @@ def store_analysis(video_id: str, sequence_id: str, analysis: str, prompt_versio
                 "VideoID": {"S": video_id},
                 "SequenceID": {"S": f"{prompt_version}#{sequence_id}"},
                 "Analysis": {"S": analysis},
-                "Created": {"S": date_timestamp}
+                "Created": {"S": date_timestamp},
+                **({"ModelID": {"S": model_id}} if model_id else {}),
+                **bedrock_converse.usage_attributes(call_stats),
+                **({"Partial": {"BOOL": True}} if partial else {})
             })
 
     except Exception as e:
@@ -223,4 +468,24 @@ def store_analysis(video_id: str, sequence_id: str, analysis: str, prompt_versio
 
     finally:
         return None
-    
\ No newline at end of file
+    
+
+# The final analysis of a sequence stored by store_analysis, along with the model it comes from. None if there is
+#  none, or only a partial or failed one.
+def stored_analysis(video_id: str, sequence_id: str, prompt_version: str) -> tuple[str, str | None] | None:
+    item = ddb.get_item(
+        TableName=analysis_table,
+        Key={
+            "VideoID": {"S": video_id},
+            "SequenceID": {"S": f"{prompt_version}#{sequence_id}"}
+        },
+        ConsistentRead=True
+    ).get("Item")
+    if not item or "Partial" in item or item["Analysis"]["S"].startswith("Empty analysis"):
+        return None
+    return item["Analysis"]["S"], item.get("ModelID", {}).get("S")
+
+
+def _image_payload_bytes(image: dict) -> int:
+    source = image["source"]
+    return len(source["bytes"]) if "bytes" in source else len(source["s3Location"]["uri"].encode("utf-8"))
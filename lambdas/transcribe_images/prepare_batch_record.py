@@ -0,0 +1,57 @@
+import json
+import os
+import boto3
+from aws_lambda_powertools import Logger, Metrics
+from aws_lambda_powertools.metrics import MetricUnit
+from lib import transcribe_images_converse as ai_lib # type: ignore
+from lib import batch_inference # type: ignore
+
+logger = Logger()
+metrics = Metrics()
+
+# Create an S3 client
+aws_region = os.environ['AWS_REGION']
+s3_client = boto3.client('s3', region_name=aws_region)
+
+# Batch inference mode: write the request of a batch of images as a record of the execution's batch inference job,
+#  instead of sending it to the model right away as transcribe_images does
+@logger.inject_lambda_context
+@metrics.log_metrics
+def lambda_handler(event, context):
+    logger.debug('## ENVIRONMENT VARIABLES')
+    logger.debug(json.dumps(dict(os.environ), indent=4))
+    logger.debug('## EVENT')
+    logger.debug(event)
+    logger.debug('## CONTEXT')
+    logger.debug(context)
+
+    image_bucket_name = os.environ["IMAGE_BUCKET"]
+    model_id = os.environ["ANALYSIS_MODEL_ID"]
+    execution_name = event["execution_name"]
+    batch = event["batch"]
+    batch_info = batch["batch_info"]
+    sequence_id = batch_info["sequence_id"]
+    record_id = batch_inference.record_id(sequence_id)
+
+    # resolve the batch's frames, from the frame manifest if there is one
+    images = ai_lib.batch_images(image_bucket_name, batch)
+    prompt, prompt_version = ai_lib.build_prompt("", 1, len(images["image_list"]))
+    if "idle" in batch:
+        # nothing changes on the screen during the batch, the analysis is stored along with the model's ones
+        idle_start, idle_end = batch["idle"]
+        logger.info(f"Sequence with ID '{sequence_id}' shows no activity from {idle_start:g}s to {idle_end:g}s, skipping the image analysis")
+        metrics.add_metric(name="IdleSequences", unit=MetricUnit.Count, value=1)
+        batch_inference.write_batch(s3_client, image_bucket_name, execution_name, record_id, batch_info, prompt_version,
+                                    ai_lib.idle_analysis(idle_start, idle_end))
+    else:
+        content = ai_lib.create_content(image_bucket_name, batch["image_path"], tile_grid=batch.get("tile_grid"), overlap=batch.get("overlap", 0), **images)
+        model_input = batch_inference.model_input(model_id, content, prompt, max_tokens = 4096, temperature = 0, top_p = 0, top_k = 250)
+        batch_inference.write_record(s3_client, image_bucket_name, execution_name, record_id, model_input)
+        batch_inference.write_batch(s3_client, image_bucket_name, execution_name, record_id, batch_info, prompt_version)
+        logger.info(f"Wrote record '{record_id}' for sequence with ID '{sequence_id}' of video with ID '{batch_info['video_id']}'")
+
+    return {
+        "status": "OK",
+        "message": "Batch record written!",
+        "record_id": record_id
+    }
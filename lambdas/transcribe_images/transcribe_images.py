@@ -1,10 +1,14 @@
 import json
 import os
+import time
+import functools
+from concurrent.futures import ThreadPoolExecutor
 import boto3, botocore
 from aws_lambda_powertools import Logger, Metrics
 from aws_lambda_powertools.logging import correlation_paths
 from aws_lambda_powertools.metrics import MetricUnit
 from lib import transcribe_images_converse as ai_lib # type: ignore
+import bedrock_converse # type: ignore
 
 logger = Logger()
 metrics = Metrics()
@@ -25,6 +29,46 @@ def lambda_handler(event, context):
     logger.debug('## CONTEXT')
     logger.debug(context)
 
+    if "batches" in event:
+        # worker mode: the invocation analyses several batches, WORKER_CONCURRENCY at a time (fewer if the function's
+        #  memory can't hold them, see WORKER_MEMORY_MB), the analyses keeping their order
+        batches = event["batches"]
+        workers = max(min(ai_lib.worker_concurrency, len(batches), int(context.memory_limit_in_mb) // ai_lib.worker_memory_mb), 1)
+        # when the task is retried, the batches analysed by the previous attempts are not sent to the model again
+        retry = event.get("retry_count", 0) > 0
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            analyses = list(executor.map(lambda batch: _transcribe_batch_or_error(batch, retry), batches))
+        # a batch Bedrock kept failing doesn't stop the others, the task is retried once they are all done
+        errors = [analysis for analysis in analyses if isinstance(analysis, Exception)]
+        if errors:
+            raise bedrock_converse.BedrockUnavailableError(
+                f"{len(errors)} of {len(batches)} image batches could not be analysed: {errors[0]}") from errors[0]
+        return {
+            "status": "OK",
+            "message": f"{len(analyses)} image batches analysed!",
+            "analyses": analyses
+        }
+
+    # Return the handling result
+    return {
+        "status": "OK",
+        "message": "Images Analysed!",
+        "analysis": transcribe_batch(event)
+    }
+
+
+# Analysis of the batch 'event', or the BedrockUnavailableError raised when Bedrock kept failing
+def _transcribe_batch_or_error(event: dict, retry: bool = False) -> dict | Exception:
+    try:
+        return transcribe_batch(event, retry)
+    except bedrock_converse.BedrockUnavailableError as e:
+        logger.error(f"Sequence with ID '{event['batch_info']['sequence_id']}' could not be analysed: {e}")
+        return e
+
+
+# Analyse the images of a batch (an item of the frame extraction's 'image_batches') and store the analysis
+#  'retry' keeps the analysis stored by a previous attempt, if any, instead of analysing the batch again
+def transcribe_batch(event: dict, retry: bool = False) -> dict:
     region = os.environ['AWS_REGION']
     ######################################## INPUT VARIABLES ########################################
     timelapse = 1
@@ -45,20 +89,51 @@ def lambda_handler(event, context):
     video_s3_uri = batch_info["video_s3_uri"]
     video_url = batch_info["video_url"]
     sequence_id = batch_info["sequence_id"]
-    image_list = event["image_list"]
-    number_of_images = len(image_list)
+    tile_grid = event.get("tile_grid")
+    # resolve the batch's frames, from the frame manifest if there is one, along with their hashes keying the analysis cache
+    images, image_hashes = ai_lib.batch_images_and_hashes(image_bucket_name, event)
+    overlap = event.get("overlap", 0)
+    number_of_images = len(images["image_list"])
 
-    logger.debug(f"Analyzing content from location '{path_to_image_files}' on S3 bucket '{image_bucket_name}'")
-    ######################################## BUILD PAYLOAD TO BE SENT TO BEDROCK ########################################
-    
-    payload_content = ai_lib.create_content(image_bucket_name, path_to_image_files, image_list)
-    ######################################## SEND TO BEDROCK ########################################
     # build the prompt
     history = "" # no history
     prompt, prompt_version = ai_lib.build_prompt(history, timelapse, number_of_images)
-    analysis = ai_lib.analyse_images(model_id=model_id, content=payload_content, prompt=prompt, max_tokens = 4096, temperature = 0, top_p = 0, top_k = 250)
-    # store the sequence analysis in DynamoDB
-    ai_lib.store_analysis(video_id, sequence_id, analysis, prompt_version)
+    # tokens, latency, images, bytes and estimated cost of the calls to the model
+    call_stats = {}
+    stored = ai_lib.stored_analysis(video_id, sequence_id, prompt_version) if retry else None
+    if stored:
+        logger.info(f"Sequence with ID '{sequence_id}' was analysed by a previous attempt, keeping its analysis")
+        analysis, analysis_model_id = stored
+    elif "idle" in event:
+        # nothing changes on the screen during the batch (see the frame extraction's IDLE_THRESHOLD), no need to ask the model
+        idle_start, idle_end = event["idle"]
+        logger.info(f"Sequence with ID '{sequence_id}' shows no activity from {idle_start:g}s to {idle_end:g}s, skipping the image analysis")
+        metrics.add_metric(name="IdleSequences", unit=MetricUnit.Count, value=1)
+        analysis = ai_lib.idle_analysis(idle_start, idle_end)
+        analysis_model_id = None
+    else:
+        logger.debug(f"Analyzing content from location '{path_to_image_files}' on S3 bucket '{image_bucket_name}'")
+        ######################################## BUILD PAYLOAD TO BE SENT TO BEDROCK ########################################
+
+        # the images are read from S3, or passed by S3 location when the model accepts it (IMAGE_SOURCE_MODE)
+        #  only once the analysis isn't found in the cache, and once for both models of the cascade
+        @functools.cache
+        def payload_content():
+            fetch_started = time.perf_counter()
+            content = ai_lib.create_content(image_bucket_name, path_to_image_files, tile_grid=tile_grid, overlap=overlap, model_id=model_id, **images)
+            # time spent reading the images from S3, before the model is called
+            metrics.add_metric(name="ImageFetchTime", unit=MetricUnit.Milliseconds, value=(time.perf_counter() - fetch_started) * 1000)
+            return content
+        ######################################## SEND TO BEDROCK ########################################
+        # with BEDROCK_STREAMING, the partial analysis is written to DynamoDB as it comes
+        #  with ESCALATION_MODEL_ID, uncertain analyses are done again by the stronger model, 'analysis_model_id' being the one kept
+        analysis, analysis_model_id = ai_lib.analyse_images_with_escalation(model_id=model_id, content=payload_content, prompt=prompt, change=event.get("change"),
+            max_tokens = 4096, temperature = 0, top_p = 0, top_k = 250, prompt_version=prompt_version, call_stats=call_stats,
+            cache_fields=ai_lib.batch_cache_fields(images, image_hashes, tile_grid, overlap),
+            on_partial=lambda partial_analysis: ai_lib.store_analysis(video_id, sequence_id, partial_analysis, prompt_version, partial=True))
+    if not stored:
+        # store the sequence analysis in DynamoDB, along with the model it comes from and the usage of the calls made for it
+        ai_lib.store_analysis(video_id, sequence_id, analysis, prompt_version, model_id=analysis_model_id, call_stats=call_stats)
 
     if analysis.startswith("Empty analysis"):
         logger.info(f"Image analysis for video with ID '{video_id}' is incomplete, failed analysis of sequence with ID '{sequence_id}'... check the logs for errors")
@@ -67,19 +142,13 @@ def lambda_handler(event, context):
         logger.info(f"###### Analysis done for sequence with ID '{sequence_id}' of video with ID '{video_id}' ######")
         logger.debug(f"Analysis of video with ID#{video_id}: \n{analysis}")
 
-    
-    # Return the handling result
     return {
-        "event": event,
-        "status": "OK",
-        "message": "Images Analysed!",
-        "analysis": { 
-            "video_id": video_id,
-            "video_s3_uri": video_s3_uri,
-            "video_url": video_url,
-            "sequence_id": sequence_id,
-            "description": analysis
-        }
+        "video_id": video_id,
+        "video_s3_uri": video_s3_uri,
+        "video_url": video_url,
+        "sequence_id": sequence_id,
+        "model_id": analysis_model_id,
+        "description": analysis
     }
     
 # for local debugging purposes only